@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################### Cost-Aware Suggestions for Hyperopt #######################
+###############################################################################
+# TPE is asked for several candidate configurations with different seeds.
+# Random forests fit on the completed trials predict the loss, with its
+# spread over the trees, and the log train_time of each candidate, and the
+# candidate with the highest expected improvement per predicted second is
+# suggested. Trials that timed out are kept in the runtime model with the
+# time they ran, so expensive regions are learned even without a loss
+import numpy as np
+from scipy.stats import norm
+from sklearn.ensemble import RandomForestRegressor
+from hyperopt import tpe, STATUS_OK
+
+
+def _encode(vals, labels):
+    """Returns the hyperopt vals of trials as rows, with -1 for inactive labels."""
+    X = np.full((len(vals), len(labels)), -1.0)
+    for i, v in enumerate(vals):
+        for j, label in enumerate(labels):
+            if v.get(label):
+                X[i, j] = float(v[label][0])
+    return X
+
+
+def expected_improvement(mu, sigma, best_loss):
+    """Returns the expected improvement below best_loss of normal losses."""
+    sigma = np.maximum(sigma, 1e-12)
+    z = (best_loss - mu) / sigma
+    return (best_loss - mu) * norm.cdf(z) + sigma * norm.pdf(z)
+
+
+class CostAwareSuggest:
+    """Hyperopt algorithm picking among TPE suggestions by expected improvement per second.
+
+    TPE is used alone until n_startup_trials trials finished. cost_exponent
+    weights the predicted runtime, where 0 ignores it and 1 divides by it.
+    """
+
+    def __init__(self, n_candidates=10, n_startup_trials=20,
+                 cost_exponent=1.0, n_trees=50):
+        self.n_candidates = n_candidates
+        self.n_startup_trials = n_startup_trials
+        self.cost_exponent = cost_exponent
+        self.n_trees = n_trees
+
+    def __call__(self, new_ids, domain, trials, seed):
+        # Failed trials are not in trials.trials, but timed out ones have a runtime
+        results = [t for t in trials._dynamic_trials
+                   if 'train_time' in t['result']
+                   and not t['result'].get('pruned')]
+        done = [t for t in results if t['result']['status'] == STATUS_OK]
+        if len(done) < self.n_startup_trials:
+            return tpe.suggest(new_ids, domain, trials, seed)
+
+        rng = np.random.default_rng(seed)
+        candidates = [tpe.suggest(new_ids, domain, trials,
+                                  int(rng.integers(2 ** 31 - 1)))
+                      for _ in range(self.n_candidates)]
+        labels = sorted(domain.params)
+        X_new = _encode([docs[0]['misc']['vals'] for docs in candidates],
+                        labels)
+
+        # Loss model, with the spread over the trees as its uncertainty
+        loss = np.array([t['result']['loss'] for t in done])
+        loss_model = RandomForestRegressor(n_estimators=self.n_trees,
+                                           min_samples_leaf=2,
+                                           random_state=seed % (2 ** 32))
+        loss_model.fit(_encode([t['misc']['vals'] for t in done], labels),
+                       loss)
+        tree_preds = np.array([tree.predict(X_new)
+                               for tree in loss_model.estimators_])
+        ei = expected_improvement(tree_preds.mean(axis=0),
+                                  tree_preds.std(axis=0), loss.min())
+
+        # Runtime model of the completed and timed out trials
+        cost_model = RandomForestRegressor(n_estimators=self.n_trees,
+                                           min_samples_leaf=2,
+                                           random_state=seed % (2 ** 32))
+        cost_model.fit(_encode([t['misc']['vals'] for t in results], labels),
+                       np.log([max(t['result']['train_time'], 1e-3)
+                               for t in results]))
+        cost = np.exp(cost_model.predict(X_new))
+
+        return candidates[int(np.argmax(ei / cost ** self.cost_exponent))]
+
+###############################################################################
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################## Multi-Fidelity HPO over Row Subsamples #####################
+###############################################################################
+# Configurations suggested by TPE are first evaluated on a small stratified
+# subsample of the training rows. The best 1/reduction_factor of each rung
+# are evaluated again on the next, larger subsample and the last rung uses all
+# rows. The subsamples are nested, so a larger rung contains the rows of the
+# smaller ones. The Spearman correlation of the losses between consecutive
+# rungs shows how well the small subsamples rank the configurations
+from concurrent.futures import wait, FIRST_COMPLETED
+import numpy as np
+from scipy.stats import spearmanr
+from hyperopt import tpe, Trials, STATUS_FAIL
+from hyperopt.base import Domain
+from joblib.externals.loky import get_reusable_executor
+from parallelTrials import _init_worker, suggest_trial, complete_trial
+from threadBudget import ThreadBudget
+
+
+def _result(future):
+    """Returns the result of a trial, or a failed result when it raised."""
+    try:
+        return future.result()
+    except Exception as e:
+        return {'status': STATUS_FAIL, 'error': repr(e)}
+
+
+def fidelity_fmin(objective, space, n_configs, rung_rows=(50000, 200000, None),
+                  reduction_factor=4, trials=None, algo=tpe.suggest,
+                  rstate=None, n_workers=None, threads_per_worker=4,
+                  out_file=None, out_columns=('loss', 'params', 'iteration',
+                                              'rows', 'train_time'),
+                  store=None):
+    """Searches space on growing row subsamples and returns the best full-data result.
+
+    rung_rows gives the rows of each rung, with None for all rows. Only
+    n_configs configurations are sampled by TPE, all on the first rung.
+    """
+    if trials is None:
+        trials = Trials()
+    if rstate is None:
+        rstate = np.random.default_rng()
+    budget = ThreadBudget(search=n_workers, estimator=threads_per_worker)
+    budget.log()
+    n_workers = budget.search
+    if store is not None:
+        store.reset()
+
+    domain = Domain(objective, space)
+    executor = get_reusable_executor(max_workers=n_workers,
+                                     initializer=_init_worker,
+                                     initargs=(threads_per_worker,))
+
+    n_total = len(objective.dataset.load()[1])
+    docs, configs = {}, {}
+    rungs = [{} for _ in rung_rows]
+    for k, n_rows in enumerate(rung_rows):
+        fn = objective.with_rows(n_rows)
+        if k == 0:
+            queue = None
+        else:
+            # Best configurations of the previous rung
+            prev = rungs[k - 1]
+            n_keep = max(1, len(prev) // reduction_factor)
+            queue = sorted(prev, key=prev.get)[:n_keep]
+
+        running = {}
+        n_submitted = 0
+        n_jobs = n_configs if queue is None else len(queue)
+        while n_submitted < n_jobs or running:
+            while len(running) < n_workers and n_submitted < n_jobs:
+                if queue is None:
+                    doc, config = suggest_trial(domain, trials, algo, rstate)
+                    tid = doc['tid']
+                    docs[tid], configs[tid] = doc, config
+                else:
+                    tid = queue[n_submitted]
+                running[executor.submit(fn, configs[tid])] = tid
+                n_submitted += 1
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                tid = running.pop(future)
+                result = _result(future)
+                result['iteration'] = tid + 1
+                result['rows'] = min(n_rows or n_total, n_total)
+
+                # Each trial keeps the result of the largest rung it reached
+                complete_trial(trials, docs[tid], result)
+                if result['status'] != STATUS_FAIL:
+                    rungs[k][tid] = result['loss']
+                if store is not None:
+                    store.add(result)
+
+        if not rungs[k]:
+            raise RuntimeError('Every trial failed on rung %d' % k)
+        print('Rung %d (%d rows): %d configurations, best loss %.5f'
+              % (k, min(n_rows or n_total, n_total), len(rungs[k]),
+                 min(rungs[k].values())))
+
+    # How well each rung ranks the configurations of the next one
+    for k in range(1, len(rungs)):
+        tids = list(rungs[k])
+        if len(tids) > 2:
+            rho = spearmanr([rungs[k - 1][t] for t in tids],
+                            [rungs[k][t] for t in tids]).correlation
+            print('Spearman rank correlation of rungs %d and %d: %.3f'
+                  % (k - 1, k, rho))
+
+    if store is not None:
+        store.flush()
+        if out_file is not None:
+            store.export_csv(out_file, out_columns)
+
+    best_tid = min(rungs[-1], key=rungs[-1].get)
+    return docs[best_tid]['result']
+
+###############################################################################
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################## Cache of Binned Datasets for Boosting Models ###############
+###############################################################################
+# The train/valid subsets of every fold are cut from one binned LightGBM
+# Dataset of the training data, built once per data fingerprint and saved in
+# LightGBM binary format. Trials load the binary files instead of binning the
+# raw data again, and each process keeps the loaded Datasets for all of its
+# trials. The XGBoost fold QuantileDMatrix objects are built once per process
+# with the quantile cuts of one reference matrix of all rows. CatBoost Pools of all rows and of each fold are
+# quantized with the same borders and saved in the quantized pool format
+import os
+import json
+import hashlib
+import numpy as np
+
+# Datasets already loaded in this process, keyed by file
+_DATASETS = {}
+
+# Dataset parameters of the LightGBM binary files. feature_pre_filter is off
+# so trials can change min_data_in_leaf on the same Dataset
+LGB_DATASET_PARAMS = {'max_bin': 255,
+                      'feature_pre_filter': False,
+                      'verbose': -1}
+
+
+def cache_file(dataset, kind, params=None, ext='.bin'):
+    """Returns the cache file of a SharedDataset for a kind of data and params."""
+    h = hashlib.blake2b(digest_size=8)
+    h.update(dataset.fingerprint.encode())
+    h.update(json.dumps(params or {}, sort_keys=True, default=str).encode())
+    os.makedirs(dataset.cache_dir, exist_ok=True)
+    return os.path.join(dataset.cache_dir, '%s_%s_%s%s'
+                        % (dataset.name, kind, h.hexdigest(), ext))
+
+
+def _save_lgb(data, file):
+    """Saves a constructed Dataset, replacing the file atomically."""
+    tmp_file = '%s.%d.tmp' % (file, os.getpid())
+    data.save_binary(tmp_file)
+    os.replace(tmp_file, file)
+
+
+def _load_lgb(file, params):
+    """Returns the constructed Dataset of a binary file, loading it once per process."""
+    import lightgbm as lgb
+    if file not in _DATASETS:
+        _DATASETS[file] = lgb.Dataset(file, params=params).construct()
+    return _DATASETS[file]
+
+
+def build_lgb_folds(X, y, kfolds, columns=None, params=None):
+    """Returns the full binned Dataset and the (train, valid) subsets of each fold.
+
+    The folds are cut from the binned full Dataset, so every fold shares
+    its bin mappers and no fold is binned on its own.
+    """
+    import lightgbm as lgb
+    params = dict(LGB_DATASET_PARAMS, **(params or {}))
+    full = lgb.Dataset(X, label=y, feature_name=columns or 'auto',
+                       params=params, free_raw_data=True).construct()
+    folds = [(full.subset(sorted(train_idx)).construct(),
+              full.subset(sorted(valid_idx)).construct())
+             for train_idx, valid_idx in kfolds.split(X, y)]
+    return full, folds
+
+
+def lgb_fold_datasets(dataset, kfolds, params=None):
+    """Returns the binned (train, valid) Datasets of each fold of a SharedDataset."""
+    params = dict(LGB_DATASET_PARAMS, **(params or {}))
+    fold_params = dict(params, kfolds=repr(kfolds))
+    files = [(cache_file(dataset, 'lgb_fold%d_train' % k, fold_params),
+              cache_file(dataset, 'lgb_fold%d_valid' % k, fold_params))
+             for k in range(kfolds.get_n_splits())]
+
+    if not all(os.path.exists(f) for pair in files for f in pair):
+        X, y = dataset.load()
+        _, folds = build_lgb_folds(X, y, kfolds, dataset.columns, params)
+        for (train_set, valid_set), (train_file, valid_file) in zip(folds,
+                                                                   files):
+            _save_lgb(train_set, train_file)
+            _save_lgb(valid_set, valid_file)
+
+    return [(_load_lgb(train_file, params), _load_lgb(valid_file, params))
+            for train_file, valid_file in files]
+
+
+def build_xgb_folds(X, y, kfolds, columns=None, max_bin=256):
+    """Returns the (train, valid) QuantileDMatrix of each fold.
+
+    Every fold uses the quantile sketch of the full data as reference, so
+    the sketch is computed once and the folds share the same cuts.
+    """
+    import xgboost as xgb
+    ref = xgb.QuantileDMatrix(X, label=y, feature_names=columns,
+                              max_bin=max_bin)
+    folds = []
+    for train_idx, valid_idx in kfolds.split(X, y):
+        folds.append((xgb.QuantileDMatrix(X[train_idx], label=y[train_idx],
+                                          feature_names=columns,
+                                          max_bin=max_bin, ref=ref),
+                      xgb.QuantileDMatrix(X[valid_idx], label=y[valid_idx],
+                                          feature_names=columns,
+                                          max_bin=max_bin, ref=ref)))
+    return folds
+
+
+def xgb_fold_matrices(dataset, kfolds, max_bin=256):
+    """Returns the fold QuantileDMatrix objects of a SharedDataset, built once per process."""
+    key = ('xgb', dataset.X_file, repr(kfolds), max_bin)
+    if key not in _DATASETS:
+        X, y = dataset.load()
+        _DATASETS[key] = build_xgb_folds(X, y, kfolds, dataset.columns,
+                                         max_bin)
+    return _DATASETS[key]
+
+
+def _save_cat(pool, file):
+    """Saves a quantized Pool, replacing the file atomically."""
+    tmp_file = '%s.%d.tmp' % (file, os.getpid())
+    pool.save(tmp_file)
+    os.replace(tmp_file, file)
+
+
+def _load_cat(file):
+    """Returns the quantized Pool of a file, loading it once per process."""
+    from catboost import Pool
+    if file not in _DATASETS:
+        _DATASETS[file] = Pool('quantized://' + file)
+    return _DATASETS[file]
+
+
+def catboost_borders_file(dataset, border_count=254):
+    """Returns the file of the quantization borders of a SharedDataset."""
+    return cache_file(dataset, 'cat_borders', {'border_count': border_count},
+                      ext='.tsv')
+
+
+def catboost_pool(dataset, border_count=254):
+    """Returns the quantized Pool of all rows of a SharedDataset.
+
+    Its borders are saved as well and used to quantize every fold.
+    """
+    file = cache_file(dataset, 'cat', {'border_count': border_count})
+    if not os.path.exists(file):
+        from catboost import Pool
+        X, y = dataset.load()
+        pool = Pool(np.asarray(X), label=np.asarray(y),
+                    feature_names=dataset.columns)
+        pool.quantize(border_count=border_count)
+        pool.save_quantization_borders(
+            catboost_borders_file(dataset, border_count))
+        _save_cat(pool, file)
+    return _load_cat(file)
+
+
+def build_catboost_folds(X, y, kfolds, borders_file, columns=None):
+    """Returns the (train, valid) Pools of each fold quantized with the given borders."""
+    from catboost import Pool
+    folds = []
+    for train_idx, valid_idx in kfolds.split(X, y):
+        pools = []
+        for idx in (train_idx, valid_idx):
+            pool = Pool(np.asarray(X[idx]), label=np.asarray(y[idx]),
+                        feature_names=columns)
+            pool.quantize(input_borders=borders_file)
+            pools.append(pool)
+        folds.append(tuple(pools))
+    return folds
+
+
+def catboost_fold_pools(dataset, kfolds, border_count=254):
+    """Returns the quantized (train, valid) Pools of each fold of a SharedDataset."""
+    catboost_pool(dataset, border_count)
+    params = {'border_count': border_count, 'kfolds': repr(kfolds)}
+    files = [(cache_file(dataset, 'cat_fold%d_train' % k, params),
+              cache_file(dataset, 'cat_fold%d_valid' % k, params))
+             for k in range(kfolds.get_n_splits())]
+
+    if not all(os.path.exists(f) for pair in files for f in pair):
+        X, y = dataset.load()
+        borders_file = catboost_borders_file(dataset, border_count)
+        folds = build_catboost_folds(X, y, kfolds, borders_file,
+                                     dataset.columns)
+        for (train_pool, valid_pool), (train_file, valid_file) in zip(folds,
+                                                                     files):
+            _save_cat(train_pool, train_file)
+            _save_cat(valid_pool, valid_file)
+
+    return [(_load_cat(train_file), _load_cat(valid_file))
+            for train_file, valid_file in files]
+
+###############################################################################
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################ Ensemble Selection from Out-of-Fold Predictions ##############
+###############################################################################
+# Greedy forward selection with replacement of Caruana et al. (2004) on the
+# stored out-of-fold predictions of the HPO trials. The ensemble starts from
+# the best single trials, and the trial whose addition gives the best score
+# of the averaged predictions is added in each round. The weights are the
+# times each trial was added, up to the round with the best score, so no
+# model is trained to build the ensemble
+import numpy as np
+import pandas as pd
+from hpoObjectives import _SCORERS, _sign
+from oofStore import OOFStore
+
+
+def ensemble_selection(preds, y, metric='auc', n_iter=50, n_init=5,
+                       n_best=50):
+    """Returns the ensemble weight of each column of preds and the ensemble score.
+
+    Only the n_best columns with the best single score are candidates, and
+    the score is higher for better ensembles with any metric.
+    """
+    y = np.asarray(y).ravel()
+    n_models = preds.shape[1]
+
+    def score(p):
+        return _sign(metric) * _SCORERS[metric](y, p)
+
+    single = np.array([score(preds[:, j]) for j in range(n_models)])
+    candidates = np.argsort(-single)[:n_best]
+
+    counts = np.zeros(n_models)
+    counts[candidates[:n_init]] = 1
+    total = preds[:, candidates[:n_init]].sum(axis=1, dtype=np.float64)
+    best_score, best_counts = score(total / counts.sum()), counts.copy()
+    for i in range(n_iter):
+        scores = [score((total + preds[:, j]) / (counts.sum() + 1))
+                  for j in candidates]
+        j = candidates[int(np.argmax(scores))]
+        counts[j] += 1
+        total += preds[:, j]
+        if max(scores) > best_score:
+            best_score, best_counts = max(scores), counts.copy()
+    return best_counts / best_counts.sum(), best_score
+
+
+def select_ensemble(oof_dir, y, metric='auc', n_iter=50, n_init=5,
+                    n_best=50):
+    """Returns the trials of the ensemble selected from an OOFStore with their weights."""
+    preds, names = OOFStore(oof_dir).load()
+    if not names:
+        return pd.DataFrame(columns=['trial', 'weight', 'score'])
+    weights, ensemble_score = ensemble_selection(preds, y, metric, n_iter,
+                                                 n_init, n_best)
+    single = [_sign(metric) * _SCORERS[metric](np.asarray(y).ravel(),
+                                              preds[:, j])
+              for j in range(len(names))]
+    print('Ensemble of %d trials scores %.5f %s, best single trial %.5f'
+          % ((weights > 0).sum(), _sign(metric) * ensemble_score, metric,
+             _sign(metric) * max(single)))
+
+    ensemble = pd.DataFrame({'trial': names, 'weight': weights,
+                             'score': np.multiply(_sign(metric), single)})
+    return (ensemble[ensemble['weight'] > 0]
+            .sort_values('weight', ascending=False)
+            .reset_index(drop=True))
+
+###############################################################################
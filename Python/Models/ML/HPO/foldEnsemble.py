@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+##################### Fold Model Ensembles of HPO Trials ######################
+###############################################################################
+# The k fold models trained in the cross validation of a trial are kept and
+# their predicted probabilities averaged, so the best trial of a study can
+# be evaluated and saved without training a model on all rows again. Each
+# fold model predicts with the boosting rounds that scored best on its fold
+import os
+import pickle
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+
+class FoldEnsemble(ClassifierMixin, BaseEstimator):
+    """Fold models of a trial averaged into one sklearn classifier.
+
+    It is used in place of the refit model of a study, also by the
+    permutation importance and LIME explanations of the scripts.
+    """
+
+    classes_ = np.array([0, 1])
+
+    def __init__(self, family, models, rounds, columns=None):
+        self.family = family
+        self.models = models
+        self.rounds = rounds
+        self.columns = columns
+
+    @classmethod
+    def load(cls, file):
+        with open(file, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, file):
+        """Pickles the fold models, replacing the file atomically, and returns the file."""
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        tmp_file = '%s.%d.tmp' % (file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmp_file, file)
+        return file
+
+    def _predict_fold(self, model, n_rounds, X):
+        if self.family == 'lightgbm':
+            return model.predict(X, num_iteration=n_rounds)
+        if self.family == 'xgboost':
+            import xgboost as xgb
+            return model.predict(xgb.DMatrix(X, feature_names=self.columns),
+                                 iteration_range=(0, n_rounds))
+        # CatBoost models keep their best iteration only
+        return model.predict_proba(X)[:, 1]
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        preds = np.mean([self._predict_fold(model, n_rounds, X)
+                         for model, n_rounds in zip(self.models, self.rounds)],
+                        axis=0)
+        return np.column_stack([1 - preds, preds])
+
+    def predict(self, X):
+        return (self.predict_proba(X)[:, 1] >= 0.5).astype(int)
+
+###############################################################################
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################ Successive Halving Grid Search for Random Forest #############
+###############################################################################
+# The n_estimators values of the grid do not need a forest each. Every other
+# configuration is fit once per fold, growing the forest with warm_start
+# through the n_estimators values and scoring the validation fold after each
+# step with the running mean of the tree probabilities, so one fit covers all
+# tree counts. The configurations are evaluated on a growing number of rows
+# and only the best 1/factor of them go on to the next rung, where the last
+# rung uses all rows. With cv='oob', a configuration is fit once on the rows
+# of the rung and scored on the out-of-bag rows of its trees instead of k
+# folds, which needs bootstrap=True
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy.stats import spearmanr
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble._forest import _generate_unsampled_indices
+from sklearn.ensemble._forest import _get_n_samples_bootstrap
+from sklearn.model_selection import ParameterGrid, check_cv
+from sklearn.metrics import accuracy_score, roc_auc_score
+from threadBudget import ThreadBudget
+
+
+def _score(scoring, y, proba, classes):
+    """Returns the accuracy or AUC of the positive class probabilities."""
+    if scoring == 'roc_auc':
+        return roc_auc_score(y == classes[1], proba)
+    if scoring == 'accuracy':
+        # Ties go to the first class like RandomForestClassifier.predict
+        return accuracy_score(y, classes[(proba > 0.5).astype(int)])
+    raise ValueError('Unknown scoring: ' + str(scoring))
+
+
+def grow_and_score(params, n_estimators, X_train, y_train, X_valid, y_valid,
+                   scoring='accuracy', n_jobs=1, seed=42):
+    """Returns the validation score of the forest at each of the sorted n_estimators."""
+    forest = RandomForestClassifier(warm_start=True, random_state=seed,
+                                    n_jobs=n_jobs, **params)
+    classes = np.unique(y_train)
+    proba_sum = np.zeros(len(y_valid))
+    scores = []
+    for n in n_estimators:
+        n_fitted = len(getattr(forest, 'estimators_', []))
+        forest.set_params(n_estimators=n).fit(X_train, y_train)
+        # Only the trees added in this step are new to the running sum
+        for tree in forest.estimators_[n_fitted:]:
+            proba_sum += tree.predict_proba(X_valid)[:, 1]
+        scores.append(_score(scoring, y_valid, proba_sum / n, classes))
+    return scores
+
+
+def _unsampled_rows(forest, tree, n_rows):
+    """Returns the rows left out of the bootstrap sample of a tree."""
+    try:
+        n_bootstrap = _get_n_samples_bootstrap(n_rows, forest.max_samples,
+                                               None)
+        return _generate_unsampled_indices(tree.random_state, n_rows,
+                                           n_bootstrap, None)
+    except TypeError:
+        # scikit-learn before sample_weight was added to the bootstrap
+        n_bootstrap = _get_n_samples_bootstrap(n_rows, forest.max_samples)
+        return _generate_unsampled_indices(tree.random_state, n_rows,
+                                           n_bootstrap)
+
+
+def oob_score(params, n_estimators, X, y, scoring='accuracy', n_jobs=1,
+              seed=42):
+    """Returns the out-of-bag score of the forest at each of the sorted n_estimators.
+
+    Each tree predicts only its out-of-bag rows, and rows that are in the
+    bootstrap sample of every tree so far are left out of the score.
+    """
+    if not params.get('bootstrap', True):
+        raise ValueError('Out-of-bag scores need bootstrap=True')
+    forest = RandomForestClassifier(warm_start=True, random_state=seed,
+                                    n_jobs=n_jobs, **params)
+    classes = np.unique(y)
+    proba_sum = np.zeros(len(y))
+    n_oob = np.zeros(len(y))
+    scores = []
+    for n in n_estimators:
+        n_fitted = len(getattr(forest, 'estimators_', []))
+        forest.set_params(n_estimators=n).fit(X, y)
+        for tree in forest.estimators_[n_fitted:]:
+            rows = _unsampled_rows(forest, tree, len(y))
+            proba_sum[rows] += tree.predict_proba(X[rows])[:, 1]
+            n_oob[rows] += 1
+        scored = n_oob > 0
+        scores.append(_score(scoring, y[scored],
+                             proba_sum[scored] / n_oob[scored], classes))
+    return scores
+
+
+class ForestHalvingSearch:
+    """Grid search for a RandomForestClassifier with successive halving and tree reuse.
+
+    Takes the param_grid of GridSearchCV and sets best_params_, best_score_,
+    cv_results_ and, with refit, best_estimator_ fit on all rows. The first
+    rung uses the rows of all rows / factor ** (rungs - 1), at least
+    min_resources. cv is a number of folds, a splitter or 'oob'.
+    """
+
+    def __init__(self, param_grid, cv=3, scoring='accuracy', factor=3,
+                 min_resources=None, refit=True, random_state=42,
+                 budget=None, verbose=1):
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.factor = factor
+        self.min_resources = min_resources
+        self.refit = refit
+        self.random_state = random_state
+        self.budget = budget
+        self.verbose = verbose
+
+    def rung_rows(self, n_configs, n_rows):
+        """Returns the number of rows of each rung."""
+        n_rungs = max(1, int(np.ceil(np.log(n_configs) / np.log(self.factor))))
+        rows = [n_rows // self.factor ** (n_rungs - 1 - i)
+                for i in range(n_rungs)]
+        return [min(n_rows, max(r, self.min_resources or 0)) for r in rows]
+
+    def fit(self, X, y):
+        X = np.asarray(X, dtype=np.float32)
+        y = np.asarray(y).ravel()
+        grid = dict(self.param_grid)
+        n_estimators = sorted(grid.pop('n_estimators', [100]))
+        configs = list(ParameterGrid(grid))
+        oob = isinstance(self.cv, str) and self.cv == 'oob'
+        cv = None if oob else check_cv(self.cv, y, classifier=True)
+        budget = self.budget or ThreadBudget(estimator=4)
+
+        # Each rung takes a prefix of one random order of the rows
+        order = np.random.default_rng(self.random_state).permutation(len(y))
+        candidates = list(range(len(configs)))
+        rung_rows = self.rung_rows(len(configs), len(y))
+        results = []
+        for rung, n_rows in enumerate(rung_rows):
+            rows = np.sort(order[:n_rows])
+            X_rung, y_rung = X[rows], y[rows]
+            if oob:
+                splits = [None]
+                jobs = (delayed(oob_score)(configs[c], n_estimators, X_rung,
+                                           y_rung, self.scoring,
+                                           budget.estimator, self.random_state)
+                        for c in candidates)
+            else:
+                splits = list(cv.split(X_rung, y_rung))
+                jobs = (delayed(grow_and_score)(configs[c], n_estimators,
+                                                X_rung[train_idx],
+                                                y_rung[train_idx],
+                                                X_rung[valid_idx],
+                                                y_rung[valid_idx],
+                                                self.scoring, budget.estimator,
+                                                self.random_state)
+                        for c in candidates for train_idx, valid_idx in splits)
+            if self.verbose:
+                print('Rung %d: %d configurations x %s on %d rows'
+                      % (rung, len(candidates),
+                         'out-of-bag' if oob else '%d folds' % len(splits),
+                         n_rows))
+
+            with budget.backend():
+                fold_scores = Parallel()(jobs)
+            scores = np.asarray(fold_scores).reshape(
+                len(candidates), len(splits), len(n_estimators))
+
+            for c, config_scores in zip(candidates, scores):
+                for j, n in enumerate(n_estimators):
+                    results.append({'rung': rung,
+                                    'n_rows': n_rows,
+                                    'params': dict(configs[c], n_estimators=n),
+                                    'mean_test_score': config_scores[:, j].mean(),
+                                    'std_test_score': config_scores[:, j].std()})
+
+            mean_scores = scores.mean(axis=1)
+            if rung < len(rung_rows) - 1:
+                # Configurations are ranked by their best tree count
+                n_keep = int(np.ceil(len(candidates) / self.factor))
+                keep = np.argsort(-mean_scores.max(axis=1),
+                                  kind='stable')[:n_keep]
+                candidates = [candidates[i] for i in sorted(keep)]
+
+        best, best_n = np.unravel_index(np.argmax(mean_scores),
+                                        mean_scores.shape)
+        self.best_params_ = dict(configs[candidates[best]],
+                                 n_estimators=n_estimators[best_n])
+        self.best_score_ = mean_scores[best, best_n]
+        self.cv_results_ = pd.DataFrame(results)
+
+        if self.refit:
+            self.best_estimator_ = RandomForestClassifier(
+                random_state=self.random_state,
+                n_jobs=ThreadBudget(search=1).estimator,
+                **self.best_params_).fit(X, y)
+        return self
+
+
+def oob_cv_agreement(param_grid, X, y, n_configs=12, cv=3, n_rows=None,
+                     scoring='accuracy', random_state=42, budget=None):
+    """Returns the out-of-bag and cv scores of a random sample of the grid and their Spearman correlation.
+
+    Every sampled configuration is scored at all of its n_estimators values
+    on the same n_rows random rows, or all rows when None.
+    """
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y).ravel()
+    grid = dict(param_grid)
+    n_estimators = sorted(grid.pop('n_estimators', [100]))
+    configs = list(ParameterGrid(grid))
+    budget = budget or ThreadBudget(estimator=4)
+
+    rng = np.random.default_rng(random_state)
+    configs = [configs[i] for i in rng.choice(len(configs),
+                                              min(n_configs, len(configs)),
+                                              replace=False)]
+    if n_rows is not None and n_rows < len(y):
+        rows = np.sort(rng.permutation(len(y))[:n_rows])
+        X, y = X[rows], y[rows]
+    splits = list(check_cv(cv, y, classifier=True).split(X, y))
+
+    with budget.backend():
+        oob_scores = Parallel()(
+            delayed(oob_score)(config, n_estimators, X, y, scoring,
+                               budget.estimator, random_state)
+            for config in configs)
+        fold_scores = Parallel()(
+            delayed(grow_and_score)(config, n_estimators, X[train_idx],
+                                    y[train_idx], X[valid_idx], y[valid_idx],
+                                    scoring, budget.estimator, random_state)
+            for config in configs for train_idx, valid_idx in splits)
+    cv_scores = np.asarray(fold_scores).reshape(
+        len(configs), len(splits), len(n_estimators)).mean(axis=1)
+
+    agreement = pd.DataFrame([{'params': dict(config, n_estimators=n),
+                               'oob_score': oob_scores[i][j],
+                               'cv_score': cv_scores[i, j]}
+                              for i, config in enumerate(configs)
+                              for j, n in enumerate(n_estimators)])
+    rho = spearmanr(agreement['oob_score'], agreement['cv_score'])[0]
+    print('Spearman correlation of OOB and %d-fold cv ranking over %d '
+          'configurations: %.3f' % (len(splits), len(agreement), rho))
+    return agreement, rho
+
+###############################################################################
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+###################### Concurrent Driver for HPO Studies ######################
+###############################################################################
+# A study is one combination of model family, dataset variant, trial budget
+# and metric. A study warm-starts from the study with the next smaller budget
+# of the same family, variant and metric, so the studies form a graph. Every
+# study whose dependency is done is started in a thread of the driver as soon
+# as enough workers are free. All studies submit their trials to one pool of
+# worker processes sized by the CPU and memory budget, so the memory-mapped
+# data and the cached fold data are loaded once per worker and shared by the
+# studies
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from hyperopt import tpe, Trials
+from hpoObjectives import CVObjective
+from costAware import CostAwareSuggest
+from datasetCache import lgb_fold_datasets, catboost_fold_pools
+from parallelTrials import parallel_fmin, best_trial, _init_worker
+from threadBudget import ThreadBudget
+from trialExecutor import KillablePool
+from studyCheckpoint import StudyCheckpoint
+from trialStore import TrialStore
+from trialMemo import TrialMemo
+from trialPruning import FoldPruner
+from warmStart import warm_start, load_hyperopt_archive
+from spaceImportance import narrow_space
+
+# Prefix of the study names of each model family, as in trialOptions
+STUDY_PREFIX = {'catboost': 'Catboost',
+                'xgboost': 'XGB',
+                'lightgbm': 'lightGBM'}
+
+
+class Study:
+    """One HPO study of the matrix and the study it warm-starts from."""
+
+    def __init__(self, family, variant, budget, metric='auc', depends_on=None):
+        self.family = family
+        self.variant = variant
+        self.budget = budget
+        self.metric = metric
+        self.depends_on = depends_on
+        self.name = '%s_HPO_%s_%d' % (STUDY_PREFIX[family], variant, budget)
+        if metric != 'auc':
+            self.name += '_' + metric
+        self.best = None
+
+    def __repr__(self):
+        return 'Study(%s)' % self.name
+
+
+def study_graph(families, variants, budgets, metrics=('auc',)):
+    """Returns the studies of every combination, each depending on the next smaller budget."""
+    studies = []
+    for family in families:
+        for variant in variants:
+            for metric in metrics:
+                previous = None
+                for budget in sorted(budgets):
+                    study = Study(family, variant, budget, metric, previous)
+                    studies.append(study)
+                    previous = study
+    return studies
+
+
+def _available_mb():
+    """Returns the available memory in MB, or None without psutil."""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.virtual_memory().available / 1024 ** 2
+
+
+class StudyScheduler:
+    """Runs a graph of studies concurrently under a CPU and memory budget.
+
+    spaces maps each model family to its search space and datasets each
+    dataset variant to its SharedDataset. The worker pool has one process
+    per threads_per_worker CPUs, capped so the workers fit into memory_mb
+    at worker_mb each, and every running study keeps workers_per_study of
+    them busy. The trial csv, database and checkpoints of the studies are
+    written to out_dir. With cost_aware, TPE suggestions are picked by
+    expected improvement per second, and trials are stopped after
+    trial_timeout seconds, or killed after twice that if they do not stop.
+    Each study stops starting trials after time_budget seconds or cpu_hours
+    of trial CPU time and keeps its best trial so far. Results are shared
+    between the studies and reruns through the trial memo in out_dir. With
+    narrow, a study searches the space narrowed by the trials of the study
+    it warm-starts from. With save_oof, the out-of-fold predictions of the
+    trials are saved to one OOFStore per dataset variant.
+    """
+
+    def __init__(self, spaces, datasets, kfolds, out_dir, n_cpus=None,
+                 memory_mb=None, threads_per_worker=4, workers_per_study=2,
+                 worker_mb=2048, seed=42, prune=True, warm_weight=1.0,
+                 cost_aware=False, trial_timeout=None, time_budget=None,
+                 cpu_hours=None, narrow=False, save_oof=False):
+        self.spaces = spaces
+        self.datasets = datasets
+        self.kfolds = kfolds
+        self.out_dir = out_dir
+        self.threads_per_worker = threads_per_worker
+        self.workers_per_study = workers_per_study
+        self.seed = seed
+        self.prune = prune
+        self.warm_weight = warm_weight
+        self.cost_aware = cost_aware
+        self.trial_timeout = trial_timeout
+        self.time_budget = time_budget
+        self.cpu_hours = cpu_hours
+        self.narrow = narrow
+        self.save_oof = save_oof
+
+        memory_mb = memory_mb or _available_mb()
+        self.budget = ThreadBudget(estimator=threads_per_worker,
+                                   n_cores=n_cpus)
+        self.n_workers = self.budget.search
+        if memory_mb is not None:
+            self.n_workers = max(1, min(self.n_workers,
+                                        int(memory_mb // worker_mb)))
+        self.workers_per_study = min(workers_per_study, self.n_workers)
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.db_file = os.path.join(out_dir, 'trials.db')
+        self.memo_file = os.path.join(out_dir, 'memo.db')
+        self.study_dir = os.path.join(out_dir, 'studies')
+
+    def out_file(self, study):
+        return os.path.join(self.out_dir, study.name + '.csv')
+
+    def oof_dir(self, variant):
+        return os.path.join(self.out_dir, 'oof', variant)
+
+    def prepare(self, studies):
+        """Writes the cached fold data used by the studies before any worker starts.
+
+        Otherwise the workers of concurrent studies would bin the same data
+        at the same time.
+        """
+        for family, variant in sorted({(s.family, s.variant)
+                                       for s in studies}):
+            if family == 'lightgbm':
+                lgb_fold_datasets(self.datasets[variant], self.kfolds)
+            elif family == 'catboost':
+                catboost_fold_pools(self.datasets[variant], self.kfolds)
+
+    def run_study(self, study, executor):
+        """Runs one study on the shared workers and returns its best result."""
+        space = self.spaces[study.family]
+        objective = CVObjective(study.family, self.datasets[study.variant],
+                                self.kfolds, n_threads=self.threads_per_worker,
+                                seed=self.seed, metric=study.metric,
+                                timeout=self.trial_timeout,
+                                oof_dir=(self.oof_dir(study.variant)
+                                         if self.save_oof else None))
+
+        trials = Trials()
+        n_warm = 0
+        if (study.depends_on is not None
+                and os.path.exists(self.out_file(study.depends_on))):
+            # Archives written by the driver already have the current loss
+            params, loss = load_hyperopt_archive(
+                self.out_file(study.depends_on), None)
+            if self.narrow:
+                space = narrow_space(space, params, loss, study.family)
+            n_warm = warm_start(trials, space, params, loss,
+                                family=study.family, weight=self.warm_weight,
+                                rstate=np.random.default_rng(self.seed))
+
+        print('Starting study %s with %d workers'
+              % (study.name, self.workers_per_study))
+        algo = CostAwareSuggest() if self.cost_aware else tpe.suggest
+        parallel_fmin(objective, space, algo=algo,
+                      max_evals=study.budget + n_warm, trials=trials,
+                      rstate=np.random.default_rng(self.seed),
+                      n_workers=self.workers_per_study,
+                      threads_per_worker=self.threads_per_worker,
+                      out_file=self.out_file(study),
+                      checkpoint=StudyCheckpoint(study.name, self.study_dir),
+                      store=TrialStore(self.db_file, study.name),
+                      pruner=FoldPruner(percentile=50) if self.prune else None,
+                      executor=executor,
+                      trial_timeout=(2 * self.trial_timeout
+                                     if self.trial_timeout else None),
+                      time_budget=self.time_budget, cpu_hours=self.cpu_hours,
+                      memo=TrialMemo(self.memo_file))
+
+        study.best = best_trial(trials)['result']
+        print('Finished study %s, best loss %.5f'
+              % (study.name, study.best['loss']))
+        return study.best
+
+    def run(self, studies):
+        """Runs the studies as their dependencies finish and returns the best result of each.
+
+        A study whose dependency failed is skipped, and a dependency that is
+        not in studies counts as done.
+        """
+        self.prepare(studies)
+        executor = KillablePool(self.n_workers, initializer=_init_worker,
+                                initargs=(self.threads_per_worker,))
+        n_slots = self.n_workers // self.workers_per_study
+        ThreadBudget(search=self.n_workers, estimator=self.threads_per_worker,
+                     n_cores=self.budget.n_cores).log()
+        print('Running %d studies, %d at a time on %d workers'
+              % (len(studies), n_slots, self.n_workers))
+
+        pending = list(studies)
+        running = {}
+        done, failed = set(), set()
+        with ThreadPoolExecutor(max_workers=n_slots) as threads:
+            while pending or running:
+                for study in list(pending):
+                    dependency = study.depends_on
+                    if dependency in failed:
+                        print('Skipping study %s, %s failed'
+                              % (study.name, dependency.name))
+                        pending.remove(study)
+                        failed.add(study)
+                    elif (len(running) < n_slots
+                          and (dependency is None or dependency in done
+                               or dependency not in studies)):
+                        future = threads.submit(self.run_study, study,
+                                                executor)
+                        running[future] = study
+                        pending.remove(study)
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    study = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(study)
+                    except Exception as e:
+                        print('Study %s failed: %r' % (study.name, e))
+                        failed.add(study)
+
+        executor.shutdown(wait=False, kill_workers=True)
+        return {study.name: study.best for study in studies}
+
+###############################################################################
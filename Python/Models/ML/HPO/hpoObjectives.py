@@ -0,0 +1,613 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+##################### Picklable HPO Objectives ################################
+###############################################################################
+# The objectives no longer read module globals (ITERATION, out_file, X_train,
+# kfolds), so they can be sent to worker processes. The training data is
+# written once to .npy files and memory-mapped by every worker
+import os
+import json
+import uuid
+import pickle
+import hashlib
+import numpy as np
+from time import process_time
+from timeit import default_timer as timer
+from hyperopt import STATUS_OK, STATUS_FAIL
+from sklearn.metrics import roc_auc_score, log_loss
+from sklearn.model_selection import train_test_split
+from datasetCache import lgb_fold_datasets, build_lgb_folds
+from datasetCache import xgb_fold_matrices, build_xgb_folds
+from datasetCache import catboost_pool, catboost_fold_pools
+from datasetCache import build_catboost_folds, catboost_borders_file
+from oofStore import OOFPredictions, OOFStore
+from foldEnsemble import FoldEnsemble
+from parallelTrials import best_trial
+
+# Arrays already mapped in this process, keyed by file
+_LOADED = {}
+
+# Stratified row orders already computed in this process
+_ORDERS = {}
+
+# Parameter holding the number of boosting rounds of each model family
+ROUNDS_PARAM = {'catboost': 'iterations',
+                'xgboost': 'n_estimators',
+                'lightgbm': 'n_estimators'}
+
+# Name of each HPO metric in every model family. Metrics in _MINIMIZED are
+# negated in the fold scores, so a higher score is always better
+METRICS = {'auc': {'lightgbm': 'auc', 'xgboost': 'auc', 'catboost': 'AUC'},
+           'logloss': {'lightgbm': 'binary_logloss', 'xgboost': 'logloss',
+                       'catboost': 'Logloss'}}
+_MINIMIZED = ['logloss']
+_SCORERS = {'auc': roc_auc_score, 'logloss': log_loss}
+
+
+class SharedDataset:
+    """Training data shared by reference between the HPO workers."""
+
+    def __init__(self, X_file, y_file, columns, name, fingerprint=None):
+        self.X_file = X_file
+        self.y_file = y_file
+        self.columns = columns
+        self.name = name
+        self.fingerprint = fingerprint
+        # Binned and quantized copies of the data are cached next to it
+        self.cache_dir = os.path.join(os.path.dirname(X_file), 'cache')
+
+    @classmethod
+    def create(cls, X, y, data_dir, name):
+        """Writes X and y as float32/int32 .npy files unless they already exist."""
+        os.makedirs(data_dir, exist_ok=True)
+        X_file = os.path.join(data_dir, name + '_X.npy')
+        y_file = os.path.join(data_dir, name + '_y.npy')
+        if not (os.path.exists(X_file) and os.path.exists(y_file)):
+            np.save(X_file, np.ascontiguousarray(X, dtype=np.float32))
+            np.save(y_file, np.asarray(y, dtype=np.int32).ravel())
+        return cls(X_file, y_file, list(X.columns), name,
+                   _file_hash(X_file, y_file))
+
+    def load(self):
+        """Returns the memory-mapped X and y, mapping them once per process."""
+        if self.X_file not in _LOADED:
+            _LOADED[self.X_file] = (np.load(self.X_file, mmap_mode='r'),
+                                    np.load(self.y_file, mmap_mode='r'))
+        return _LOADED[self.X_file]
+
+
+def _file_hash(*files):
+    """Returns a content hash of files, read in chunks."""
+    h = hashlib.blake2b(digest_size=16)
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def stratified_order(y, seed=42):
+    """Returns a row order whose every prefix keeps the class proportions of y."""
+    rng = np.random.default_rng(seed)
+    key = np.empty(len(y))
+    for c in np.unique(y):
+        idx = np.flatnonzero(y == c)
+        # Rows of each class are spread evenly over [0, 1) in random order
+        key[idx] = (rng.permutation(len(idx)) + rng.random(len(idx))) / len(idx)
+    return np.argsort(key, kind='stable')
+
+
+def _peak_rss():
+    """Returns the peak resident memory of this process in MB."""
+    try:
+        import resource
+        # ru_maxrss is in kB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 ** (2 if os.uname().sysname == 'Darwin' else 1)
+    except ImportError:
+        import psutil
+        mem = psutil.Process().memory_info()
+        return getattr(mem, 'peak_wset', mem.rss) / 1024 ** 2
+
+
+def _sign(metric):
+    """Returns the factor turning a value of metric into a score to maximize."""
+    if metric not in METRICS:
+        raise ValueError('Unknown metric: ' + str(metric))
+    return -1 if metric in _MINIMIZED else 1
+
+
+def metric_loss(metric, score):
+    """Returns the hyperopt loss of a score, 1 - AUC or the logloss."""
+    return -score if metric in _MINIMIZED else 1 - score
+
+
+class TrialTimeout(Exception):
+    """Raised when a trial runs past its timeout."""
+
+
+class _Deadline:
+    """Time limit of a trial, checked between boosting rounds and folds."""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+
+    def expired(self):
+        return timer() > self.deadline
+
+    def check(self):
+        if self.expired():
+            raise TrialTimeout('Trial ran past its timeout')
+
+    def after_iteration(self, info):
+        # CatBoost callback, training stops when False is returned
+        return not self.expired()
+
+
+def clean_config(family, config):
+    """Returns the sampled config converted to the parameters the model takes."""
+    config = dict(config)
+    if family == 'catboost':
+        # Parameters that are integers to remain integers
+        config['iterations'] = int(config['iterations'])
+        # Start hyperopt at 3 for max_depth
+        config['depth'] = int(config['depth']) + 3
+    elif family == 'xgboost':
+        config['n_estimators'] = int(config['n_estimators'])
+        config['max_depth'] = int(config['max_depth']) + 3
+    elif family == 'lightgbm':
+        # Retrieve the subsample if present otherwise set to 1.0
+        boosting_type = config['boosting_type']
+        config['boosting_type'] = boosting_type['boosting_type']
+        config['subsample'] = boosting_type.get('subsample', 1.0)
+        for param_name in ['max_depth', 'num_leaves']:
+            config[param_name] = int(config[param_name])
+    else:
+        raise ValueError('Unknown model family: ' + str(family))
+    return config
+
+
+def build_model(family, params, n_threads=-1, seed=42, **kwargs):
+    """Returns the sklearn estimator used by the scripts for a model family."""
+    if family == 'catboost':
+        from catboost import CatBoostClassifier
+        return CatBoostClassifier(loss_function='Logloss',
+                                  eval_metric=kwargs.pop('eval_metric',
+                                                         'AUC'),
+                                  early_stopping_rounds=10,
+                                  logging_level='Silent',
+                                  random_state=seed,
+                                  thread_count=n_threads,
+                                  **params, **kwargs)
+    if family == 'xgboost':
+        from xgboost import XGBClassifier
+        return XGBClassifier(objective='binary:logistic',
+                             booster='gbtree',
+                             scale_pos_weight=1,
+                             use_label_encoder=False,
+                             random_state=seed,
+                             n_jobs=n_threads,
+                             verbosity=0,
+                             **params, **kwargs)
+    if family == 'lightgbm':
+        import lightgbm as lgb
+        return lgb.LGBMClassifier(objective='binary',
+                                  random_state=seed,
+                                  n_jobs=n_threads,
+                                  verbose=-1,
+                                  **params, **kwargs)
+    raise ValueError('Unknown model family: ' + str(family))
+
+
+def continue_fit(family, model, params, X, y, n_rounds, n_threads=-1,
+                 seed=42):
+    """Fits n_rounds more boosting rounds on top of model, or a new model when None."""
+    params = dict(params, **{ROUNDS_PARAM[family]: n_rounds})
+    new_model = build_model(family, params, n_threads, seed)
+    if model is None:
+        new_model.fit(X, y)
+    elif family == 'catboost':
+        new_model.fit(X, y, init_model=model)
+    elif family == 'xgboost':
+        new_model.fit(X, y, xgb_model=model.get_booster())
+    else:
+        new_model.fit(X, y, init_model=model.booster_)
+    return new_model
+
+
+def holdout_refit(family, params, X, y, valid_size=0.1, n_threads=-1,
+                  seed=42, early_stopping_rounds=10):
+    """Fits params on the training data, stopping early on a stratified held out part of it.
+
+    LightGBM params without n_estimators get the 100 rounds of the cv.
+    """
+    X_fit, X_valid, y_fit, y_valid = train_test_split(
+        X, np.ravel(y), test_size=valid_size, stratify=np.ravel(y),
+        random_state=seed)
+    params = dict(params)
+    params.setdefault(ROUNDS_PARAM[family], 100)
+    if family == 'catboost':
+        model = build_model(family, params, n_threads, seed)
+        model.fit(X_fit, y_fit, eval_set=(X_valid, y_valid))
+    elif family == 'xgboost':
+        model = build_model(family, params, n_threads, seed,
+                            eval_metric='auc',
+                            early_stopping_rounds=early_stopping_rounds)
+        model.fit(X_fit, y_fit, eval_set=[(X_valid, y_valid)],
+                  verbose=False)
+    else:
+        import lightgbm as lgb
+        model = build_model(family, params, n_threads, seed)
+        model.fit(X_fit, y_fit, eval_set=[(X_valid, y_valid)],
+                  eval_metric='auc',
+                  callbacks=[lgb.early_stopping(early_stopping_rounds,
+                                                verbose=False)])
+    return model
+
+
+def best_model(trials, family, params, X, y, refit='folds', n_threads=-1,
+               seed=42):
+    """Returns the model of the best trial of a study.
+
+    With refit='folds', the fold models kept from the best trial by a
+    CVObjective with model_dir are averaged, and the best params are refit
+    with holdout_refit when none were kept or with refit='holdout'. Warm
+    start trials are never the best trial.
+    """
+    if refit == 'folds':
+        file = best_trial(trials)['result'].get('fold_models')
+        if file is not None and os.path.exists(file):
+            return FoldEnsemble.load(file)
+        print('No fold models kept for the best trial, refitting with a '
+              'held out early stopping set')
+    return holdout_refit(family, params, X, y, n_threads=n_threads,
+                         seed=seed)
+
+
+def _lgb_cv(params, folds, n_threads, seed, num_boost_round=100,
+            early_stopping_rounds=10, metric='auc', deadline=None, oof=None,
+            models=None):
+    """Returns the mean fold score of each boosting round on binned fold Datasets.
+
+    The fold boosters are updated in lockstep like lgb.cv and stop when the
+    mean score has not improved for early_stopping_rounds rounds. With
+    OOFPredictions, the held out rows are predicted at the best round, and
+    each booster and the best round are added to the models list.
+    """
+    import lightgbm as lgb
+    params = dict(params, objective='binary',
+                  metric=METRICS[metric]['lightgbm'], verbose=-1,
+                  num_threads=n_threads, seed=seed)
+    boosters = []
+    for train_set, valid_set in folds:
+        booster = lgb.Booster(params=params, train_set=train_set)
+        booster.add_valid(valid_set, 'valid')
+        boosters.append(booster)
+
+    score_mean = []
+    for i in range(num_boost_round):
+        scores = []
+        for booster in boosters:
+            booster.update()
+            scores.append(_sign(metric) * booster.eval_valid()[0][2])
+        score_mean.append(np.mean(scores))
+        if deadline is not None:
+            deadline.check()
+        if i - int(np.argmax(score_mean)) >= early_stopping_rounds:
+            break
+
+    best_round = int(np.argmax(score_mean)) + 1
+    for k, booster in enumerate(boosters):
+        if oof is not None:
+            oof.set(k, booster.predict(oof.fold(k), num_iteration=best_round))
+        if models is not None:
+            models.append((booster, best_round))
+    return np.asarray(score_mean)
+
+
+def _xgb_cv(params, folds, n_threads, seed, thresholds=None,
+            early_stopping_rounds=10, metric='auc', deadline=None, oof=None,
+            models=None):
+    """Returns the fold scores, best iterations and whether the trial was pruned.
+
+    Each fold is trained with the native API on its QuantileDMatrix and
+    stops early on the metric of the fold validation set.
+    """
+    import xgboost as xgb
+    params = dict(params, objective='binary:logistic',
+                  eval_metric=METRICS[metric]['xgboost'],
+                  tree_method='hist', scale_pos_weight=1, nthread=n_threads,
+                  seed=seed, verbosity=0)
+    n_rounds = params.pop('n_estimators')
+
+    callbacks = []
+    if deadline is not None:
+        class _Stop(xgb.callback.TrainingCallback):
+            def after_iteration(self, model, epoch, evals_log):
+                return deadline.expired()
+        callbacks.append(_Stop())
+
+    scores, best_iterations = [], []
+    for k, (dtrain, dvalid) in enumerate(folds):
+        booster = xgb.train(params, dtrain, num_boost_round=n_rounds,
+                            evals=[(dvalid, 'valid')],
+                            early_stopping_rounds=early_stopping_rounds,
+                            callbacks=callbacks, verbose_eval=False)
+        if deadline is not None:
+            deadline.check()
+        scores.append(_sign(metric) * booster.best_score)
+        best_iterations.append(booster.best_iteration + 1)
+        if oof is not None:
+            oof.set(k, booster.predict(
+                xgb.DMatrix(oof.fold(k), feature_names=dvalid.feature_names),
+                iteration_range=(0, booster.best_iteration + 1)))
+        if models is not None:
+            models.append((booster, booster.best_iteration + 1))
+
+        if (thresholds is not None and k < len(folds) - 1
+                and np.mean(scores) < thresholds[k]):
+            return scores, best_iterations, True
+    return scores, best_iterations, False
+
+
+def _catboost_cv(params, folds, n_threads, seed, thresholds=None,
+                 metric='auc', deadline=None, oof=None, models=None):
+    """Returns the fold scores, best iterations and whether the trial was pruned.
+
+    Each fold is fit on its quantized train Pool and stops early on the
+    metric of its quantized validation Pool.
+    """
+    name = METRICS[metric]['catboost']
+    scores, best_iterations = [], []
+    for k, (train_pool, valid_pool) in enumerate(folds):
+        model = build_model('catboost', params, n_threads, seed,
+                            eval_metric=name)
+        model.fit(train_pool, eval_set=valid_pool,
+                  callbacks=[deadline] if deadline is not None else None)
+        if deadline is not None:
+            deadline.check()
+        scores.append(_sign(metric)
+                      * model.get_best_score()['validation'][name])
+        best_iterations.append(model.get_best_iteration() + 1)
+        if oof is not None:
+            # The model of the quantized Pool predicts the raw features
+            oof.set(k, model.predict_proba(oof.fold(k))[:, 1])
+        if models is not None:
+            models.append((model, model.get_best_iteration() + 1))
+
+        if (thresholds is not None and k < len(folds) - 1
+                and np.mean(scores) < thresholds[k]):
+            return scores, best_iterations, True
+    return scores, best_iterations, False
+
+
+def _catboost_native_cv(params, pool, kfolds, n_threads, seed, metric='auc'):
+    """Returns the mean test score of each iteration from catboost.cv on a quantized Pool."""
+    from catboost import cv
+    name = METRICS[metric]['catboost']
+    params = dict(params, loss_function='Logloss', eval_metric=name,
+                  thread_count=n_threads, random_seed=seed,
+                  logging_level='Silent')
+    cv_results = cv(pool, params, folds=kfolds, early_stopping_rounds=10,
+                    as_pandas=True)
+    return _sign(metric) * cv_results['test-%s-mean' % name].values
+
+
+class CVObjective:
+    """K-fold AUC or logloss objective for hyperopt that can be pickled to worker processes.
+
+    CatBoost trials use the cached quantized fold Pools, or catboost.cv on
+    the quantized Pool of all rows with engine='cv'. A trial running longer
+    than timeout seconds is stopped at the next boosting round and returned
+    as failed with timed_out. With oof_dir, the out-of-fold predictions of
+    every completed trial on all rows are saved to the OOFStore there, which
+    holds one dataset and fold scheme. With model_dir, the fold models of
+    these trials are saved there as a FoldEnsemble, and complete_trial only
+    keeps the file of the best trial.
+    """
+
+    def __init__(self, family, dataset, kfolds, n_threads=1, seed=42,
+                 n_rows=None, engine='folds', metric='auc', timeout=None,
+                 oof_dir=None, model_dir=None):
+        self.family = family
+        self.dataset = dataset
+        self.kfolds = kfolds
+        self.n_threads = n_threads
+        self.seed = seed
+        self.n_rows = n_rows
+        self.engine = engine
+        self.metric = metric
+        self.timeout = timeout
+        self.oof_dir = oof_dir
+        self.model_dir = model_dir
+
+    def with_rows(self, n_rows):
+        """Returns the objective on a stratified subsample of n_rows, or all rows when None."""
+        return CVObjective(self.family, self.dataset, self.kfolds,
+                           self.n_threads, self.seed, n_rows, self.engine,
+                           self.metric, self.timeout, self.oof_dir,
+                           self.model_dir)
+
+    def with_timeout(self, timeout):
+        """Returns the objective stopping trials after timeout seconds."""
+        return CVObjective(self.family, self.dataset, self.kfolds,
+                           self.n_threads, self.seed, self.n_rows, self.engine,
+                           self.metric, timeout, self.oof_dir, self.model_dir)
+
+    def memo_key(self, config):
+        """Returns the hash of everything the result of config depends on.
+
+        Floats are rounded to 12 significant digits so the same sampled
+        value gives the same key after a round trip through the trials.
+        """
+        params = clean_config(self.family, config)
+        params = sorted((name, float('%.12g' % value)
+                         if isinstance(value, (float, np.floating))
+                         else value.item() if hasattr(value, 'item')
+                         else value)
+                        for name, value in params.items())
+        key = [self.family, self.dataset.fingerprint or self.dataset.X_file,
+               repr(self.kfolds), self.metric, self.engine, self.n_rows,
+               self.seed, params]
+        return hashlib.blake2b(json.dumps(key).encode(),
+                               digest_size=16).hexdigest()
+
+    def load(self):
+        """Returns the training rows of the objective."""
+        X, y = self.dataset.load()
+        if self.n_rows is None or self.n_rows >= len(y):
+            return X, y
+
+        key = (self.dataset.y_file, self.seed)
+        if key not in _ORDERS:
+            _ORDERS[key] = stratified_order(y, self.seed)
+        rows = np.sort(_ORDERS[key][:self.n_rows])
+        return X[rows], y[rows]
+
+    def __call__(self, config, prune_thresholds=None):
+        params = clean_config(self.family, config)
+        result = {'params': params, 'status': STATUS_OK}
+
+        # Start timer for each trial
+        start = timer()
+        cpu_start = process_time()
+        deadline = None
+        if self.timeout is not None:
+            deadline = _Deadline(start + self.timeout)
+        oof = None
+        if self.oof_dir is not None and self.n_rows is None:
+            oof = OOFPredictions(*self.load(), self.kfolds)
+        models = None
+        if self.model_dir is not None and self.n_rows is None:
+            models = []
+        try:
+            best_score = self._cv(params, prune_thresholds, deadline, result,
+                                  oof, models)
+        except TrialTimeout:
+            result['status'] = STATUS_FAIL
+            result['timed_out'] = True
+        if result['status'] == STATUS_OK and not result.get('pruned'):
+            if oof is not None and oof.complete():
+                result['oof'] = OOFStore(self.oof_dir).save(
+                    '%s_%s' % (self.family, self.memo_key(config)), oof.preds)
+            if models:
+                ensemble = FoldEnsemble(self.family, [m for m, _ in models],
+                                        [r for _, r in models],
+                                        self.dataset.columns)
+                result['fold_models'] = ensemble.save(os.path.join(
+                    self.model_dir, '%s_%s.pkl' % (self.family,
+                                                   uuid.uuid4().hex)))
+        result['train_time'] = timer() - start
+        result['cpu_time'] = process_time() - cpu_start
+        result['peak_rss'] = _peak_rss()
+
+        # Loss must be minimized
+        if result['status'] == STATUS_OK:
+            result['loss'] = metric_loss(self.metric, best_score)
+        return result
+
+    def _cv(self, params, prune_thresholds, deadline, result, oof=None,
+            models=None):
+        """Returns the cv score of params, adding the fold details to result."""
+        X, y = self.load()
+        if self.family == 'lightgbm':
+            if self.n_rows is None:
+                folds = lgb_fold_datasets(self.dataset, self.kfolds)
+            else:
+                folds = build_lgb_folds(X, y, self.kfolds,
+                                        self.dataset.columns)[1]
+            score_mean = _lgb_cv(params, folds, self.n_threads, self.seed,
+                                 metric=self.metric, deadline=deadline,
+                                 oof=oof, models=models)
+
+            # Boosting rounds that returned the highest cv score
+            result['estimators'] = int(np.argmax(score_mean) + 1)
+            return np.max(score_mean)
+
+        if self.family == 'catboost' and self.engine == 'cv':
+            if self.n_rows is not None:
+                raise ValueError("engine='cv' runs on all rows only")
+            score_mean = _catboost_native_cv(params,
+                                             catboost_pool(self.dataset),
+                                             self.kfolds, self.n_threads,
+                                             self.seed, self.metric)
+            result['estimators'] = int(np.argmax(score_mean) + 1)
+            return np.max(score_mean)
+
+        if self.family == 'xgboost':
+            if self.n_rows is None:
+                folds = xgb_fold_matrices(self.dataset, self.kfolds)
+            else:
+                folds = build_xgb_folds(X, y, self.kfolds,
+                                        self.dataset.columns)
+            scores, best_iterations, pruned = _xgb_cv(params, folds,
+                                                      self.n_threads,
+                                                      self.seed,
+                                                      prune_thresholds,
+                                                      metric=self.metric,
+                                                      deadline=deadline,
+                                                      oof=oof, models=models)
+        else:
+            if self.n_rows is None:
+                folds = catboost_fold_pools(self.dataset, self.kfolds)
+            else:
+                catboost_pool(self.dataset)
+                folds = build_catboost_folds(
+                    X, y, self.kfolds, catboost_borders_file(self.dataset),
+                    self.dataset.columns)
+            scores, best_iterations, pruned = _catboost_cv(params, folds,
+                                                           self.n_threads,
+                                                           self.seed,
+                                                           prune_thresholds,
+                                                           self.metric,
+                                                           deadline, oof,
+                                                           models)
+        result['fold_scores'] = [float(s) for s in scores]
+        result['pruned'] = pruned
+
+        # Mean of the early stopping iterations of the folds
+        result['estimators'] = int(round(np.mean(best_iterations)))
+        return np.mean(scores)
+
+    def run_rounds(self, config, n_rounds, model_prefix, prev_rounds=0):
+        """Returns the k-fold result after n_rounds boosting rounds.
+
+        The fold models are saved under model_prefix, and with prev_rounds
+        the saved models are loaded and boosted for the remaining rounds.
+        """
+        params = clean_config(self.family, config)
+        params.pop(ROUNDS_PARAM[self.family], None)
+        X, y = self.load()
+
+        start = timer()
+        cpu_start = process_time()
+        scores = []
+        for k, (train_idx, valid_idx) in enumerate(self.kfolds.split(X, y)):
+            model_file = '%s_fold%d.pkl' % (model_prefix, k)
+            model = None
+            if prev_rounds:
+                with open(model_file, 'rb') as file:
+                    model = pickle.load(file)
+            model = continue_fit(self.family, model, params, X[train_idx],
+                                 y[train_idx], n_rounds - prev_rounds,
+                                 self.n_threads, self.seed)
+            with open(model_file, 'wb') as file:
+                pickle.dump(model, file)
+
+            preds = model.predict_proba(X[valid_idx])[:, 1]
+            scores.append(_sign(self.metric)
+                          * _SCORERS[self.metric](y[valid_idx], preds))
+
+        params[ROUNDS_PARAM[self.family]] = n_rounds
+        return {'params': params, 'status': STATUS_OK,
+                'loss': metric_loss(self.metric, np.mean(scores)),
+                'fold_scores': [float(s) for s in scores],
+                'estimators': n_rounds,
+                'train_time': timer() - start,
+                'cpu_time': process_time() - cpu_start,
+                'peak_rss': _peak_rss()}
+
+###############################################################################
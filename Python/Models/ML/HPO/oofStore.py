@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################# Store of Out-of-Fold Predictions of Trials ##################
+###############################################################################
+# The cross validation of each trial predicts every training row once, in the
+# fold where it is held out. These out-of-fold probabilities are saved as one
+# float16 column file per trial, named by the model family and the memo key
+# of the trial, so the trials of all studies on the same dataset and folds
+# can be stacked into one matrix and ensembled without training again
+import os
+import numpy as np
+
+
+class OOFPredictions:
+    """Out-of-fold predicted probabilities of one trial, filled fold by fold."""
+
+    def __init__(self, X, y, kfolds):
+        self.X = X
+        self.valid_rows = [valid_idx for _, valid_idx in kfolds.split(X, y)]
+        self.preds = np.full(len(y), np.nan, dtype=np.float32)
+
+    def fold(self, k):
+        """Returns the held out rows of fold k."""
+        return self.X[self.valid_rows[k]]
+
+    def set(self, k, preds):
+        self.preds[self.valid_rows[k]] = preds
+
+    def complete(self):
+        return not np.isnan(self.preds).any()
+
+
+class OOFStore:
+    """Column files of the out-of-fold predictions of trials on one dataset and fold scheme."""
+
+    def __init__(self, oof_dir, dtype='float16'):
+        self.oof_dir = oof_dir
+        self.dtype = dtype
+
+    def save(self, name, preds):
+        """Writes the predictions of a trial, replacing the file atomically."""
+        os.makedirs(self.oof_dir, exist_ok=True)
+        file = os.path.join(self.oof_dir, name + '.npy')
+        tmp_file = '%s.%d.tmp.npy' % (file[:-4], os.getpid())
+        np.save(tmp_file, np.asarray(preds).astype(self.dtype))
+        os.replace(tmp_file, file)
+        return name
+
+    def names(self):
+        """Returns the names of the stored trials."""
+        if not os.path.isdir(self.oof_dir):
+            return []
+        return sorted(f[:-4] for f in os.listdir(self.oof_dir)
+                      if f.endswith('.npy') and '.tmp' not in f)
+
+    def load(self, names=None):
+        """Returns the predictions of the trials as float32 columns, and their names."""
+        if names is None:
+            names = self.names()
+        preds = np.empty((0, 0), dtype=np.float32)
+        for j, name in enumerate(names):
+            column = np.load(os.path.join(self.oof_dir, name + '.npy'),
+                             mmap_mode='r')
+            if j == 0:
+                preds = np.empty((len(column), len(names)), dtype=np.float32)
+            preds[:, j] = column
+        return preds, list(names)
+
+###############################################################################
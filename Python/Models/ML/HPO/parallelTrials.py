@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################# Parallel Trials Backend for Hyperopt ########################
+###############################################################################
+# Runs n_workers trials at once in worker processes with a fixed number of
+# threads each. TPE is asked for a new point whenever a worker frees up, so
+# every suggestion uses all the results completed so far
+import os
+import csv
+from datetime import datetime
+from timeit import default_timer as timer
+from concurrent.futures import wait, FIRST_COMPLETED
+import numpy as np
+from hyperopt import tpe, Trials, space_eval
+from hyperopt import JOB_STATE_RUNNING, JOB_STATE_DONE, JOB_STATE_ERROR
+from hyperopt import STATUS_OK, STATUS_FAIL
+from hyperopt.exceptions import AllTrialsFailed
+from hyperopt.base import Domain, spec_from_misc
+from joblib.externals.loky import get_reusable_executor
+from threadBudget import ThreadBudget
+from trialExecutor import KillablePool
+
+
+def _init_worker(n_threads):
+    """Limits the BLAS/OpenMP threads of a worker process."""
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(n_threads)
+    from threadpoolctl import threadpool_limits
+    threadpool_limits(n_threads)
+
+
+def _seed(rstate):
+    """Returns the next algorithm seed from a RandomState or Generator."""
+    if isinstance(rstate, np.random.Generator):
+        return int(rstate.integers(2 ** 31 - 1))
+    return int(rstate.randint(2 ** 31 - 1))
+
+
+def suggest_trial(domain, trials, algo, rstate):
+    """Asks the algorithm for one new trial and returns its document and config."""
+    new_ids = trials.new_trial_ids(1)
+    trials.refresh()
+    docs = algo(new_ids, domain, trials, _seed(rstate))
+    for doc in docs:
+        doc['state'] = JOB_STATE_RUNNING
+        doc['book_time'] = datetime.now()
+    trials.insert_trial_docs(docs)
+    trials.refresh()
+
+    doc = trials._dynamic_trials[-1]
+    config = space_eval(domain.expr, spec_from_misc(doc['misc']))
+    return doc, config
+
+
+def complete_trial(trials, doc, result):
+    """Stores the result of a finished trial so TPE can use it."""
+    doc['result'] = result
+    doc['state'] = (JOB_STATE_ERROR if result.get('status') == STATUS_FAIL
+                    else JOB_STATE_DONE)
+    doc['refresh_time'] = datetime.now()
+    trials.refresh()
+    if 'fold_models' in result:
+        _keep_best_models(trials, result)
+
+
+def finished_trials(trials):
+    """Returns the docs of the done and failed trials.
+
+    Trials.trials leaves out failed trials, which still used up a trial of
+    the budget.
+    """
+    return [t for t in trials._dynamic_trials
+            if t['state'] in (JOB_STATE_DONE, JOB_STATE_ERROR)]
+
+
+def completed_results(trials):
+    """Returns the results of the trials evaluated in this study.
+
+    Warm start trials only carry the loss of an archived study and pruned
+    trials the mean of their completed folds, so they are used by TPE but
+    never chosen as the best trial.
+    """
+    return [r for r in trials.results if _completed(r)]
+
+
+def best_trial(trials):
+    """Returns the completed trial with the lowest loss."""
+    docs = [t for t in trials.trials if _completed(t['result'])]
+    if not docs:
+        raise AllTrialsFailed
+    return min(docs, key=lambda t: t['result']['loss'])
+
+
+def best_params(trials):
+    """Returns the point of the best trial like Trials.argmin."""
+    vals = best_trial(trials)['misc']['vals']
+    return {k: v[0] for k, v in vals.items() if v}
+
+
+def _completed(result):
+    return (result.get('status') == STATUS_OK and not result.get('warm_start')
+            and not result.get('pruned'))
+
+
+def _keep_best_models(trials, result):
+    """Deletes the fold models of all but the trial with the lowest loss."""
+    kept = [r for r in trials.results
+            if r is not result and 'fold_models' in r]
+    if any(r['loss'] <= result['loss'] for r in kept):
+        kept = [result]
+    for r in kept:
+        if os.path.exists(r['fold_models']):
+            os.remove(r['fold_models'])
+        del r['fold_models']
+
+
+def parallel_fmin(fn, space, max_evals, trials=None, algo=tpe.suggest,
+                  rstate=None, n_workers=None, threads_per_worker=4,
+                  out_file=None, out_columns=('loss', 'params', 'iteration',
+                                              'train_time'),
+                  checkpoint=None, store=None, pruner=None, executor=None,
+                  trial_timeout=None, time_budget=None, cpu_hours=None,
+                  grace=60, memo=None):
+    """Minimizes fn over space like hyperopt.fmin, running trials in parallel.
+
+    fn must be picklable and return a hyperopt result dict. The iteration of
+    each trial is its order of suggestion, and results are added to the
+    TrialStore as they complete and exported to out_file at the end. With a
+    StudyCheckpoint, the study state is saved after every trial and an
+    existing checkpoint is resumed instead of trials/rstate. With a
+    FoldPruner, fn is also passed the fold thresholds of the completed trials.
+    An executor shared by several studies can be given, in which case
+    n_workers is how many of its processes this study keeps busy. A trial
+    without a result trial_timeout seconds after it was submitted is
+    recorded as failed with timed_out. With a KillablePool, which is used
+    when the study has a trial_timeout or time_budget and no executor is
+    given, the worker of the trial is killed so its slot is free at once.
+    Other executors finish the trial while the study goes on and its late
+    result is discarded.
+
+    With time_budget seconds or cpu_hours of trial CPU time, no trial is
+    started once the budget is spent. Objectives with with_timeout, like
+    CVObjective, are told to stop at the time_budget deadline, and trials
+    still running grace seconds after it are recorded as timed out, so the
+    best trial so far is returned in time. The best loss after each trial
+    against the elapsed time is written to out_file ending in _anytime.
+
+    With a TrialMemo and an objective with memo_key, a configuration whose
+    result is in the memo is completed with it at once instead of being
+    submitted, and the results of the other trials are added to the memo.
+    """
+    if trials is None:
+        trials = Trials()
+    if rstate is None:
+        rstate = np.random.default_rng()
+    if checkpoint is not None and checkpoint.exists():
+        # Restore into the caller's Trials so it sees the resumed study
+        saved_trials, rstate = checkpoint.load()
+        trials._dynamic_trials = saved_trials._dynamic_trials
+        trials._ids = saved_trials._ids
+        trials.refresh()
+        print('Resuming study %s after %d completed trials'
+              % (checkpoint.study_name, len(finished_trials(trials))))
+    if store is not None:
+        # Rows of an earlier run are replaced by the trials being continued
+        store.reset()
+        for doc in finished_trials(trials):
+            if 'iteration' in doc['result']:
+                store.add(doc['result'])
+    budget = ThreadBudget(search=n_workers, estimator=threads_per_worker)
+    budget.log()
+    n_workers = budget.search
+
+    domain = Domain(fn, space)
+    own_executor = executor is None
+    if own_executor and (trial_timeout is not None
+                         or time_budget is not None):
+        executor = KillablePool(n_workers, initializer=_init_worker,
+                                initargs=(threads_per_worker,))
+    elif own_executor:
+        executor = get_reusable_executor(max_workers=n_workers,
+                                         initializer=_init_worker,
+                                         initargs=(threads_per_worker,))
+
+    start = timer()
+    deadline = start + time_budget if time_budget is not None else None
+    cpu_used = sum(r.get('cpu_time', 0) for r in trials.results)
+    ok_losses = [r['loss'] for r in completed_results(trials)]
+    best_loss = min(ok_losses) if ok_losses else None
+    curve = []
+
+    def in_budget():
+        return ((deadline is None or timer() < deadline)
+                and (cpu_hours is None or cpu_used < cpu_hours * 3600))
+
+    def record(doc, result):
+        nonlocal n_done, cpu_used, best_loss
+        result['iteration'] = doc['tid'] + 1
+        complete_trial(trials, doc, result)
+        n_done += 1
+
+        cpu_used += result.get('cpu_time', 0)
+        if _completed(result) and (
+                best_loss is None or result['loss'] < best_loss):
+            best_loss = result['loss']
+        curve.append((timer() - start, cpu_used / 3600, n_done, best_loss))
+
+        if store is not None:
+            store.add(result)
+        if checkpoint is not None:
+            checkpoint.save(trials, rstate)
+
+    use_memo = memo is not None and hasattr(fn, 'memo_key')
+    running = {}
+    submitted = {}
+    keys = {}
+    # Timed out trials of an executor that cannot kill them keep their
+    # worker busy until they return
+    abandoned = set()
+    n_submitted = n_done = len(finished_trials(trials))
+    while running or (n_submitted < max_evals and in_budget()):
+        # Keep every worker busy while trials and budget remain
+        while (len(running) + len(abandoned) < n_workers
+               and n_submitted < max_evals and in_budget()):
+            doc, config = suggest_trial(domain, trials, algo, rstate)
+            n_submitted += 1
+            if use_memo:
+                key = fn.memo_key(config)
+                result = memo.get(key)
+                if result is not None:
+                    record(doc, result)
+                    continue
+
+            trial_fn = fn
+            if deadline is not None and hasattr(fn, 'with_timeout'):
+                remaining = deadline - timer()
+                if fn.timeout is None or remaining < fn.timeout:
+                    trial_fn = fn.with_timeout(remaining)
+            if pruner is not None:
+                future = executor.submit(trial_fn, config,
+                                         pruner.thresholds(trials.results))
+            else:
+                future = executor.submit(trial_fn, config)
+            running[future] = doc
+            submitted[future] = timer()
+            if use_memo:
+                keys[future] = key
+
+        # Wake up for the next result or the first trial past its time limit
+        limits = {}
+        for future in running:
+            limit = float('inf')
+            if trial_timeout is not None:
+                limit = submitted[future] + trial_timeout
+            if deadline is not None:
+                limit = min(limit, deadline + grace)
+            limits[future] = limit
+        timeout = None
+        if limits and min(limits.values()) < float('inf'):
+            timeout = max(0, min(limits.values()) - timer())
+        finished, _ = wait(list(running) + list(abandoned), timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+        abandoned -= finished
+        now = timer()
+        done = [f for f in running if f in finished or now >= limits[f]]
+        for future in done:
+            doc = running.pop(future)
+            elapsed = timer() - submitted.pop(future)
+            if not future.done():
+                if isinstance(executor, KillablePool):
+                    executor.kill(future)
+                else:
+                    abandoned.add(future)
+                result = {'status': STATUS_FAIL, 'timed_out': True,
+                          'train_time': elapsed}
+            else:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'status': STATUS_FAIL, 'error': repr(e)}
+            if use_memo:
+                memo.put(keys.pop(future), result)
+            record(doc, result)
+
+    if n_submitted < max_evals:
+        print('Study stopped by its budget after %d of %d trials, %.0f s and '
+              '%.2f CPU hours' % (n_submitted, max_evals, timer() - start,
+                                  cpu_used / 3600))
+    if use_memo and memo.hits:
+        print('%d trials returned from the memo' % memo.hits)
+    if own_executor and (abandoned or isinstance(executor, KillablePool)):
+        # Timed out trials are not waited for, and killable workers are not
+        # reused by later studies
+        executor.shutdown(wait=False, kill_workers=True)
+
+    if out_file is not None:
+        with open(out_file[:-4] + '_anytime.csv', 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['elapsed', 'cpu_hours', 'trials', 'best_loss'])
+            writer.writerows(curve)
+
+    if store is not None:
+        store.flush()
+        if out_file is not None:
+            store.export_csv(out_file, out_columns)
+
+    return best_params(trials)
+
+###############################################################################
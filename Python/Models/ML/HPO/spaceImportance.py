@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################ Hyperparameter Importance and Narrowed Spaces ################
+###############################################################################
+# A random forest surrogate is fit on the params and loss of the trials of a
+# study. The importance of a hyperparameter is the share of the variance of
+# the surrogate explained by its marginal effect, the partial dependence of
+# the predicted loss on it, as the first order terms of fANOVA. The next
+# study can search a narrowed space, where hyperparameters without effect are
+# frozen at the value of the best trial and the ranges of the others are cut
+# to the values of the best trials
+import ast
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from hyperopt import hp
+from hyperopt.pyll import Literal
+from warmStart import raw_config
+
+
+def params_frame(params):
+    """Returns one column per hyperparameter from the params strings of a trial csv."""
+    return pd.DataFrame(params.map(ast.literal_eval).tolist(),
+                        index=params.index)
+
+
+def _encode(frame):
+    """Returns the params as a float matrix, categories as their codes and missing as -1."""
+    X = np.empty(frame.shape)
+    for j, name in enumerate(frame.columns):
+        column = frame[name]
+        if not pd.api.types.is_numeric_dtype(column):
+            column = pd.Series(pd.factorize(column)[0], index=column.index)
+        X[:, j] = column.astype(np.float64).fillna(-1).values
+    return X
+
+
+def fit_surrogate(frame, loss, n_trees=200, seed=42):
+    """Returns the random forest predicting the loss of the trials from their params."""
+    model = RandomForestRegressor(n_estimators=n_trees, min_samples_leaf=2,
+                                  random_state=seed, n_jobs=-1)
+    return model.fit(_encode(frame), np.asarray(loss, dtype=np.float64))
+
+
+def marginal_effects(frame, loss, n_grid=20, model=None, seed=42):
+    """Returns the predicted loss of each hyperparameter over a grid of its values.
+
+    Each value is set for all trials at once and the predictions averaged,
+    so every curve is one predict call.
+    """
+    if model is None:
+        model = fit_surrogate(frame, loss, seed=seed)
+    X = _encode(frame)
+    curves = []
+    for j, name in enumerate(frame.columns):
+        grid = np.unique(np.quantile(X[:, j], np.linspace(0, 1, n_grid)))
+        X_grid = np.tile(X, (len(grid), 1))
+        X_grid[:, j] = np.repeat(grid, len(X))
+        pred = model.predict(X_grid).reshape(len(grid), len(X)).mean(axis=1)
+        curves.append(pd.DataFrame({'param': name, 'value': grid,
+                                    'loss': pred}))
+    return pd.concat(curves, ignore_index=True)
+
+
+def param_importance(frame, loss, n_grid=20, seed=42):
+    """Returns the share of the variance of the predicted loss explained by each hyperparameter."""
+    model = fit_surrogate(frame, loss, seed=seed)
+    total = model.predict(_encode(frame)).var()
+    effects = marginal_effects(frame, loss, n_grid, model)
+    importance = effects.groupby('param', sort=False)['loss'].var(ddof=0)
+    importance = (importance / total if total > 0 else importance * 0)
+    return (importance.rename('importance').reset_index()
+            .sort_values('importance', ascending=False)
+            .reset_index(drop=True))
+
+
+def _narrow_node(node, label, values, pad):
+    """Returns the distribution of node cut to the range of values, or node when it cannot be cut."""
+    if node.name == 'float' and node.pos_args[0].name == 'hyperopt_param':
+        dist = node.pos_args[0].pos_args[1]
+        low, high = dist.pos_args[0].obj, dist.pos_args[1].obj
+        if dist.name == 'uniform':
+            lo, hi = min(values), max(values)
+        elif dist.name == 'loguniform':
+            lo, hi = np.log(min(values)), np.log(max(values))
+        else:
+            return node
+        span = high - low
+        return getattr(hp, dist.name)(label, max(low, lo - pad * span),
+                                      min(high, hi + pad * span))
+
+    if node.name == 'switch':
+        options = node.pos_args[1:]
+        if len(options) < 2 or not all(isinstance(o, Literal)
+                                       for o in options):
+            return node
+        options = [o.obj for o in options]
+        if all(isinstance(o, (int, float, np.number)) for o in options):
+            kept = [o for o in options if min(values) <= o <= max(values)]
+        else:
+            kept = [o for o in options if o in set(values)]
+        if 0 < len(kept) < len(options):
+            return hp.choice(label, kept)
+    return node
+
+
+def narrow_space(space, params, loss, family=None, freeze_below=0.02,
+                 top_fraction=0.2, pad=0.1, min_trials=30):
+    """Returns the search space of the next study from the trials of the last one.
+
+    params are the cleaned params of the trials and loss their loss. Top
+    level hyperparameters explaining less than freeze_below of the predicted
+    loss variance are frozen at the value of the best trial. Uniform ranges
+    and integer choices of the others are cut to the values of the
+    top_fraction best trials, widened by pad of the original range. With
+    fewer than min_trials trials the space is returned unchanged.
+    """
+    loss = np.asarray(loss, dtype=np.float64)
+    keep = np.isfinite(loss)
+    params = [p for p, k in zip(params, keep) if k]
+    loss = loss[keep]
+    if len(params) < min_trials:
+        return space
+
+    frame = pd.DataFrame(params)
+    importance = param_importance(frame, loss).set_index('param')['importance']
+    raw = [raw_config(family, p) if family else dict(p) for p in params]
+    order = np.argsort(loss)
+    top = [raw[i] for i in order[:max(2, int(len(raw) * top_fraction))]]
+
+    narrowed = dict(space)
+    for key, node in space.items():
+        if isinstance(node, Literal) or not hasattr(node, 'name'):
+            continue
+        # Dict valued choices hold several cleaned params
+        value = raw[order[0]].get(key)
+        columns = list(value) if isinstance(value, dict) else [key]
+        if not all(c in importance for c in columns):
+            continue
+
+        if importance[columns].sum() < freeze_below:
+            narrowed[key] = value
+            print('%-20s frozen at %s' % (key, value))
+        elif not isinstance(value, dict):
+            narrowed[key] = _narrow_node(node, key, [t[key] for t in top],
+                                         pad)
+    return narrowed
+
+###############################################################################
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+###################### Checkpoints for HPO Studies ############################
+###############################################################################
+# The Trials object and the random state used for suggestions are pickled
+# after every completed trial. Re-running a study with the same name resumes
+# with the remaining trial budget and continues the same random stream
+import os
+import pickle
+from hyperopt import JOB_STATE_DONE, JOB_STATE_ERROR
+
+
+class StudyCheckpoint:
+    """Durable state of a named HPO study."""
+
+    def __init__(self, study_name, checkpoint_dir):
+        self.study_name = study_name
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.file = os.path.join(checkpoint_dir, study_name + '.pkl')
+
+    def exists(self):
+        return os.path.exists(self.file)
+
+    def save(self, trials, rstate):
+        """Pickles the trials and random state, replacing the file atomically."""
+        tmp_file = self.file + '.tmp'
+        with open(tmp_file, 'wb') as file:
+            pickle.dump({'trials': trials, 'rstate': rstate}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file, self.file)
+
+    def load(self):
+        """Returns the trials and random state of the study.
+
+        Trials that were still running when the study stopped are discarded
+        so they are suggested and evaluated again.
+        """
+        with open(self.file, 'rb') as file:
+            state = pickle.load(file)
+
+        trials = state['trials']
+        trials._dynamic_trials = [t for t in trials._dynamic_trials
+                                  if t['state'] in (JOB_STATE_DONE,
+                                                    JOB_STATE_ERROR)]
+        trials.refresh()
+        return trials, state['rstate']
+
+###############################################################################
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+########################## Lending Tree Loan Status ###########################
+########################### HPO Study Matrix ##################################
+###############################################################################
+# Runs the HPO studies of every model family, dataset variant and trial
+# budget at once instead of the serial sections of the model scripts. The
+# refits, metrics and explanations stay in the model scripts, which can read
+# the best parameters from the trial csv files written here
+import os
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold
+from hyperopt import hp
+sys.path.insert(0, r'D:\LoanStatus\Python\Models\ML\HPO')
+from hpoObjectives import SharedDataset
+from hpoDriver import StudyScheduler, study_graph
+from ensembleSelection import select_ensemble
+
+# Set seed
+seed_value = 42
+
+# Studies to run, a study per combination
+FAMILIES = ['catboost', 'xgboost', 'lightgbm']
+VARIANTS = ['Upsampling', 'SMOTE']
+BUDGETS = [100, 300, 500]
+METRICS = ['auc']
+
+# CPU and memory budget of all studies, memory in MB where None is the
+# available memory
+N_CPUS = os.cpu_count()
+MEMORY_MB = None
+THREADS_PER_WORKER = 4
+WORKERS_PER_STUDY = 2
+WORKER_MB = 4096
+
+# Pick TPE suggestions by expected improvement per predicted second, and
+# stop trials running longer than TRIAL_TIMEOUT seconds
+COST_AWARE = True
+TRIAL_TIMEOUT = 1800
+
+# Wall-clock seconds and CPU hours of each study, where None is no limit
+TIME_BUDGET = 4 * 3600
+CPU_HOURS = None
+
+# Search the space narrowed by the trials of the next smaller budget
+NARROW_SPACE = True
+
+# Save the out-of-fold predictions of the trials and select an ensemble of
+# them for each dataset variant
+SAVE_OOF = True
+
+# Trial csv files, database and checkpoints of the studies
+OUT_DIR = r'D:\LoanStatus\Python\Models\ML\HPO\studyMatrix'
+
+# Define parameter grids
+search_spaces = {
+    'catboost': {
+        'iterations': hp.choice('iterations', np.arange(100, 500, dtype=int)),
+        'depth': hp.choice('depth', np.arange(3, 10, dtype=int)),
+        'l2_leaf_reg': hp.uniform('l2_leaf_reg', 1e-2, 1e0),
+        'learning_rate': hp.uniform('learning_rate', 1e-4, 0.3),
+        'min_data_in_leaf': hp.choice('min_data_in_leaf', np.arange(2, 20,
+                                                                    dtype=int)),
+        'one_hot_max_size': hp.choice('one_hot_max_size', np.arange(2, 20,
+                                                                    dtype=int)),
+        'scale_pos_weight': hp.uniform('scale_pos_weight', 1e-2, 1.0)
+        },
+    'xgboost': {
+        'n_estimators': hp.choice('n_estimators', np.arange(100, 500, dtype=int)),
+        'max_depth': hp.choice('max_depth', np.arange(3, 10, dtype=int)),
+        'subsample': hp.uniform('subsample', 0.25, 0.75),
+        'gamma': hp.uniform('gamma', 0, 9),
+        'learning_rate': hp.uniform('learning_rate', 0.0001, 0.3),
+        'reg_alpha': hp.choice('reg_alpha', np.arange(0, 30, dtype=int)),
+        'reg_lambda': hp.uniform('reg_lambda', 0, 3),
+        'colsample_bytree': hp.uniform('colsample_bytree', 0.5, 1),
+        'colsample_bylevel': hp.uniform('colsample_bylevel', 0.05, 0.5),
+        'min_child_weight': hp.choice('min_child_weight', np.arange(0, 10,
+                                                                    dtype=int)),
+        },
+    'lightgbm': {
+        'force_col_wise': hp.choice('force_col_wise', '+'),
+        'learning_rate': hp.loguniform('learning_rate', np.log(1e-2), np.log(1)),
+        'max_depth': hp.choice('max_depth', np.arange(5, 6, dtype=int)),
+        'num_leaves': hp.choice('num_leaves', np.arange(30, 100, dtype=int)),
+        'boosting_type': hp.choice('boosting_type',
+                                   [{'boosting_type': 'gbdt',
+                                     'subsample': hp.uniform('gdbt_subsample',
+                                                             0.5, 1)},
+                                    {'boosting_type': 'dart',
+                                     'subsample': hp.uniform('dart_subsample',
+                                                             0.5, 1)},
+                                    {'boosting_type': 'goss',
+                                     'subsample': 1.0}]),
+        'colsample_bytree': hp.uniform('colsample_by_tree', 0.6, 1.0),
+        'reg_alpha': hp.uniform('reg_alpha', 0.0, 1.0),
+        'reg_lambda': hp.uniform('reg_lambda', 0.0, 1.0),
+        }
+    }
+
+# The worker processes import this file, so the data is only read and the
+# studies only run in the main process
+if __name__ == '__main__':
+    path = r'D:\LoanStatus\Data'
+    os.chdir(path)
+
+    # Read data
+    train_US = pd.read_csv('trainDF_US.csv', low_memory=False)
+    train_SMOTE = pd.read_csv('trainDF_SMOTE.csv', low_memory=False)
+
+    # Training sets written once and memory-mapped by the HPO workers
+    datasets = {
+        'Upsampling': SharedDataset.create(train_US.drop('loan_status', axis=1),
+                                           train_US[['loan_status']],
+                                           r'D:\LoanStatus\Data\sharedData',
+                                           'trainDF_US'),
+        'SMOTE': SharedDataset.create(train_SMOTE.drop('loan_status', axis=1),
+                                      train_SMOTE[['loan_status']],
+                                      r'D:\LoanStatus\Data\sharedData',
+                                      'trainDF_SMOTE')
+        }
+    del train_US, train_SMOTE
+
+    # Set same k-folds for reproducibility
+    kfolds = KFold(n_splits=3, shuffle=True, random_state=seed_value)
+
+    scheduler = StudyScheduler(search_spaces, datasets, kfolds, OUT_DIR,
+                               n_cpus=N_CPUS, memory_mb=MEMORY_MB,
+                               threads_per_worker=THREADS_PER_WORKER,
+                               workers_per_study=WORKERS_PER_STUDY,
+                               worker_mb=WORKER_MB, seed=seed_value,
+                               cost_aware=COST_AWARE,
+                               trial_timeout=TRIAL_TIMEOUT,
+                               time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                               narrow=NARROW_SPACE, save_oof=SAVE_OOF)
+    best = scheduler.run(study_graph(FAMILIES, VARIANTS, BUDGETS, METRICS))
+
+    # Summary of the best trial of each study
+    summary = pd.DataFrame([{'study': name,
+                             'loss': result['loss'] if result else None,
+                             'params': result['params'] if result else None}
+                            for name, result in best.items()])
+    summary.to_csv(os.path.join(OUT_DIR, 'studyMatrix_best.csv'), index=False)
+    print(summary[['study', 'loss']].to_string(index=False))
+
+    # Weighted ensembles of the trials of all studies on each variant
+    if SAVE_OOF:
+        for variant in VARIANTS:
+            ensemble = select_ensemble(scheduler.oof_dir(variant),
+                                       datasets[variant].load()[1])
+            ensemble.to_csv(os.path.join(OUT_DIR, 'studyMatrix_ensemble_%s.csv'
+                                         % variant), index=False)
+
+###############################################################################
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+############## Asynchronous Successive Halving over Boosting Rounds ###########
+###############################################################################
+# New configurations from TPE start with min_rounds boosting rounds. When a
+# worker frees up, the best 1/reduction_factor of the configurations that
+# finished a rung and were not promoted yet continue to the next rung with
+# reduction_factor times more rounds, otherwise a new configuration starts.
+# Promoted configurations continue boosting from their saved fold models
+# instead of training again from the first round
+import os
+import shutil
+import tempfile
+from concurrent.futures import wait, FIRST_COMPLETED
+import numpy as np
+from hyperopt import tpe, Trials, STATUS_FAIL
+from hyperopt.base import Domain
+from joblib.externals.loky import get_reusable_executor
+from parallelTrials import _init_worker, suggest_trial, complete_trial
+from threadBudget import ThreadBudget
+
+
+def rung_rounds(min_rounds, max_rounds, reduction_factor=3):
+    """Returns the boosting rounds of each rung."""
+    rounds = [min_rounds]
+    while rounds[-1] * reduction_factor <= max_rounds:
+        rounds.append(rounds[-1] * reduction_factor)
+    return rounds
+
+
+class ASHAScheduler:
+    """Tracks the loss of each trial on each rung and picks promotions."""
+
+    def __init__(self, rounds, reduction_factor=3):
+        self.rounds = rounds
+        self.reduction_factor = reduction_factor
+        self.rungs = [{} for _ in rounds]
+        self.promoted = [set() for _ in rounds]
+
+    def report(self, tid, rung, loss):
+        self.rungs[rung][tid] = loss
+
+    def next_promotion(self):
+        """Returns (tid, rung) of the next promotion, starting from the top rung."""
+        for k in reversed(range(len(self.rounds) - 1)):
+            done = self.rungs[k]
+            n_top = len(done) // self.reduction_factor
+            for tid in sorted(done, key=done.get)[:n_top]:
+                if tid not in self.promoted[k]:
+                    self.promoted[k].add(tid)
+                    return tid, k + 1
+        return None
+
+
+def asha_fmin(objective, space, max_evals, trials=None, algo=tpe.suggest,
+              rstate=None, min_rounds=10, max_rounds=810, reduction_factor=3,
+              n_workers=None, threads_per_worker=4, model_dir=None,
+              out_file=None, out_columns=('loss', 'params', 'iteration',
+                                          'estimators', 'train_time'),
+              store=None):
+    """Minimizes a CVObjective over space with ASHA over boosting rounds.
+
+    max_evals is the number of configurations sampled. The result of a
+    trial is the one from the highest rung it reached, with the rounds in
+    'estimators'. Fold models are kept in model_dir until the search ends.
+    Returns the result of the best trial on the highest rung reached, since
+    losses after fewer rounds are not comparable.
+    """
+    if trials is None:
+        trials = Trials()
+    if rstate is None:
+        rstate = np.random.default_rng()
+    budget = ThreadBudget(search=n_workers, estimator=threads_per_worker)
+    budget.log()
+    n_workers = budget.search
+    if store is not None:
+        store.reset()
+    remove_models = model_dir is None
+    if model_dir is None:
+        model_dir = tempfile.mkdtemp(prefix='asha_')
+    os.makedirs(model_dir, exist_ok=True)
+
+    rounds = rung_rounds(min_rounds, max_rounds, reduction_factor)
+    scheduler = ASHAScheduler(rounds, reduction_factor)
+    domain = Domain(objective, space)
+    executor = get_reusable_executor(max_workers=n_workers,
+                                     initializer=_init_worker,
+                                     initargs=(threads_per_worker,))
+
+    docs, configs, running = {}, {}, {}
+    n_submitted = len(trials.trials)
+    while True:
+        while len(running) < n_workers:
+            promotion = scheduler.next_promotion()
+            if promotion is not None:
+                tid, rung = promotion
+                prev_rounds = rounds[rung - 1]
+            elif n_submitted < max_evals:
+                doc, config = suggest_trial(domain, trials, algo, rstate)
+                tid, rung, prev_rounds = doc['tid'], 0, 0
+                docs[tid], configs[tid] = doc, config
+                n_submitted += 1
+            else:
+                break
+            model_prefix = os.path.join(model_dir, 'trial_%d' % tid)
+            future = executor.submit(objective.run_rounds, configs[tid],
+                                     rounds[rung], model_prefix, prev_rounds)
+            running[future] = (tid, rung)
+
+        if not running:
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            tid, rung = running.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'status': STATUS_FAIL, 'error': repr(e)}
+            result['iteration'] = tid + 1
+            result['rung'] = rung
+
+            # TPE and the store see the result from the highest rung reached
+            complete_trial(trials, docs[tid], result)
+            if result['status'] != STATUS_FAIL:
+                scheduler.report(tid, rung, result['loss'])
+            if store is not None:
+                store.add(result)
+
+    if remove_models:
+        shutil.rmtree(model_dir, ignore_errors=True)
+    if store is not None:
+        store.flush()
+        if out_file is not None:
+            store.export_csv(out_file, out_columns)
+
+    print('ASHA trials per rung: '
+          + ', '.join('%d rounds: %d' % (r, len(t))
+                      for r, t in zip(rounds, scheduler.rungs)))
+
+    top = [rung for rung in scheduler.rungs if rung]
+    if not top:
+        raise RuntimeError('Every ASHA trial failed')
+    best_tid = min(top[-1], key=top[-1].get)
+    return docs[best_tid]['result']
+
+###############################################################################
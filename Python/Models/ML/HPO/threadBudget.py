@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+###################### Thread Budget for Nested Parallelism ###################
+###############################################################################
+# The cores are split between the layers of parallelism of a run: the search
+# (candidates or trials run at once), the folds of each candidate, the
+# threads of each estimator and the BLAS threads of each of those. The
+# product of the layers is kept within the cores, so a grid search of
+# multi-threaded forests does not start a thread per core in every candidate.
+# The budget sets the joblib backend, the BLAS/OpenMP variables read by child
+# processes and the threadpool limits of the running process, and prints the
+# layout it applied
+import os
+from joblib import parallel_backend
+
+LAYERS = ['search', 'fold', 'estimator', 'blas']
+
+
+class ThreadBudget:
+    """Share of the cores given to each layer of parallelism.
+
+    Layers left as None share the cores that remain after the given ones,
+    the search layer first since the outermost layer scales best.
+    """
+
+    def __init__(self, search=None, fold=1, estimator=None, blas=1,
+                 n_cores=None):
+        self.n_cores = n_cores or os.cpu_count()
+        fixed = 1
+        for n in [search, fold, estimator, blas]:
+            if n is not None:
+                fixed *= n
+        free = max(1, self.n_cores // fixed)
+
+        if search is None:
+            search, free = free, 1
+        if estimator is None:
+            estimator = free
+        self.search = search
+        self.fold = fold
+        self.estimator = estimator
+        self.blas = blas
+        self._limits = None
+
+    @property
+    def n_threads(self):
+        """Returns the number of threads running at once under the budget."""
+        return self.search * self.fold * self.estimator * self.blas
+
+    def layout(self):
+        """Returns the split of the cores as text."""
+        text = '%d cores: %s = %d threads' % (
+            self.n_cores,
+            ' x '.join('%s %d' % (layer, getattr(self, layer))
+                       for layer in LAYERS),
+            self.n_threads)
+        if self.n_threads > self.n_cores:
+            text += ' (oversubscribed)'
+        return text
+
+    def log(self):
+        print('Thread budget - ' + self.layout())
+
+    def apply(self):
+        """Limits the BLAS and OpenMP threads of this and child processes and logs the layout."""
+        os.environ['OMP_NUM_THREADS'] = str(self.estimator * self.blas)
+        for var in ['MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            os.environ[var] = str(self.blas)
+        from threadpoolctl import threadpool_limits
+        self._limits = threadpool_limits(limits=self.blas, user_api='blas')
+        self.log()
+        return self
+
+    def restore(self):
+        """Restores the threadpool limits from before apply."""
+        if self._limits is not None:
+            self._limits.restore_original_limits()
+            self._limits = None
+
+    def backend(self, backend='threading'):
+        """Returns the joblib backend running the search and fold layers.
+
+        Estimators inside take their threads from n_jobs=estimator, and the
+        workers of a process backend are limited to blas BLAS threads.
+        """
+        if backend == 'threading':
+            return parallel_backend(backend, n_jobs=self.search * self.fold)
+        return parallel_backend(backend, n_jobs=self.search * self.fold,
+                                inner_max_num_threads=self.blas)
+
+###############################################################################
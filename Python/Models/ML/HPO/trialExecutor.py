@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+##################### Worker Pool with Killable Trials ########################
+###############################################################################
+# Every worker is a loky executor with a single process, so a trial that runs
+# past its time limit is stopped by killing its own worker while the other
+# workers keep running their trials. The slot of a killed worker starts a new
+# process with the next trial it is given
+import threading
+from joblib.externals.loky import ProcessPoolExecutor
+
+
+class KillablePool:
+    """Process pool whose trials can be killed one worker at a time."""
+
+    def __init__(self, max_workers, initializer=None, initargs=()):
+        self.max_workers = max_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self._executors = [None] * max_workers
+        self._futures = [[] for _ in range(max_workers)]
+        # Studies of the driver submit from their own threads
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Runs fn on an idle worker, or queues it on the least busy one."""
+        with self._lock:
+            for futures in self._futures:
+                futures[:] = [f for f in futures if not f.done()]
+            slot = min(range(self.max_workers),
+                       key=lambda k: len(self._futures[k]))
+            if self._executors[slot] is None:
+                self._executors[slot] = ProcessPoolExecutor(
+                    max_workers=1, initializer=self.initializer,
+                    initargs=self.initargs)
+            future = self._executors[slot].submit(fn, *args, **kwargs)
+            self._futures[slot].append(future)
+        return future
+
+    def kill(self, future):
+        """Kills the worker running future and frees its slot."""
+        with self._lock:
+            for slot, futures in enumerate(self._futures):
+                if any(f is future for f in futures):
+                    self._executors[slot].shutdown(wait=False,
+                                                   kill_workers=True)
+                    self._executors[slot] = None
+                    self._futures[slot] = []
+                    return
+
+    def shutdown(self, wait=True, kill_workers=False):
+        """Shuts down the worker processes."""
+        with self._lock:
+            for executor in self._executors:
+                if executor is not None:
+                    executor.shutdown(wait=wait, kill_workers=kill_workers)
+            self._executors = [None] * self.max_workers
+            self._futures = [[] for _ in range(self.max_workers)]
+
+###############################################################################
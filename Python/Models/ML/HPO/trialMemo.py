@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+####################### Memo of HPO Trial Results #############################
+###############################################################################
+# TPE often suggests a configuration that was already evaluated, since most
+# of the search spaces are hp.choice over integer ranges. The result of every
+# completed trial is saved in a SQLite database under the hash of the model
+# family, data fingerprint, fold scheme, metric and cleaned parameters, so a
+# repeated configuration in the same or any later study returns the saved
+# loss instead of being trained again. Pruned and timed out trials are not
+# saved since their result depends on the other trials
+import os
+import json
+import sqlite3
+from hyperopt import STATUS_OK
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS memo (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL
+);
+"""
+
+
+class TrialMemo:
+    """Results of completed trials keyed by the memo_key of their objective."""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._conn = None
+        self.hits = 0
+
+    @property
+    def conn(self):
+        """Opens the database on first use in WAL mode."""
+        if self._conn is None:
+            db_dir = os.path.dirname(self.db_file)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def get(self, key):
+        """Returns a copy of the saved result of key marked as memo_hit, or None."""
+        row = self.conn.execute('SELECT result FROM memo WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        self.hits += 1
+        result = json.loads(row[0])
+        # The saved trial already paid for the training
+        result.update(memo_hit=True, cpu_time=0.0)
+        return result
+
+    def put(self, key, result):
+        """Saves a completed trial that was neither pruned nor timed out."""
+        if (result.get('status') != STATUS_OK or result.get('pruned')
+                or result.get('timed_out') or result.get('memo_hit')):
+            return
+        # Fold models are deleted once a better trial completes
+        result = {k: v for k, v in result.items()
+                  if k not in ('iteration', 'fold_models')}
+        with self.conn:
+            self.conn.execute('INSERT OR IGNORE INTO memo VALUES (?,?)',
+                              (key, json.dumps(result, default=_value)))
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        # The connection stays in the process that opened it
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+
+def _value(value):
+    """Converts numpy scalars and arrays to json types."""
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+###############################################################################
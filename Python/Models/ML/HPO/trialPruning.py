@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+###################### Fold-Level Pruning of HPO Trials #######################
+###############################################################################
+# Before a trial is sent to a worker, the running mean AUC after each fold is
+# collected from the completed trials and the given percentile is taken as
+# the threshold for that fold. The objective evaluates the folds one at a
+# time and stops a trial as soon as its running mean falls below the
+# threshold. Pruned trials keep the loss of the folds they completed, so TPE
+# still learns that the region is poor
+import numpy as np
+
+
+class FoldPruner:
+    """Percentile rule over the running fold scores of completed trials."""
+
+    def __init__(self, percentile=50, n_startup_trials=5, n_warmup_folds=0):
+        self.percentile = percentile
+        self.n_startup_trials = n_startup_trials
+        self.n_warmup_folds = n_warmup_folds
+
+    def thresholds(self, results):
+        """Returns the minimum running mean AUC after each fold, or None.
+
+        Only trials that ran every fold are used, so the rule is not biased
+        by the optimistic partial scores of pruned trials.
+        """
+        scores = [r['fold_scores'] for r in results
+                  if r.get('fold_scores') and not r.get('pruned')]
+        if len(scores) < self.n_startup_trials:
+            return None
+
+        n_folds = min(len(s) for s in scores)
+        scores = np.array([s[:n_folds] for s in scores])
+        running_mean = np.cumsum(scores, axis=1) / np.arange(1, n_folds + 1)
+        thresholds = np.percentile(running_mean, self.percentile, axis=0)
+
+        # Never prune during the warmup folds
+        thresholds[:self.n_warmup_folds] = -np.inf
+        return thresholds
+
+###############################################################################
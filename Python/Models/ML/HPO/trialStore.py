@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+########################## SQLite Store for HPO Trials ########################
+###############################################################################
+# Trial results are buffered and written in batches to a SQLite database in
+# WAL mode, so several studies can write to the same file at once. The loss,
+# timings and memory are columns of the trials table, while each
+# hyperparameter and fold score is its own typed row that is pivoted back to
+# columns for analysis. The csv layout used in trialOptions is exported from
+# the store at the end of a study
+import os
+import csv
+import json
+import sqlite3
+import pandas as pd
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trials (
+    study TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    status TEXT,
+    loss REAL,
+    train_time REAL,
+    cpu_time REAL,
+    peak_rss REAL,
+    estimators INTEGER,
+    rows INTEGER,
+    params TEXT,
+    PRIMARY KEY (study, iteration)
+);
+CREATE TABLE IF NOT EXISTS trial_params (
+    study TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (study, iteration, name)
+);
+CREATE TABLE IF NOT EXISTS trial_folds (
+    study TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    fold INTEGER NOT NULL,
+    score REAL,
+    PRIMARY KEY (study, iteration, fold)
+);
+"""
+
+_TRIAL_COLUMNS = ['status', 'loss', 'train_time', 'cpu_time', 'peak_rss',
+                  'estimators', 'rows']
+
+
+class TrialStore:
+    """Buffered store of the trials of one HPO study."""
+
+    def __init__(self, db_file, study_name, buffer_size=25):
+        self.db_file = db_file
+        self.study_name = study_name
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._conn = None
+
+    @property
+    def conn(self):
+        """Opens the database on first use in WAL mode."""
+        if self._conn is None:
+            db_dir = os.path.dirname(self.db_file)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._conn = sqlite3.connect(self.db_file, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+        return self._conn
+
+    def add(self, result):
+        """Buffers the result of a trial, writing when the buffer is full."""
+        self._buffer.append(result)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered trials in one transaction."""
+        if not self._buffer:
+            return
+
+        trials, params, folds = [], [], []
+        for result in self._buffer:
+            it = int(result['iteration'])
+            row = [_value(result.get(c)) for c in _TRIAL_COLUMNS]
+            if result.get('pruned'):
+                row[0] = 'pruned'
+            elif result.get('timed_out'):
+                row[0] = 'timeout'
+            trials.append([self.study_name, it] + row
+                          + [json.dumps(result.get('params', {}),
+                                        default=_value)])
+            params += [(self.study_name, it, k, _value(v))
+                       for k, v in result.get('params', {}).items()]
+            folds += [(self.study_name, it, i, float(s))
+                      for i, s in enumerate(result.get('fold_scores') or [])]
+
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO trials VALUES (?,?,?,?,?,?,?,?,?,?)',
+                trials)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO trial_params VALUES (?,?,?,?)', params)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO trial_folds VALUES (?,?,?,?)', folds)
+        self._buffer = []
+
+    def reset(self):
+        """Deletes the stored trials of the study."""
+        self._buffer = []
+        with self.conn:
+            for table in ['trials', 'trial_params', 'trial_folds']:
+                self.conn.execute('DELETE FROM %s WHERE study = ?' % table,
+                                  (self.study_name,))
+
+    def to_frame(self):
+        """Returns one row per trial with a column for each hyperparameter and fold score."""
+        self.flush()
+        query = 'SELECT * FROM %s WHERE study = ?'
+        trials = pd.read_sql_query(query % 'trials', self.conn,
+                                   params=(self.study_name,))
+        trials = trials.drop(columns=['study', 'params']).set_index('iteration')
+
+        params = pd.read_sql_query(query % 'trial_params', self.conn,
+                                   params=(self.study_name,))
+        if len(params):
+            params = params.pivot(index='iteration', columns='name',
+                                  values='value')
+            trials = trials.join(params)
+
+        folds = pd.read_sql_query(query % 'trial_folds', self.conn,
+                                  params=(self.study_name,))
+        if len(folds):
+            folds = folds.pivot(index='iteration', columns='fold',
+                                values='score')
+            folds.columns = ['fold_%d' % (c + 1) for c in folds.columns]
+            trials = trials.join(folds)
+
+        return trials.reset_index().sort_values('iteration')
+
+    def export_csv(self, out_file, columns=('loss', 'params', 'iteration',
+                                            'train_time')):
+        """Writes the trials in the trialOptions csv layout.
+
+        Pruned trials stay in the database only, so the lowest loss in the
+        csv is from a trial scored on every fold.
+        """
+        self.flush()
+        rows = self.conn.execute(
+            "SELECT * FROM trials WHERE study = ? AND status IS NOT 'pruned' "
+            'ORDER BY iteration', (self.study_name,))
+        names = [d[0] for d in rows.description]
+
+        with open(out_file, 'w', newline='') as of_connection:
+            writer = csv.writer(of_connection)
+            writer.writerow(columns)
+            for row in rows:
+                row = dict(zip(names, row))
+                # Params as the dict string read back with ast.literal_eval
+                row['params'] = str(json.loads(row['params']))
+                writer.writerow([row.get(c) for c in columns])
+
+    def close(self):
+        """Flushes the buffer and closes the database."""
+        if self._conn is not None:
+            self.flush()
+            self._conn.close()
+            self._conn = None
+
+    def __getstate__(self):
+        # The connection stays in the process that opened it
+        self.flush()
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+
+def _value(value):
+    """Converts numpy scalars to the python types SQLite stores."""
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+###############################################################################
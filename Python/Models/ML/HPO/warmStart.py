@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################ Warm Start HPO Studies from Trial Archives ###################
+###############################################################################
+# Completed trials in the trialOptions archives of a model family are mapped
+# into the current search space and added to a new hyperopt Trials or Optuna
+# study as prior observations, so TPE does not start from random points.
+# Archived params outside the current space are skipped. Trials from another
+# dataset variant can be down-weighted by keeping only a random fraction.
+# The first CatBoost and XGBoost studies minimized 1 - lowest fold AUC, while
+# the current objective minimizes 1 - mean fold AUC, so their losses are
+# higher than the current ones by the spread of the fold AUCs. Where the trial
+# store has the fold scores of an archive, its losses are recomputed from
+# them, and the remaining old losses are lowered by the median spread
+import ast
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from hyperopt import STATUS_OK, JOB_STATE_DONE
+from hyperopt.base import Domain
+from hyperopt.pyll import Literal
+
+# Columns of the Optuna trial csv that are not hyperparameters
+_OPTUNA_COLUMNS = ['iteration', 'datetime_start', 'datetime_complete',
+                   'duration', 'state']
+
+
+def load_hyperopt_archive(filename, family, store=None):
+    """Returns the params and loss of each trial in a hyperopt trial csv.
+
+    The old CatBoost and XGBoost archives were written with a loss of 1 plus
+    the lowest fold AUC. With the TrialStore of an archived study with the
+    auc metric, the loss of each trial with fold scores is 1 - mean fold AUC,
+    and the old losses of the other trials are mapped to 1 - lowest fold AUC
+    less the median gap between the mean and lowest fold AUC of the store.
+    """
+    archive = pd.read_csv(filename)
+    params = [ast.literal_eval(p) for p in archive['params']]
+    loss = archive['loss'].values.astype(np.float64)
+    old = np.zeros(len(loss), dtype=bool)
+    if family in ('catboost', 'xgboost'):
+        old = loss > 1
+        loss = np.where(old, 2 - loss, loss)
+
+    if store is not None:
+        trials = store.to_frame()
+        trials = trials[trials['status'] != 'pruned']
+        fold_columns = [c for c in trials if str(c).startswith('fold_')]
+        if fold_columns and 'iteration' in archive:
+            folds = trials.set_index('iteration')[fold_columns]
+            mean_auc = folds.mean(axis=1)
+            gap = np.nanmedian(mean_auc - folds.min(axis=1))
+            archived = archive['iteration'].map(mean_auc).values
+            has_folds = ~np.isnan(archived)
+            loss = np.where(has_folds, 1 - archived, loss)
+            loss = np.where(old & ~has_folds, loss - gap, loss)
+            return params, loss
+
+    if old.any():
+        print('Warm start: %d archived losses are 1 - lowest fold AUC, '
+              'above the current 1 - mean fold AUC' % old.sum())
+    return params, loss
+
+
+def load_optuna_archive(filename, value_column, direction='maximize'):
+    """Returns the params and loss of each completed trial in an Optuna trial csv."""
+    archive = pd.read_csv(filename)
+    if 'state' in archive:
+        archive = archive[archive['state'] == 'COMPLETE']
+    columns = [c for c in archive.columns
+               if c not in _OPTUNA_COLUMNS + [value_column]]
+    params = archive[columns].to_dict('records')
+    value = archive[value_column].values.astype(np.float64)
+    loss = -value if direction == 'maximize' else value
+    return params, loss
+
+
+def raw_config(family, params):
+    """Returns the config as sampled from the space, inverting clean_config."""
+    config = dict(params)
+    if family == 'catboost':
+        config['depth'] = int(config['depth']) - 3
+    elif family == 'xgboost':
+        config['max_depth'] = int(config['max_depth']) - 3
+    elif family == 'lightgbm':
+        config['boosting_type'] = {'boosting_type': config['boosting_type'],
+                                   'subsample': config.pop('subsample', 1.0)}
+    return config
+
+
+def _same(a, b):
+    """Compares literal values, numbers with a tolerance."""
+    if isinstance(a, (int, float, np.number)) and isinstance(b, (int, float,
+                                                                 np.number)):
+        return bool(np.isclose(float(a), float(b)))
+    return a == b
+
+
+def _matches(option, value):
+    """Returns whether a choice option can produce value."""
+    if isinstance(option, Literal):
+        return _same(option.obj, value)
+    if option.name == 'dict' and isinstance(value, dict):
+        return all(_same(node.obj, value.get(key))
+                   for key, node in option.named_args
+                   if isinstance(node, Literal))
+    return True
+
+
+def _in_range(dist, value):
+    """Returns whether value lies inside the bounds of a hyperopt distribution."""
+    if dist.name in ('uniform', 'quniform'):
+        low, high = dist.pos_args[0].obj, dist.pos_args[1].obj
+    elif dist.name in ('loguniform', 'qloguniform'):
+        low, high = np.exp(dist.pos_args[0].obj), np.exp(dist.pos_args[1].obj)
+    else:
+        return True
+    return low - 1e-12 <= value <= high + 1e-12
+
+
+def encode_config(space_node, value, vals):
+    """Fills vals with the hyperopt encoding of value, returning False when it is outside the space."""
+    if isinstance(space_node, Literal):
+        return True
+    if space_node.name == 'dict':
+        return all(encode_config(node, value[key], vals)
+                   for key, node in space_node.named_args if key in value)
+    if space_node.name == 'switch':
+        label = space_node.pos_args[0].pos_args[0].obj
+        options = space_node.pos_args[1:]
+        for i, option in enumerate(options):
+            if _matches(option, value):
+                vals[label] = [i]
+                return encode_config(option, value, vals)
+        return False
+    if space_node.name == 'hyperopt_param':
+        if not _in_range(space_node.pos_args[1], value):
+            return False
+        vals[space_node.pos_args[0].obj] = [value]
+        return True
+    return all(encode_config(arg, value, vals) for arg in space_node.pos_args)
+
+
+def _keep(n, weight, rstate=None):
+    """Returns the archived trials kept, a random fraction weight of them."""
+    if weight >= 1:
+        return np.arange(n)
+    rng = rstate if rstate is not None else np.random.default_rng()
+    return np.sort(rng.choice(n, int(round(weight * n)), replace=False))
+
+
+def warm_start(trials, space, params, loss, family=None, weight=1.0,
+               rstate=None):
+    """Adds archived trials to a hyperopt Trials and returns how many were added.
+
+    params are the cleaned params of the archive and loss their loss. With
+    weight below 1, only that random fraction of the archive is added. The
+    added trials have no iteration, so they are not written to the trial
+    store, and max_evals has to include them. Their results are marked
+    warm_start and carry the cleaned params.
+    """
+    domain = Domain(lambda config: None, space)
+    labels = list(domain.params)
+    keep = _keep(len(params), weight, rstate)
+
+    points = []
+    for i in keep:
+        vals = {}
+        config = raw_config(family, params[i]) if family else params[i]
+        if encode_config(domain.expr, config, vals) and np.isfinite(loss[i]):
+            points.append((vals, float(loss[i]), params[i]))
+
+    tids = trials.new_trial_ids(len(points))
+    docs = []
+    for tid, (vals, point_loss, point_params) in zip(tids, points):
+        misc = {'tid': tid, 'cmd': domain.cmd, 'workdir': None,
+                'idxs': {l: [tid] if l in vals else [] for l in labels},
+                'vals': {l: vals.get(l, []) for l in labels}}
+        result = {'status': STATUS_OK, 'loss': point_loss,
+                  'params': point_params, 'warm_start': True}
+        doc, = trials.new_trial_docs([tid], [None], [result], [misc])
+        doc['state'] = JOB_STATE_DONE
+        doc['refresh_time'] = datetime.now()
+        docs.append(doc)
+    trials.insert_trial_docs(docs)
+    trials.refresh()
+
+    print('Warm start: added %d of %d archived trials'
+          % (len(points), len(params)))
+    return len(points)
+
+
+def warm_start_optuna(study, distributions, params, loss, weight=1.0,
+                      rstate=None):
+    """Adds archived trials to an Optuna study and returns how many were added.
+
+    distributions maps each hyperparameter to its Optuna distribution, and
+    archived params outside them are skipped.
+    """
+    import optuna
+    keep = _keep(len(params), weight, rstate)
+
+    sign = -1 if study.direction == optuna.study.StudyDirection.MAXIMIZE else 1
+    trials = []
+    for i in keep:
+        try:
+            point = {k: d.to_external_repr(d.to_internal_repr(params[i][k]))
+                     for k, d in distributions.items()}
+            trials.append(optuna.trial.create_trial(
+                params=point, distributions=distributions,
+                value=sign * loss[i]))
+        except (KeyError, ValueError):
+            # Missing or outside the current distributions
+            continue
+    study.add_trials(trials)
+
+    print('Warm start: added %d of %d archived trials'
+          % (len(trials), len(params)))
+    return len(trials)
+
+###############################################################################
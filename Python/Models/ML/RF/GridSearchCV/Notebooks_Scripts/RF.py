@@ -8,12 +8,12 @@
 ################################ Random Forest ################################
 ###############################################################################
 import os
+import sys
 import random
 import numpy as np
 import warnings
 import pandas as pd
 from sklearn.ensemble import RandomForestClassifier
-from joblib import parallel_backend
 from sklearn.model_selection import GridSearchCV
 import time
 from sklearn.metrics import f1_score, accuracy_score, recall_score, precision_score
@@ -23,6 +23,9 @@ from eli5.sklearn import PermutationImportance
 import webbrowser
 from eli5.formatters import format_as_dataframe
 from lime import lime_tabular
+sys.path.insert(0, r'D:\LoanStatus\Python\Models\ML\HPO')
+from threadBudget import ThreadBudget
+from forestSearch import ForestHalvingSearch, oob_cv_agreement
 warnings.filterwarnings('ignore')
 
 # Set seed 
@@ -31,6 +34,12 @@ os.environ['LoanStatus_RF'] = str(seed_value)
 random.seed(seed_value)
 np.random.seed(seed_value)
 
+# Single fits give every core to the trees, while the grid search runs the
+# candidates and folds in parallel with a few tree threads each so the
+# nested joblib calls do not each start a thread per core
+fit_budget = ThreadBudget(search=1).apply()
+search_budget = ThreadBudget(estimator=4)
+
 # Set path
 path = r'D:\LoanStatus\Data'
 os.chdir(path)
@@ -59,11 +68,12 @@ del train_US, test_US, train_SMOTE, test_SMOTE
 ##############################  Baseline  #####################################
 ###############################################################################
 # Set baseline model for Upsampling
-rf = RandomForestClassifier(random_state=seed_value, n_jobs=-1)
+rf = RandomForestClassifier(random_state=seed_value,
+                            n_jobs=fit_budget.estimator)
 print('Baseline parameters for RF', rf.get_params()) 
 
 # Fit model to the data
-with parallel_backend('threading', n_jobs=-1):
+with fit_budget.backend():
     rf.fit(X_train, y_train)
 
 # Set path for ML results
@@ -102,7 +112,7 @@ print('F1 score : %.3f' % f1_score(y_test, y_pred_US))
 ###############################################################################
 # Set baseline model for SMOTE
 # Fit the model to the data
-with parallel_backend('threading', n_jobs=-1):
+with fit_budget.backend():
     rf.fit(X1_train, y1_train)
     
 # Save model
@@ -141,17 +151,44 @@ param_grid = {
     'min_samples_split': [2, 5, 10]
 }
 
+# Search mode, where halving fits each configuration once per fold for all
+# n_estimators and keeps the best third on more rows each rung, while grid
+# is the full grid search
+SEARCH_MODE = 'halving'
+
+# Halving scores configurations on the out-of-bag rows of one fit with oob,
+# or with 3-fold cv
+EVAL_MODE = 'oob'
+
 # Create a grid search based model
-grid_search = GridSearchCV(estimator=rf, 
-                           param_grid=param_grid, 
-                           verbose=1, 
-                           cv=3,  
-                           n_jobs=-1)
+if SEARCH_MODE == 'halving':
+    grid_search = ForestHalvingSearch(param_grid=param_grid,
+                                      cv='oob' if EVAL_MODE == 'oob' else 3,
+                                      factor=3,
+                                      random_state=seed_value,
+                                      budget=search_budget)
+else:
+    grid_search = GridSearchCV(estimator=RandomForestClassifier(
+                                   random_state=seed_value,
+                                   n_jobs=search_budget.estimator),
+                               param_grid=param_grid, 
+                               verbose=1, 
+                               cv=3,  
+                               n_jobs=search_budget.search * search_budget.fold)
+
+# Agreement of the out-of-bag and cv ranking on a sample of the grid
+if SEARCH_MODE == 'halving' and EVAL_MODE == 'oob':
+    oob_agreement, oob_rho = oob_cv_agreement(param_grid, X_train, y_train,
+                                              n_configs=12, cv=3,
+                                              n_rows=50000,
+                                              random_state=seed_value,
+                                              budget=search_budget)
 
 # Fit the grid search to the data
 print('Start Upsampling - Grid Search..')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
+search_budget.log()
+with search_budget.backend():
     grid_search.fit(X_train, y_train)
 print('Finished Upsampling - Grid Search :', time.time() - search_time_start)
 print('======================================================================')
@@ -160,12 +197,13 @@ print('Upsampling RF HPO - best parameters')
 print(grid_search.best_params_)
 
 # Use best model from grid search to see feature importance
-rf_US_HPO = grid_search.best_estimator_
+rf_US_HPO = grid_search.best_estimator_.set_params(
+    n_jobs=fit_budget.estimator)
 
 # Fit the results from grid search to the data
 print('Start fit the best hyperparameters from Upsampling grid search to the data..')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
+with fit_budget.backend():
     rf_US_HPO.fit(X_train, y_train)
 print('Finished fit the best hyperparameters from Upsampling grid search to the data:',
       time.time() - search_time_start)
@@ -274,7 +312,7 @@ exp.save_to_file('RF_US_HPO_LIME.html')
 # Use best model from grid search to compare with SMOTE
 print('Start Fit best model using gridsearch results on Upsamplimg to SMOTE data..')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
+with fit_budget.backend():
     rf_US_HPO.fit(X1_train, y1_train)
 print('Finished Fit best model using gridsearch results on Upsamplimg to SMOTE data :',
       time.time() - search_time_start)
@@ -385,7 +423,8 @@ exp.save_to_file('RF_US_HPO_SMOTE_LIME.html')
 # Fit the grid search to the data
 print('Start SMOTE - Grid Search..')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
+search_budget.log()
+with search_budget.backend():
     grid_search.fit(X1_train, y1_train)
 print('Finished SMOTE - Grid Search :', time.time() - search_time_start)
 print('======================================================================')
@@ -394,12 +433,13 @@ print('SMOTE RF HPO - best parameters')
 print(grid_search.best_params_)
 
 # SMOTEe best model from grid search to see feature importance
-rf_SMOTE_HPO = grid_search.best_estimator_
+rf_SMOTE_HPO = grid_search.best_estimator_.set_params(
+    n_jobs=fit_budget.estimator)
 
 # Fit the results from grid search to the data
 print('Start fit the best hyperparameters from SMOTE grid search to the data..')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
+with fit_budget.backend():
     rf_SMOTE_HPO.fit(X1_train, y1_train)
 print('Finished fit the best hyperparameters from SMOTE grid search to the data:',
       time.time() - search_time_start)
@@ -446,7 +486,7 @@ df_rf.to_csv('SMOTE_rf_gridsearchBest_featureimportance.csv', index=False)
 # Use best model from grid search to compare with US
 print('Start fit best model using gridsearch results on SMOTE to Upsamplimg data..')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
+with fit_budget.backend():
     rf_SMOTE_HPO.fit(X_train, y_train)
 print('Finished fit best model using gridsearch results on SMOTE to Upsamplimg data :',
       time.time() - search_time_start)
@@ -7,16 +7,15 @@
 #####################       XGBoost Methods      ##############################
 ###############################################################################
 import os
+import sys
 import random
 import numpy as np
 import warnings
 import pandas as pd
-from sklearn.model_selection import cross_val_score, KFold
+from sklearn.model_selection import KFold
 from xgboost import XGBClassifier
-from hyperopt import fmin, hp, tpe, Trials, STATUS_OK
-import csv
+from hyperopt import hp, tpe, Trials
 from datetime import datetime, timedelta
-from timeit import default_timer as timer
 import ast
 import pickle
 from sklearn.metrics import f1_score, roc_auc_score, accuracy_score
@@ -29,6 +28,17 @@ from eli5.sklearn import PermutationImportance
 import webbrowser
 from eli5.formatters import format_as_dataframe
 from lime import lime_tabular
+sys.path.insert(0, r'D:\LoanStatus\Python\Models\ML\HPO')
+from hpoObjectives import SharedDataset, CVObjective, build_model
+from hpoObjectives import best_model
+from parallelTrials import parallel_fmin, completed_results
+from studyCheckpoint import StudyCheckpoint
+from trialStore import TrialStore
+from successiveHalving import asha_fmin
+from dataFidelity import fidelity_fmin
+from warmStart import warm_start, load_hyperopt_archive
+from spaceImportance import params_frame, param_importance
+from trialPruning import FoldPruner
 warnings.filterwarnings('ignore')
 
 path = r'D:\LoanStatus\Data'
@@ -160,6 +170,30 @@ NUM_EVAL = 100
 # Set same k-folds for reproducibility
 kfolds = KFold(n_splits=3, shuffle=True, random_state=seed_value)
 
+# Number of threads for each parallel HPO worker
+THREADS_PER_WORKER = 4
+
+# Wall-clock seconds and CPU hours of each study, where None is no limit
+TIME_BUDGET = None
+CPU_HOURS = None
+
+# Database of all trials, exported to the trial csv after each study
+TRIAL_DB = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\trialOptions\trials.db'
+
+# Checkpoints to resume interrupted studies
+STUDY_DIR = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\studies'
+
+# Average the fold models of the best trial ('folds'), refit it with a held
+# out early stopping set ('holdout') or on all training rows ('full')
+REFIT_MODE = 'folds'
+FOLD_MODEL_DIR = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\foldModels'
+
+# Training sets written once and memory-mapped by the HPO workers
+US_data = SharedDataset.create(X_train, y_train, r'D:\LoanStatus\Data\sharedData',
+                               'trainDF_US')
+SMOTE_data = SharedDataset.create(X1_train, y1_train, r'D:\LoanStatus\Data\sharedData',
+                                  'trainDF_SMOTE')
+
 # Define parameter grid
 xgb_tune_kwargs= {
     'n_estimators': hp.choice('n_estimators', np.arange(100, 500, dtype=int)),
@@ -175,77 +209,34 @@ xgb_tune_kwargs= {
                                                                  dtype=int)),
     }
 
-# Define a function for optimization of hyperparameters
-def xgb_upsampling(config):
-    """XGBoost HPO"""
-    
-    # Keep track of evaluations
-    global ITERATION
-    
-    ITERATION += 1  
-    
-    # Parameters that are integers to remain integers
-    config['n_estimators'] = int(config['n_estimators'])   
-    
-    # Start hyperopt at 3 for max_depth   
-    config['max_depth'] = int(config['max_depth']) + 3
-    
-    # Define model type
-    xgb = XGBClassifier( 
-        objective='binary:logistic',
-        booster='gbtree',   
-        scale_pos_weight=1,
-        use_label_encoder=False,
-        random_state=seed_value,
-        n_jobs=-1,
-        verbosity=0,
-        **config)
-    
-    # Start timer for each trial
-    start = timer()
-    
-    # Perform k_folds cross validation to find lower error
-    scores = -cross_val_score(xgb,X_train, y_train, 
-                              scoring='roc_auc', cv=kfolds)
-    run_time = timer() - start
-    
-    # Extract the best score
-    best_score = np.max(scores)
-    
-    # Loss must be minimized
-    loss = 1 - best_score
-
-    # Write to the csv file ('a' means append)
-    of_connection = open(out_file, 'a')
-    writer = csv.writer(of_connection)
-    writer.writerow([loss, config, ITERATION, run_time])
-    
-    return {'loss': loss, 'params': config, 'iteration': ITERATION, 
-            'train_time': run_time, 'status': STATUS_OK}    
+# Objective for optimization of hyperparameters, picklable so trials can
+# run in parallel worker processes
+xgb_upsampling = CVObjective('xgboost', US_data, kfolds,
+                             n_threads=THREADS_PER_WORKER, seed=seed_value,
+                             model_dir=FOLD_MODEL_DIR)
 
 # Optimization algorithm
 tpe_algorithm = tpe.suggest
 
 # File to save first results
 out_file = 'XGB_HPO_Upsampling_100.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'train_time'])
-of_connection.close()
 
-# Set global variable and HPO is run with fmin
-global  ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers and trials whose running fold
+# AUC is below the median of the completed trials are pruned
 bayesOpt_Upsampling_trials = Trials()
 
 # Start timer for experiment
 start_time = datetime.now()
 print('%-20s %s' % ('Start Time', start_time))
-best_param = fmin(xgb_upsampling, xgb_tune_kwargs, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
-                  rstate= np.random.RandomState(42))
+best_param = parallel_fmin(xgb_upsampling, xgb_tune_kwargs, algo=tpe.suggest,
+                           max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
+                           rstate= np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           pruner=FoldPruner(percentile=50))
 
 # End timer for experiment
 end_time = datetime.now()
@@ -254,7 +245,7 @@ print('%-20s %s' % ('End Time', end_time))
 print(str(timedelta(seconds=(end_time-start_time).seconds)))
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_Upsampling_trials_results = sorted(bayesOpt_Upsampling_trials.results,
+bayesOpt_Upsampling_trials_results = sorted(completed_results(bayesOpt_Upsampling_trials),
                                             key=lambda x: x['loss'])
 print('Upsampling HPO 100 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_Upsampling_trials_results[:2])
@@ -277,17 +268,22 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\Model_PKL'
 os.chdir(path)
                                       
-# Re-create the best model and train on the training data
-best_bayes_Upsampling_model = XGBClassifier(objective='binary:logistic', 
-                                            booster='gbtree', 
-                                            scale_pos_weight=1, 
-                                            use_label_encoder=False,                                        
-                                            random_state=seed_value, 
-                                            n_jobs=-1, 
-                                            verbosity=0, 
-                                            **best_bayes_params)
-# Fit the model
-best_bayes_Upsampling_model.fit(X_train, y_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_Upsampling_model = best_model(bayesOpt_Upsampling_trials, 'xgboost', best_bayes_params,
+                                             X_train, y_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Re-create the best model and train on the training data
+    best_bayes_Upsampling_model = XGBClassifier(objective='binary:logistic', 
+                                                booster='gbtree', 
+                                                scale_pos_weight=1, 
+                                                use_label_encoder=False,                                        
+                                                random_state=seed_value, 
+                                                n_jobs=-1, 
+                                                verbosity=0, 
+                                                **best_bayes_params)
+    # Fit the model
+    best_bayes_Upsampling_model.fit(X_train, y_train)
 
 # Save model
 Pkl_Filename = 'XGB_HPO_Upsampling_100.pkl'  
@@ -326,17 +322,16 @@ print('The best model from Upsampling Bayes 100 trials optimization scores {:.5f
                                                                                                                                  preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\bayesParams'
 os.chdir(path)
@@ -455,80 +450,42 @@ exp.save_to_file('best_bayes_Upsampling_100_LIME.html')
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\trialOptions'
 os.chdir(path)
 
-# Define a function for optimization of hyperparameters
-def xgb_smote(config):
-    """XGBoost HPO"""
-    
-    # Keep track of evaluations
-    global ITERATION
-    
-    ITERATION += 1  
-    
-    # Parameters that are integers to remain integers
-    config['n_estimators'] = int(config['n_estimators'])   
-    
-    # Start hyperopt at 3 for max_depth   
-    config['max_depth'] = int(config['max_depth']) + 3
-    
-    # Define model type
-    xgb = XGBClassifier( 
-        objective='binary:logistic',
-        booster='gbtree',   
-        scale_pos_weight=1,
-        use_label_encoder=False,
-        random_state=seed_value,
-        n_jobs=-1,
-        verbosity=0,
-        **config)
-    
-    # Start timer for each trial
-    start = timer()
-    
-    # Perform k_folds cross validation to find lower error
-    scores = -cross_val_score(xgb, 
-                              X1_train, 
-                              y1_train,
-                              scoring='roc_auc',
-                              cv=kfolds) 
-    run_time = timer() - start
-    
-    # Extract the best score
-    best_score = np.max(scores)
-    
-    # Loss must be minimized
-    loss = 1 - best_score
-
-    # Write to the csv file ('a' means append)
-    of_connection = open(out_file, 'a')
-    writer = csv.writer(of_connection)
-    writer.writerow([loss, config, ITERATION, run_time])
-    
-    return {'loss': loss, 'params': config, 'iteration': ITERATION, 
-            'train_time': run_time, 'status': STATUS_OK}    
+# Objective for optimization of hyperparameters, picklable so trials can
+# run in parallel worker processes
+xgb_smote = CVObjective('xgboost', SMOTE_data, kfolds,
+                        n_threads=THREADS_PER_WORKER, seed=seed_value,
+                        model_dir=FOLD_MODEL_DIR)
 
 # Optimization algorithm
 tpe_algorithm = tpe.suggest
 
 # File to save first results
 out_file = 'XGB_HPO_SMOTE_100.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'train_time'])
-of_connection.close()
 
-# Set global variable and HPO is run with fmin
-global  ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers and trials whose running fold
+# AUC is below the median of the completed trials are pruned
 bayesOpt_SMOTE_trials = Trials()
 
+# Warm start from the archived trials of the XGB_HPO_Upsampling_100 study,
+# down-weighted since it used the other dataset variant
+n_warm = warm_start(bayesOpt_SMOTE_trials, xgb_tune_kwargs,
+                    *load_hyperopt_archive('XGB_HPO_Upsampling_100.csv', 'xgboost',
+                                           TrialStore(TRIAL_DB, 'XGB_HPO_Upsampling_100')),
+                    family='xgboost', weight=0.5,
+                    rstate=np.random.default_rng(42))
+
 # Start timer for experiment
 start_time = datetime.now()
 print('%-20s %s' % ('Start Time', start_time))
-best_param = fmin(xgb_smote, xgb_tune_kwargs, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_SMOTE_trials,
-                  rstate= np.random.RandomState(42))
+best_param = parallel_fmin(xgb_smote, xgb_tune_kwargs, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_SMOTE_trials,
+                           rstate= np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           pruner=FoldPruner(percentile=50))
 
 # End timer for experiment
 end_time = datetime.now()
@@ -537,7 +494,7 @@ print('%-20s %s' % ('End Time', end_time))
 print(str(timedelta(seconds=(end_time-start_time).seconds)))
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_SMOTE_trials_results = sorted(bayesOpt_SMOTE_trials.results, 
+bayesOpt_SMOTE_trials_results = sorted(completed_results(bayesOpt_SMOTE_trials), 
                                        key=lambda x: x['loss'])
 print('SMOTE HPO 100 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_SMOTE_trials_results[:2])
@@ -560,18 +517,23 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\Model_PKL'
 os.chdir(path)
                                   
-# Re-create the best model and train on the training data
-best_bayes_SMOTE_model = XGBClassifier(objective='binary:logistic', 
-                                       booster='gbtree', 
-                                       scale_pos_weight=1, 
-                                       use_label_encoder=False,                                        
-                                       random_state=seed_value, 
-                                       n_jobs=-1, 
-                                       verbosity=0, 
-                                       **best_bayes_params)
-
-# Fit the model
-best_bayes_SMOTE_model.fit(X1_train, y1_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_SMOTE_model = best_model(bayesOpt_SMOTE_trials, 'xgboost', best_bayes_params,
+                                        X1_train, y1_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Re-create the best model and train on the training data
+    best_bayes_SMOTE_model = XGBClassifier(objective='binary:logistic', 
+                                           booster='gbtree', 
+                                           scale_pos_weight=1, 
+                                           use_label_encoder=False,                                        
+                                           random_state=seed_value, 
+                                           n_jobs=-1, 
+                                           verbosity=0, 
+                                           **best_bayes_params)
+
+    # Fit the model
+    best_bayes_SMOTE_model.fit(X1_train, y1_train)
 
 # Save model
 Pkl_Filename = 'XGB_HPO_SMOTE_100.pkl'  
@@ -610,17 +572,16 @@ print('The best model from SMOTE Bayes optimization 100 trials scores {:.5f} AUC
                                                                                                                             preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\bayesParams'
 os.chdir(path)
@@ -744,24 +705,30 @@ NUM_EVAL = 300
 
 # File to save first results
 out_file = 'XGB_HPO_Upsampling_300.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'train_time'])
-of_connection.close()
 
-# Set global variable and HPO is run with fmin
-global  ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers and trials whose running fold
+# AUC is below the median of the completed trials are pruned
 bayesOpt_Upsampling_trials = Trials()
 
+# Warm start from the archived trials of the XGB_HPO_Upsampling_100 study
+n_warm = warm_start(bayesOpt_Upsampling_trials, xgb_tune_kwargs,
+                    *load_hyperopt_archive('XGB_HPO_Upsampling_100.csv', 'xgboost',
+                                           TrialStore(TRIAL_DB, 'XGB_HPO_Upsampling_100')),
+                    family='xgboost', weight=1,
+                    rstate=np.random.default_rng(42))
+
 # Start timer for experiment
 start_time = datetime.now()
 print('%-20s %s' % ('Start Time', start_time))
-best_param = fmin(xgb_upsampling, xgb_tune_kwargs, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
-                  rstate= np.random.RandomState(42))
+best_param = parallel_fmin(xgb_upsampling, xgb_tune_kwargs, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_Upsampling_trials,
+                           rstate= np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           pruner=FoldPruner(percentile=50))
 
 # End timer for experiment
 end_time = datetime.now()
@@ -770,7 +737,7 @@ print('%-20s %s' % ('End Time', end_time))
 print(str(timedelta(seconds=(end_time-start_time).seconds)))
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_Upsampling_trials_results = sorted(bayesOpt_Upsampling_trials.results,
+bayesOpt_Upsampling_trials_results = sorted(completed_results(bayesOpt_Upsampling_trials),
                                             key=lambda x: x['loss'])
 print('Upsampling HPO 100 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_Upsampling_trials_results[:2])
@@ -793,18 +760,23 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\Model_PKL'
 os.chdir(path)
   
-# Re-create the best model and train on the training data
-best_bayes_Upsampling_model = XGBClassifier(objective='binary:logistic', 
-                                            booster='gbtree', 
-                                            scale_pos_weight=1, 
-                                            use_label_encoder=False,                                        
-                                            random_state=seed_value, 
-                                            n_jobs=-1, 
-                                            verbosity=0, 
-                                            **best_bayes_params)
-
-# Fit the model
-best_bayes_Upsampling_model.fit(X_train, y_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_Upsampling_model = best_model(bayesOpt_Upsampling_trials, 'xgboost', best_bayes_params,
+                                             X_train, y_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Re-create the best model and train on the training data
+    best_bayes_Upsampling_model = XGBClassifier(objective='binary:logistic', 
+                                                booster='gbtree', 
+                                                scale_pos_weight=1, 
+                                                use_label_encoder=False,                                        
+                                                random_state=seed_value, 
+                                                n_jobs=-1, 
+                                                verbosity=0, 
+                                                **best_bayes_params)
+
+    # Fit the model
+    best_bayes_Upsampling_model.fit(X_train, y_train)
 
 # Save model
 Pkl_Filename = 'XGB_HPO_Upsampling_300.pkl'  
@@ -843,17 +815,16 @@ print('The best model from Upsampling Bayes 300 trials optimization scores {:.5f
                                                                                                                                  preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\bayesParams'
 os.chdir(path)
@@ -972,24 +943,30 @@ os.chdir(path)
 
 # File to save first results
 out_file = 'XGB_HPO_SMOTE_300.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'train_time'])
-of_connection.close()
 
-# Set global variable and HPO is run with fmin
-global  ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers and trials whose running fold
+# AUC is below the median of the completed trials are pruned
 bayesOpt_SMOTE_trials = Trials()
 
+# Warm start from the archived trials of the XGB_HPO_SMOTE_100 study
+n_warm = warm_start(bayesOpt_SMOTE_trials, xgb_tune_kwargs,
+                    *load_hyperopt_archive('XGB_HPO_SMOTE_100.csv', 'xgboost',
+                                           TrialStore(TRIAL_DB, 'XGB_HPO_SMOTE_100')),
+                    family='xgboost', weight=1,
+                    rstate=np.random.default_rng(42))
+
 # Start timer for experiment
 start_time = datetime.now()
 print('%-20s %s' % ('Start Time', start_time))
-best_param = fmin(xgb_smote, xgb_tune_kwargs, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_SMOTE_trials,
-                  rstate= np.random.RandomState(42))
+best_param = parallel_fmin(xgb_smote, xgb_tune_kwargs, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_SMOTE_trials,
+                           rstate= np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           pruner=FoldPruner(percentile=50))
 
 # End timer for experiment
 end_time = datetime.now()
@@ -998,7 +975,7 @@ print('%-20s %s' % ('End Time', end_time))
 print(str(timedelta(seconds=(end_time-start_time).seconds)))
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_SMOTE_trials_results = sorted(bayesOpt_SMOTE_trials.results,
+bayesOpt_SMOTE_trials_results = sorted(completed_results(bayesOpt_SMOTE_trials),
                                        key=lambda x: x['loss'])
 print('SMOTE HPO 300 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_SMOTE_trials_results[:2])
@@ -1021,18 +998,23 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\Model_PKL'
 os.chdir(path)
    
-# Re-create the best model and train on the training data                
-best_bayes_SMOTE_model = XGBClassifier(objective='binary:logistic', 
-                                       booster='gbtree', 
-                                       scale_pos_weight=1, 
-                                       use_label_encoder=False,                                        
-                                       random_state=seed_value, 
-                                       n_jobs=-1, 
-                                       verbosity=0, 
-                                       **best_bayes_params)
-         
-# Fit the model
-best_bayes_SMOTE_model.fit(X1_train, y1_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_SMOTE_model = best_model(bayesOpt_SMOTE_trials, 'xgboost', best_bayes_params,
+                                        X1_train, y1_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Re-create the best model and train on the training data
+    best_bayes_SMOTE_model = XGBClassifier(objective='binary:logistic',
+                                           booster='gbtree',
+                                           scale_pos_weight=1,
+                                           use_label_encoder=False,
+                                           random_state=seed_value,
+                                           n_jobs=-1,
+                                           verbosity=0,
+                                           **best_bayes_params)
+
+    # Fit the model
+    best_bayes_SMOTE_model.fit(X1_train, y1_train)
 
 # Save model
 Pkl_Filename = 'XGB_HPO_SMOTE_300.pkl'  
@@ -1071,17 +1053,16 @@ print('The best model from SMOTE Bayes optimization 300 trials scores {:.5f} AUC
                                                                                                                             preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\bayesParams'
 os.chdir(path)
@@ -1191,4 +1172,66 @@ exp = explainer.explain_instance(
 
 exp.save_to_file('best_bayes_SMOTE_300_LIME.html')
 
+###############################################################################
+# Asynchronous successive halving over boosting rounds on Upsampling data
+path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\trialOptions'
+os.chdir(path)
+
+# Configurations start with 20 trees and the best third of each rung
+# continue boosting to 60, 180 and 540 trees
+out_file = 'XGB_HPO_Upsampling_ASHA.csv'
+bayesOpt_ASHA_trials = Trials()
+
+# Start timer for experiment
+start_time = datetime.now()
+print('%-20s %s' % ('Start Time', start_time))
+best_asha = asha_fmin(xgb_upsampling, xgb_tune_kwargs, algo=tpe.suggest,
+                      max_evals=500, trials=bayesOpt_ASHA_trials,
+                      rstate=np.random.RandomState(42),
+                      min_rounds=20, max_rounds=540, reduction_factor=3,
+                      threads_per_worker=THREADS_PER_WORKER,
+                      out_file=out_file,
+                      store=TrialStore(TRIAL_DB, out_file[:-4]))
+
+# End timer for experiment
+end_time = datetime.now()
+print('%-20s %s' % ('End Time', end_time))
+print(str(timedelta(seconds=(end_time-start_time).seconds)))
+
+# Losses after fewer rounds are not comparable, so the best trial is taken
+# from the highest rung reached
+print('Upsampling ASHA: Best trial on the highest rung')
+print(best_asha)
+
+###############################################################################
+# Search on stratified row subsamples of the Upsampling data and confirm the
+# best configurations on all rows
+path = r'D:\LoanStatus\Python\Models\ML\XGBoost\Hyperopt\TrainTest\trialOptions'
+os.chdir(path)
+
+# 200 configurations on 50k rows, the best quarter of them on 200k rows and
+# the best quarter of those on all rows
+out_file = 'XGB_HPO_Upsampling_Fidelity.csv'
+bayesOpt_Fidelity_trials = Trials()
+
+best_fidelity = fidelity_fmin(xgb_upsampling, xgb_tune_kwargs, n_configs=200,
+                              rung_rows=(50000, 200000, None),
+                              reduction_factor=4,
+                              trials=bayesOpt_Fidelity_trials,
+                              rstate=np.random.RandomState(42),
+                              threads_per_worker=THREADS_PER_WORKER,
+                              out_file=out_file,
+                              store=TrialStore(TRIAL_DB, out_file[:-4]))
+print('Best configuration on all rows:')
+print(best_fidelity)
+
+# Refit the best configuration on the full training data
+best_fidelity_model = build_model('xgboost', best_fidelity['params'],
+                                  seed=seed_value)
+best_fidelity_model.fit(X_train, y_train)
+
+preds = best_fidelity_model.predict_proba(X_test)[:, 1]
+print('The best model from the row subsample search scores {:.5f} AUC ROC on the test set.'.format(roc_auc_score(y_test,
+                                                                                                                  preds)))
+
 ###############################################################################
\ No newline at end of file
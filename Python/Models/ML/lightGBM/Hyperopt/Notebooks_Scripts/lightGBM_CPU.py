@@ -8,14 +8,14 @@
 ############################  lightGBM Methods  ###############################
 ###############################################################################
 import os
+import sys
 import random
 import numpy as np
 import warnings
 import pandas as pd
 import lightgbm as lgb
-from hyperopt import hp, fmin, tpe, Trials, STATUS_OK
-import csv
-from timeit import default_timer as timer
+from hyperopt import hp, tpe, Trials
+from sklearn.model_selection import KFold
 import ast
 import pickle
 from sklearn.metrics import f1_score, roc_auc_score, accuracy_score
@@ -29,6 +29,17 @@ import webbrowser
 from eli5.formatters import format_as_dataframe
 from eli5 import show_prediction
 from lime import lime_tabular
+sys.path.insert(0, r'D:\LoanStatus\Python\Models\ML\HPO')
+from hpoObjectives import SharedDataset, CVObjective, build_model
+from hpoObjectives import best_model
+from datasetCache import lgb_fold_datasets
+from parallelTrials import parallel_fmin, completed_results
+from studyCheckpoint import StudyCheckpoint
+from trialStore import TrialStore
+from successiveHalving import asha_fmin
+from dataFidelity import fidelity_fmin
+from warmStart import warm_start, load_hyperopt_archive
+from spaceImportance import params_frame, param_importance
 warnings.filterwarnings('ignore')
 
 path = r'D:\LoanStatus\Data'
@@ -146,59 +157,46 @@ print('F1 score : %.3f' % f1_score(y_test, y_pred_SMOTE))
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X_train, label=y_train, params=params)
-
 # Set number of trials and folds
 NUM_EVAL = 100
 N_FOLDS = 3
 
-# Define an lgb_hpo function
-def lgb_hpo(params, n_folds=N_FOLDS):
-    """Gradient Boosting Machine Hyperparameter Optimization"""
-    
-    # Keep track of evals
-    global ITERATION
-    
-    ITERATION += 1
-    
-    # Retrieve the subsample if present otherwise set to 1.0
-    subsample = params['boosting_type'].get('subsample', 1.0)
-    
-    # Extract the boosting type
-    params['boosting_type'] = params['boosting_type']['boosting_type']
-    params['subsample'] = subsample
-    
-    # Make sure parameters that need to be integers are integers
-    for param_name in ['max_depth', 'num_leaves']:
-        params[param_name] = int(params[param_name])
-
-    # Perform n_folds cross validation        
-    start = timer()
-    cv_results = lgb.cv(params, train_set, metrics='auc',
-                        nfold=N_FOLDS, num_boost_round=100, 
-                        early_stopping_rounds=10, seed=seed_value)
-    run_time = timer() - start
-    
-    # Extract the best score
-    best_score = np.max(cv_results['auc-mean'])
-    
-    # Loss must be minimized
-    loss = 1 - best_score
-    
-    # Boosting rounds that returned the highest cv score
-    n_estimators = int(np.argmax(cv_results['auc-mean']) + 1)
+# Set same k-folds for reproducibility
+kfolds = KFold(n_splits=N_FOLDS, shuffle=True, random_state=seed_value)
 
-    # Write to the csv file ('a' means append)
-    of_connection = open(out_file, 'a')
-    writer = csv.writer(of_connection)
-    writer.writerow([loss, params, ITERATION, n_estimators, run_time])
-    
-    # Dictionary with information for evaluation
-    return {'loss': loss, 'params': params, 'iteration': ITERATION,
-            'estimators': n_estimators, 
-            'train_time': run_time, 'status': STATUS_OK}
+# Number of threads for each parallel HPO worker
+THREADS_PER_WORKER = 4
+
+# Wall-clock seconds and CPU hours of each study, where None is no limit
+TIME_BUDGET = None
+CPU_HOURS = None
+
+# Database of all trials, exported to the trial csv after each study
+TRIAL_DB = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions\trials.db'
+
+# Checkpoints to resume interrupted studies
+STUDY_DIR = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\studies'
+
+# Average the fold models of the best trial ('folds'), refit it with a held
+# out early stopping set ('holdout') or on all training rows ('full')
+REFIT_MODE = 'folds'
+FOLD_MODEL_DIR = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\foldModels'
+
+# Training sets written once and memory-mapped by the HPO workers
+US_data = SharedDataset.create(X_train, y_train, r'D:\LoanStatus\Data\sharedData',
+                               'trainDF_US')
+SMOTE_data = SharedDataset.create(X1_train, y1_train, r'D:\LoanStatus\Data\sharedData',
+                                  'trainDF_SMOTE')
+
+# Binned LightGBM Datasets of the folds, built once and reused by every trial
+lgb_fold_datasets(US_data, kfolds)
+lgb_fold_datasets(SMOTE_data, kfolds)
+
+# Objective for optimization of hyperparameters, picklable so trials can
+# run in parallel worker processes
+lgb_hpo = CVObjective('lightgbm', US_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
     
 # Define the parameter grid
 param_grid = {
@@ -224,24 +222,23 @@ tpe_algorithm = tpe.suggest
 
 # File to save results
 out_file = 'lightGBM_HPO_Upsampling_100.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
 
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
-
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_Upsampling_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
-                  rstate=np.random.RandomState(42))
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_Upsampling_trials_results = sorted(bayesOpt_Upsampling_trials.results,
+bayesOpt_Upsampling_trials_results = sorted(completed_results(bayesOpt_Upsampling_trials),
                                             key=lambda x: x['loss'])
 print('Upsampling HPO 100 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_Upsampling_trials_results[:2])
@@ -266,15 +263,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_Upsampling_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                                 lgb_hpo='binary',
-                                                 random_state=seed_value,
-                                                 n_jobs=-1, 
-                                                 **best_bayes_params)
-
-# Fit the model
-best_bayes_Upsampling_model.fit(X_train, y_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_Upsampling_model = best_model(bayesOpt_Upsampling_trials, 'lightgbm', best_bayes_params,
+                                             X_train, y_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_Upsampling_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                     lgb_hpo='binary',
+                                                     random_state=seed_value,
+                                                     n_jobs=-1, 
+                                                     **best_bayes_params)
+
+    # Fit the model
+    best_bayes_Upsampling_model.fit(X_train, y_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_Upsampling_100.pkl' 
@@ -312,9 +314,8 @@ print('The best model from Upsampling Bayes 100 trials optimization scores {:.5f
                                                                                                                                  preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -324,13 +325,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -485,30 +486,38 @@ exp.save_to_file('best_bayes_Upsampling_100_LIME_Test.html')
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X1_train, label=y1_train, params=params)
+# Objective on the shared training set
+lgb_hpo = CVObjective('lightgbm', SMOTE_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
 
 # File to save results
 out_file = 'lightGBM_HPO_SMOTE_100.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
 
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_SMOTE_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_SMOTE_trials,
-                  rstate=np.random.RandomState(42))
+# Warm start from the archived trials of the lightGBM_HPO_Upsampling_100 study,
+# down-weighted since it used the other dataset variant
+n_warm = warm_start(bayesOpt_SMOTE_trials, param_grid,
+                    *load_hyperopt_archive('lightGBM_HPO_Upsampling_100.csv', 'lightgbm',
+                                           TrialStore(TRIAL_DB, 'lightGBM_HPO_Upsampling_100')),
+                    family='lightgbm', weight=0.5,
+                    rstate=np.random.default_rng(42))
+
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_SMOTE_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_SMOTE_trials_results = sorted(bayesOpt_SMOTE_trials.results,
+bayesOpt_SMOTE_trials_results = sorted(completed_results(bayesOpt_SMOTE_trials),
                                        key=lambda x: x['loss'])
 print('SMOTE HPO 100 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_SMOTE_trials_results[:2])
@@ -533,15 +542,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                            lgb_hpo='binary',
-                                            random_state=seed_value,
-                                            n_jobs=-1, 
-                                            **best_bayes_params)
-
-# Fit the model
-best_bayes_SMOTE_model.fit(X1_train, y1_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_SMOTE_model = best_model(bayesOpt_SMOTE_trials, 'lightgbm', best_bayes_params,
+                                        X1_train, y1_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                lgb_hpo='binary',
+                                                random_state=seed_value,
+                                                n_jobs=-1, 
+                                                **best_bayes_params)
+
+    # Fit the model
+    best_bayes_SMOTE_model.fit(X1_train, y1_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_SMOTE_100.pkl' 
@@ -579,9 +593,8 @@ print('The best model from SMOTE Bayes optimization 100 trials scores {:.5f} AUC
                                                                                                                             preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -591,13 +604,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -752,9 +765,10 @@ exp.save_to_file('best_bayes_SMOTE_100_LIME_Test.html')
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X_train, label=y_train, params=params)
+# Objective on the shared training set
+lgb_hpo = CVObjective('lightgbm', US_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
 
 # Define number of trials
 NUM_EVAL = 500
@@ -785,24 +799,30 @@ tpe_algorithm = tpe.suggest
 
 # File to save results
 out_file = 'lightGBM_HPO_Upsampling_500.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
 
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_Upsampling_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
-                  rstate=np.random.RandomState(42))
+# Warm start from the archived trials of the lightGBM_HPO_Upsampling_100 study
+n_warm = warm_start(bayesOpt_Upsampling_trials, param_grid,
+                    *load_hyperopt_archive('lightGBM_HPO_Upsampling_100.csv', 'lightgbm',
+                                           TrialStore(TRIAL_DB, 'lightGBM_HPO_Upsampling_100')),
+                    family='lightgbm', weight=1,
+                    rstate=np.random.default_rng(42))
+
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_Upsampling_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_Upsampling_trials_results = sorted(bayesOpt_Upsampling_trials.results,
+bayesOpt_Upsampling_trials_results = sorted(completed_results(bayesOpt_Upsampling_trials),
                                             key=lambda x: x['loss'])
 print('Upsampling HPO 500 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_Upsampling_trials_results[:2])
@@ -827,15 +847,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_Upsampling_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                                 lgb_hpo='binary',
-                                                 random_state=seed_value, 
-                                                 n_jobs=-1, 
-                                                 **best_bayes_params)
-
-# Fit the model
-best_bayes_Upsampling_model.fit(X_train, y_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_Upsampling_model = best_model(bayesOpt_Upsampling_trials, 'lightgbm', best_bayes_params,
+                                             X_train, y_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_Upsampling_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                     lgb_hpo='binary',
+                                                     random_state=seed_value, 
+                                                     n_jobs=-1, 
+                                                     **best_bayes_params)
+
+    # Fit the model
+    best_bayes_Upsampling_model.fit(X_train, y_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_Upsampling_500.pkl' 
@@ -873,9 +898,8 @@ print('The best model from Upsampling Bayes 500 trials optimization scores {:.5f
                                                                                                                                  preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(colum0ns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -885,13 +909,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -1044,9 +1068,10 @@ path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
 # GBDT has lowest loss for Upsampling initial exploration
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X_train, label=y_train, params=params)
+# Objective on the shared training set
+lgb_hpo = CVObjective('lightgbm', US_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
 
 # Define number of trials
 NUM_EVAL = 300
@@ -1073,27 +1098,26 @@ param_grid = {
 
 # File to save results
 out_file = 'lightGBM_GBDT_HPO_Upsampling_300.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
-
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
 
 # Select the optimization algorithm
 tpe_algorithm = tpe.suggest
 
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_Upsampling_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
-                  rstate=np.random.RandomState(42))
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL, trials=bayesOpt_Upsampling_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_Upsampling_trials_results = sorted(bayesOpt_Upsampling_trials.results,
+bayesOpt_Upsampling_trials_results = sorted(completed_results(bayesOpt_Upsampling_trials),
                                             key=lambda x: x['loss'])
 print('Upsampling HPO GBDT 300 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_Upsampling_trials_results[:2])
@@ -1118,15 +1142,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_Upsampling_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                                 lgb_hpo='binary',
-                                                 random_state=seed_value,
-                                                 n_jobs=-1, 
-                                                 **best_bayes_params)
-
-# Fit the model
-best_bayes_Upsampling_model.fit(X_train, y_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_Upsampling_model = best_model(bayesOpt_Upsampling_trials, 'lightgbm', best_bayes_params,
+                                             X_train, y_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_Upsampling_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                     lgb_hpo='binary',
+                                                     random_state=seed_value,
+                                                     n_jobs=-1, 
+                                                     **best_bayes_params)
+
+    # Fit the model
+    best_bayes_Upsampling_model.fit(X_train, y_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_GBDT_Upsampling_300.pkl' 
@@ -1164,9 +1193,8 @@ print('The best model from Upsampling GBDT Bayes optimization 300 trials scores
                                                                                                                                       preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -1179,13 +1207,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -1328,9 +1356,10 @@ exp.save_to_file('best_bayes_Upsampling_GBDT_300_LIME_Test.html')
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X1_train, label=y1_train, params=params)
+# Objective on the shared training set
+lgb_hpo = CVObjective('lightgbm', SMOTE_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
 
 # Define number of trials
 NUM_EVAL = 300
@@ -1357,24 +1386,30 @@ param_grid = {
 }
 # File to save results
 out_file = 'lightGBM_HPO_SMOTE_300.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
 
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
-
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_SMOTE_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_SMOTE_trials,
-                  rstate=np.random.RandomState(42))
+# Warm start from the archived trials of the lightGBM_HPO_SMOTE_100 study
+n_warm = warm_start(bayesOpt_SMOTE_trials, param_grid,
+                    *load_hyperopt_archive('lightGBM_HPO_SMOTE_100.csv', 'lightgbm',
+                                           TrialStore(TRIAL_DB, 'lightGBM_HPO_SMOTE_100')),
+                    family='lightgbm', weight=1,
+                    rstate=np.random.default_rng(42))
+
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_SMOTE_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_SMOTE_trials_results = sorted(bayesOpt_SMOTE_trials.results,
+bayesOpt_SMOTE_trials_results = sorted(completed_results(bayesOpt_SMOTE_trials),
                                        key=lambda x: x['loss'])
 print('SMOTE HPO 300 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_SMOTE_trials_results[:2])
@@ -1399,15 +1434,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                            lgb_hpo='binary',
-                                            random_state=seed_value, 
-                                            n_jobs=-1, 
-                                            **best_bayes_params)
-
-# Fit the model
-best_bayes_SMOTE_model.fit(X1_train, y1_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_SMOTE_model = best_model(bayesOpt_SMOTE_trials, 'lightgbm', best_bayes_params,
+                                        X1_train, y1_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                lgb_hpo='binary',
+                                                random_state=seed_value, 
+                                                n_jobs=-1, 
+                                                **best_bayes_params)
+
+    # Fit the model
+    best_bayes_SMOTE_model.fit(X1_train, y1_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_SMOTE_300.pkl' 
@@ -1445,9 +1485,8 @@ print('The best model from SMOTE Bayes optimization 300 trials scores {:.5f} AUC
                                                                                                                             preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -1457,13 +1496,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -1614,9 +1653,10 @@ exp.save_to_file('best_bayes_SMOTE_300_LIME_Test.html')
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X1_train, label=y1_train, params=params)
+# Objective on the shared training set
+lgb_hpo = CVObjective('lightgbm', SMOTE_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
 
 # Define number of trials
 NUM_EVAL = 500
@@ -1644,24 +1684,30 @@ param_grid = {
 
 # File to save results
 out_file = 'lightGBM_HPO_SMOTE_500.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
 
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
-
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_SMOTE_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_SMOTE_trials,
-                  rstate=np.random.RandomState(42))
+# Warm start from the archived trials of the lightGBM_HPO_SMOTE_300 study
+n_warm = warm_start(bayesOpt_SMOTE_trials, param_grid,
+                    *load_hyperopt_archive('lightGBM_HPO_SMOTE_300.csv', 'lightgbm',
+                                           TrialStore(TRIAL_DB, 'lightGBM_HPO_SMOTE_300')),
+                    family='lightgbm', weight=1,
+                    rstate=np.random.default_rng(42))
+
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_SMOTE_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_SMOTE_trials_results = sorted(bayesOpt_SMOTE_trials.results,
+bayesOpt_SMOTE_trials_results = sorted(completed_results(bayesOpt_SMOTE_trials),
                                        key=lambda x: x['loss'])
 print('SMOTE HPO 500 trials: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_SMOTE_trials_results[:2])
@@ -1686,15 +1732,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                            lgb_hpo='binary',
-                                            random_state=seed_value, 
-                                            n_jobs=-1, 
-                                            **best_bayes_params)
-
-# Fit the model
-best_bayes_SMOTE_model.fit(X1_train, y1_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_SMOTE_model = best_model(bayesOpt_SMOTE_trials, 'lightgbm', best_bayes_params,
+                                        X1_train, y1_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                lgb_hpo='binary',
+                                                random_state=seed_value, 
+                                                n_jobs=-1, 
+                                                **best_bayes_params)
+
+    # Fit the model
+    best_bayes_SMOTE_model.fit(X1_train, y1_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_SMOTE_500.pkl' 
@@ -1732,9 +1783,8 @@ print('The best model from SMOTE Bayes optimization 500 trials scores {:.5f} AUC
                                                                                                                             preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -1744,13 +1794,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -1903,9 +1953,10 @@ exp.save_to_file('best_bayes_SMOTE_500_LIME_Test.html')
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
 os.chdir(path)
 
-# Create a lgb dataset
-params = {'verbose': -1}
-train_set = lgb.Dataset(X1_train, label=y1_train, params=params)
+# Objective on the shared training set
+lgb_hpo = CVObjective('lightgbm', SMOTE_data, kfolds,
+                      n_threads=THREADS_PER_WORKER, seed=seed_value,
+                      model_dir=FOLD_MODEL_DIR)
 
 # Define the parameter grid
 param_grid = {
@@ -1928,24 +1979,30 @@ param_grid = {
 
 # File to save results
 out_file = 'lightGBM_HPO_SMOTE_500_2.csv'
-of_connection = open(out_file, 'w')
-writer = csv.writer(of_connection)
 
-# Write the headers to the file
-writer.writerow(['loss', 'params', 'iteration', 'estimators', 'train_time'])
-of_connection.close()
-
-# Set global variable and HPO is run with fmin
-global ITERATION
-ITERATION = 0
+# HPO is run with fmin over parallel workers
 bayesOpt_SMOTE_trials = Trials()
 
-best_param = fmin(lgb_hpo, param_grid, algo=tpe.suggest,
-                  max_evals=NUM_EVAL, trials=bayesOpt_SMOTE_trials,
-                  rstate=np.random.RandomState(42))
+# Warm start from the archived trials of the lightGBM_HPO_SMOTE_500 study
+n_warm = warm_start(bayesOpt_SMOTE_trials, param_grid,
+                    *load_hyperopt_archive('lightGBM_HPO_SMOTE_500.csv', 'lightgbm',
+                                           TrialStore(TRIAL_DB, 'lightGBM_HPO_SMOTE_500')),
+                    family='lightgbm', weight=1,
+                    rstate=np.random.default_rng(42))
+
+best_param = parallel_fmin(lgb_hpo, param_grid, algo=tpe.suggest,
+                           max_evals=NUM_EVAL + n_warm, trials=bayesOpt_SMOTE_trials,
+                           rstate=np.random.RandomState(42),
+                           threads_per_worker=THREADS_PER_WORKER,
+                           time_budget=TIME_BUDGET, cpu_hours=CPU_HOURS,
+                           out_file=out_file,
+                           checkpoint=StudyCheckpoint(out_file[:-4], STUDY_DIR),
+                           store=TrialStore(TRIAL_DB, out_file[:-4]),
+                           out_columns=['loss', 'params', 'iteration',
+                                        'estimators', 'train_time'])
 
 # Sort the trials with lowest loss (highest AUC) 
-bayesOpt_SMOTE_trials_results = sorted(bayesOpt_SMOTE_trials.results,
+bayesOpt_SMOTE_trials_results = sorted(completed_results(bayesOpt_SMOTE_trials),
                                        key=lambda x: x['loss'])
 print('SMOTE HPO 500 trials GOSS DART: Top two trials with the lowest loss (highest AUC)')
 print(bayesOpt_SMOTE_trials_results[:2])
@@ -1970,15 +2027,20 @@ best_bayes_params = ast.literal_eval(results.loc[0, 'params']).copy()
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\Model_PKL'
 os.chdir(path)
 
-# Use the HPO from best model fit a model
-best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
-                                            lgb_hpo='binary',
-                                            random_state=seed_value, 
-                                            n_jobs=-1, 
-                                            **best_bayes_params)
-
-# Fit the model
-best_bayes_SMOTE_model.fit(X1_train, y1_train)
+# Average the fold models of the best trial or refit it with early stopping
+if REFIT_MODE in ('folds', 'holdout'):
+    best_bayes_SMOTE_model = best_model(bayesOpt_SMOTE_trials, 'lightgbm', best_bayes_params,
+                                        X1_train, y1_train, refit=REFIT_MODE, seed=seed_value)
+else:
+    # Use the HPO from best model fit a model
+    best_bayes_SMOTE_model = lgb.LGBMClassifier(n_estimators=best_bayes_estimators, 
+                                                lgb_hpo='binary',
+                                                random_state=seed_value, 
+                                                n_jobs=-1, 
+                                                **best_bayes_params)
+
+    # Fit the model
+    best_bayes_SMOTE_model.fit(X1_train, y1_train)
 
 # Save model
 Pkl_Filename = 'lightGBM_HPO_SMOTE_500_2.pkl' 
@@ -2016,9 +2078,8 @@ print('The best model from SMOTE Bayes optimization 500 trials GOSS DART scores
                                                                                                                                       preds)))
 print('This was achieved after {} search iterations'.format(results.loc[0, 'iteration']))
 
-# Create a new dataframe for storing parameters
-bayes_params = pd.DataFrame(columns=list(ast.literal_eval(results.loc[0, 'params']).keys()),
-                            index=list(range(len(results))))
+# Parameters of each trial as columns
+bayes_params = params_frame(results['params'])
 
 # Convert data types for graphing
 bayes_params['colsample_bytree'] = bayes_params['colsample_bytree'].astype('float64')
@@ -2028,13 +2089,13 @@ bayes_params['reg_alpha'] = bayes_params['reg_alpha'].astype('float64')
 bayes_params['reg_lambda'] = bayes_params['reg_lambda'].astype('float64')
 bayes_params['subsample'] = bayes_params['subsample'].astype('float64')
 
-# Add the results with each parameter a different column
-for i, params in enumerate(results['params']):
-    bayes_params.loc[i, :] = list(ast.literal_eval(params).values())
-    
 bayes_params['loss'] = results['loss']
 bayes_params['iteration'] = results['iteration']
 
+# Share of the loss variance explained by each hyperparameter
+print(param_importance(bayes_params.drop(columns=['loss', 'iteration']),
+                       results['loss']))
+
 # Set path for ML results
 path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\bayesParams'
 os.chdir(path)
@@ -2176,4 +2237,62 @@ exp = explainer.explain_instance(
     predict_fn=best_bayes_SMOTE_model.predict_proba)
 exp.save_to_file('best_bayes_SMOTE_500_2_LIME_Test.html')
 
+###############################################################################
+# Asynchronous successive halving over boosting rounds on Upsampling data
+path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
+os.chdir(path)
+
+# Objective trained on the Upsampling data
+lgb_asha = CVObjective('lightgbm', US_data, kfolds,
+                       n_threads=THREADS_PER_WORKER, seed=seed_value)
+
+# Configurations start with 10 rounds and the best third of each rung
+# continue boosting to 30, 90 and 270 rounds
+out_file = 'lightGBM_HPO_Upsampling_ASHA.csv'
+bayesOpt_ASHA_trials = Trials()
+
+best_asha = asha_fmin(lgb_asha, param_grid, algo=tpe.suggest,
+                      max_evals=500, trials=bayesOpt_ASHA_trials,
+                      rstate=np.random.RandomState(42),
+                      min_rounds=10, max_rounds=270, reduction_factor=3,
+                      threads_per_worker=THREADS_PER_WORKER,
+                      out_file=out_file,
+                      store=TrialStore(TRIAL_DB, out_file[:-4]))
+
+# Losses after fewer rounds are not comparable, so the best trial is taken
+# from the highest rung reached
+print('Upsampling ASHA: Best trial on the highest rung')
+print(best_asha)
+
+###############################################################################
+# Search on stratified row subsamples of the Upsampling data and confirm the
+# best configurations on all rows
+path = r'D:\LoanStatus\Python\Models\ML\lightGBM\Hyperopt\trialOptions'
+os.chdir(path)
+
+# 200 configurations on 50k rows, the best quarter of them on 200k rows and
+# the best quarter of those on all rows
+out_file = 'lightGBM_HPO_Upsampling_Fidelity.csv'
+bayesOpt_Fidelity_trials = Trials()
+
+best_fidelity = fidelity_fmin(lgb_asha, param_grid, n_configs=200,
+                              rung_rows=(50000, 200000, None),
+                              reduction_factor=4,
+                              trials=bayesOpt_Fidelity_trials,
+                              rstate=np.random.RandomState(42),
+                              threads_per_worker=THREADS_PER_WORKER,
+                              out_file=out_file,
+                              store=TrialStore(TRIAL_DB, out_file[:-4]))
+print('Best configuration on all rows:')
+print(best_fidelity)
+
+# Refit the best configuration on the full training data
+best_fidelity_model = build_model('lightgbm', best_fidelity['params'],
+                                  seed=seed_value)
+best_fidelity_model.fit(X_train, y_train)
+
+preds = best_fidelity_model.predict_proba(X_test)[:, 1]
+print('The best model from the row subsample search scores {:.5f} AUC ROC on the test set.'.format(roc_auc_score(y_test,
+                                                                                                                  preds)))
+
 ###############################################################################
\ No newline at end of file
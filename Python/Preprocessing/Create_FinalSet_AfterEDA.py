@@ -10,6 +10,8 @@ import random
 import numpy as np
 import pandas as pd
 import warnings
+from featureSelection_Cache import FeatureSelectionCache
+from featurePruning import feature_stats, prune_features, write_manifest
 warnings.filterwarnings('ignore')
 
 seed_value = 42
@@ -25,11 +27,21 @@ df = pd.read_csv('LendingTree_LoanStatus_EDA.csv', low_memory=False)
 df = df.drop_duplicates()
 
 # Drop based off high correlations and imbalance in cat vars
-df = df.drop(['out_prncp_inv', 'funded_amnt', 'funded_amnt_inv',
-              'total_pymnt_inv', 'open_acc', 'tot_cur_bal', 'total_rec_prncp',
-              'num_op_rev_tl', 'home_ownership_OTHER', 'hardship_flag_Y',
-              'pymnt_plan_y', 'purpose_house', 'purpose_medical',
-              'debt_settlement_flag_Y', 'purpose_small_business'], axis=1)
+X = df.drop('loan_status', axis=1)
+y = df.loan_status
+
+fs_cache = FeatureSelectionCache(r'D:\LoanStatus\Python\EDA\featureSelection_cache')
+stats = fs_cache.cached('pruning_stats', (X, y), {'method': 'spearman'},
+                        lambda: feature_stats(X, y))
+
+drop_list, manifest = prune_features(stats, corr_threshold=0.8, min_freq=0.02)
+write_manifest(manifest, 'LendingTree_LoanStatus_final_dropManifest.json')
+print('\nFeatures dropped due to high correlation or imbalance:')
+print(drop_list)
+
+del X, y, stats
+
+df = df.drop(drop_list, axis=1)
 df = df.drop_duplicates()
 
 print('\nDimensions of Final Data:', df.shape) 
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+############ Principal Component Analysis after Cleaning Data #################
+###############################################################################
+# Python port of R/EDA/PCA_afterCleaning.R
+# Features are centered and scaled as in prcomp(center=TRUE, scale.=TRUE).
+# 'randomized' fits a randomized SVD on the data in memory while 'incremental'
+# streams the cleaned csv in chunks so the full matrix is never loaded
+import os
+import time
+import pickle
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from sklearn.decomposition import PCA, IncrementalPCA
+
+
+class PCAStage:
+    """Scaled PCA of the cleaned data using randomized SVD or chunked incremental PCA."""
+
+    def __init__(self, n_components=65, mode='randomized', chunksize=100000,
+                 target='loan_status', random_state=42):
+        if mode not in ('randomized', 'incremental'):
+            raise ValueError("mode must be 'randomized' or 'incremental'")
+        self.n_components = n_components
+        self.mode = mode
+        self.chunksize = chunksize
+        self.target = target
+        self.random_state = random_state
+
+    def _chunks(self, filename):
+        """Yields the features of the csv in chunks."""
+        for chunk in pd.read_csv(filename, chunksize=self.chunksize,
+                                 low_memory=False):
+            yield chunk.drop(self.target, axis=1, errors='ignore')
+
+    def _set_features(self, columns):
+        """Keeps the columns with nonzero variance as in the R code."""
+        keep = self.scaler_.var_ > 0
+        self.features_ = [c for c, k in zip(columns, keep) if k]
+        self.scaler_.mean_ = self.scaler_.mean_[keep]
+        self.scaler_.var_ = self.scaler_.var_[keep]
+        self.scaler_.scale_ = self.scaler_.scale_[keep]
+        self.scaler_.n_features_in_ = len(self.features_)
+        if hasattr(self.scaler_, 'feature_names_in_'):
+            del self.scaler_.feature_names_in_
+        if self.n_components > len(self.features_):
+            raise ValueError('n_components=%d is more than the %d features '
+                             'with nonzero variance'
+                             % (self.n_components, len(self.features_)))
+
+    def fit(self, X):
+        """Fits the scaler and a randomized PCA on data in memory."""
+        self.scaler_ = StandardScaler().fit(X)
+        self._set_features(X.columns)
+        Z = self.scaler_.transform(X[self.features_].values)
+
+        self.pca_ = PCA(n_components=self.n_components, svd_solver='randomized',
+                        random_state=self.random_state)
+        self.scores_ = self.pca_.fit_transform(Z).astype(np.float32)
+        return self
+
+    def fit_chunks(self, filename):
+        """Fits the scaler and an incremental PCA with two passes over the csv."""
+        # First pass for the mean and variance of each feature
+        self.scaler_ = StandardScaler()
+        for chunk in self._chunks(filename):
+            self.scaler_.partial_fit(chunk.values)
+            columns = chunk.columns
+        self._set_features(columns)
+
+        # Second pass to fit the components; every batch needs at least
+        # n_components rows, so short chunks are gathered until a batch is
+        # full and the last full batch is held back to take a short tail
+        self.pca_ = IncrementalPCA(n_components=self.n_components)
+        held, short = None, None
+        for chunk in self._chunks(filename):
+            Z = self.scaler_.transform(chunk[self.features_].values)
+            short = Z if short is None else np.vstack([short, Z])
+            if short.shape[0] >= self.n_components:
+                if held is not None:
+                    self.pca_.partial_fit(held)
+                held, short = short, None
+        if short is not None:
+            held = short if held is None else np.vstack([held, short])
+        if held is None or held.shape[0] < self.n_components:
+            raise ValueError('n_components=%d is more than the rows of %s'
+                             % (self.n_components, filename))
+        self.pca_.partial_fit(held)
+        return self
+
+    def transform(self, X):
+        """Returns the principal component scores of X as float32."""
+        Z = self.scaler_.transform(X[self.features_].values)
+        return self.pca_.transform(Z).astype(np.float32)
+
+    def explained_variance(self):
+        """Returns the eigenvalues, proportion and cumulative proportion of variance."""
+        eig = self.pca_.explained_variance_
+        prop = self.pca_.explained_variance_ratio_
+        return pd.DataFrame({'eigenvalue': eig,
+                             'variance.percent': prop * 100,
+                             'cumulative.variance.percent': np.cumsum(prop) * 100},
+                            index=['PC' + str(i + 1) for i in range(len(eig))])
+
+    def components(self):
+        """Returns the loadings of each feature on each component."""
+        return pd.DataFrame(self.pca_.components_.T, index=self.features_,
+                            columns=['PC' + str(i + 1)
+                                     for i in range(self.pca_.n_components_)])
+
+    def n_components_for(self, threshold=0.9):
+        """Returns the number of components explaining the threshold of variance."""
+        cumpro = np.cumsum(self.pca_.explained_variance_ratio_)
+        return int(min(np.searchsorted(cumpro, threshold) + 1, len(cumpro)))
+
+    def write_scores(self, filename, out_file):
+        """Streams the csv through the fitted stage and writes the scores to a npy file."""
+        n_rows = sum(len(chunk) for chunk in self._chunks(filename))
+        scores = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32,
+                                           shape=(n_rows,
+                                                  self.pca_.n_components_))
+        i = 0
+        for chunk in self._chunks(filename):
+            scores[i:i + len(chunk)] = self.transform(chunk)
+            i += len(chunk)
+        scores.flush()
+        del scores
+
+    def save(self, prefix):
+        """Writes the components, explained variance and fitted stage to disk."""
+        self.components().to_csv(prefix + '_components.csv')
+        self.explained_variance().to_csv(prefix + '_explainedVariance.csv')
+        if hasattr(self, 'scores_'):
+            np.save(prefix + '_scores.npy', self.scores_)
+        with open(prefix + '.pkl', 'wb') as file:
+            pickle.dump(self, file)
+
+
+def pca_features(stage, X, threshold=None):
+    """Returns the compressed PC feature set of X for the linear and KNN models."""
+    scores = stage.transform(X)
+    if threshold is not None:
+        scores = scores[:, :stage.n_components_for(threshold)]
+    return pd.DataFrame(scores, index=X.index,
+                        columns=['PC' + str(i + 1)
+                                 for i in range(scores.shape[1])])
+
+###############################################################################
+if __name__ == '__main__':
+    print('\nLoan Status: PCA after Cleaning Data')
+    print('======================================================================')
+
+    path = r'D:\LoanStatus\Data'
+    os.chdir(path)
+
+    search_time_start = time.time()
+    pca_stage = PCAStage(mode='incremental').fit_chunks(
+        'LendingTree_LoanStatus_final.csv')
+    print('Finished incremental PCA in:', time.time() - search_time_start)
+
+    pca_stage.write_scores('LendingTree_LoanStatus_final.csv',
+                           'LendingTree_LoanStatus_final_PCA_scores.npy')
+
+    path = r'D:\LoanStatus\Python\EDA'
+    os.chdir(path)
+
+    pca_stage.save('PCA_afterCleaning')
+    print(pca_stage.explained_variance().head(30))
+    print('\nComponents explaining 90% of variance:',
+          pca_stage.n_components_for(0.9))
+    print('======================================================================')
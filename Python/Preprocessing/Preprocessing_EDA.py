@@ -14,21 +14,21 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.preprocessing import MinMaxScaler, OneHotEncoder
-from joblib import parallel_backend, import Parallel, delayed
-from sklearn.feature_selection import SelectFromModel
+from joblib import parallel_backend, Parallel, delayed
 from sklearn.model_selection import GridSearchCV
 from sklearn.metrics import accuracy_score
 from xgboost import XGBClassifier, plot_importance
 from sklearn.inspection import permutation_importance
 import shap
 import time
-from datetime import datetime, timedelta
 from statsmodels.stats.outliers_influence import variance_inflation_factor 
 from group_lasso.utils import extract_ohe_groups
 import scipy.sparse
 from group_lasso import LogisticGroupLasso
 import sweetviz as sv
 from ydata_profiling import ProfileReport
+from variableSelection_MVSIS import mvsis_screen
+from featureSelection_Cache import FeatureSelectionCache
 warnings.filterwarnings('ignore')
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
@@ -168,25 +168,46 @@ X = pd.get_dummies(X, drop_first=True)
 ###############################################################################
 ######################   1. SelectFromModel using XGBoost #####################
 ###############################################################################
-# Fit baseline model on all data
-model = XGBClassifier(eval_metric='logloss', 
-                      use_label_encoder=False,
-                      tree_method='gpu_hist', 
-                      gpu_id=0,
-                      random_state=seed_value)
+# Cache for variable selection results keyed by the data and parameters
+fs_cache = FeatureSelectionCache(r'D:\LoanStatus\Python\EDA\featureSelection_cache')
+
+xgb_params = {'eval_metric': 'logloss',
+              'use_label_encoder': False,
+              'tree_method': 'gpu_hist',
+              'gpu_id': 0,
+              'random_state': seed_value}
+
+def xgb_importance(X, y, model_file=None):
+    """Returns accuracy, feature importance, permutation importance and SHAP values from XGBoost."""
+    model = XGBClassifier(**xgb_params)
+    model.fit(X, y)
+    if model_file is not None:
+        model.save_model(model_file)
+
+    y_pred = model.predict(X)
+    predictions = [round(value) for value in y_pred]
+    perm_importance = permutation_importance(model, X, y)
+    explainer = shap.TreeExplainer(model)
+    
+    return {'accuracy': accuracy_score(y, predictions),
+            'feature_importances': model.feature_importances_,
+            'importance_weight': model.get_booster().get_score(importance_type='weight'),
+            'perm_importance_mean': perm_importance.importances_mean,
+            'shap_values': np.asarray(explainer.shap_values(X), 
+                                      dtype=np.float32)}
 
-model.fit(X, y)
+# Fit baseline model on all data
+xgb_all = fs_cache.cached('xgb_importance', (X, y), xgb_params,
+                          lambda: xgb_importance(X, y))
 
-y_pred = model.predict(X)
-predictions = [round(value) for value in y_pred]
-accuracy = accuracy_score(y, predictions)
+accuracy = xgb_all['accuracy']
 print('Accuracy: %.3f%%' % (accuracy * 100.0)) 
 print('======================================================================')
 
 # XGBoost - plot feature importance
 plt.rcParams['figure.figsize'] = (10, 10)
 plt.rcParams.update({'font.size': 8.5})
-ax = plot_importance(model)
+ax = plot_importance(xgb_all['importance_weight'])
 fig = ax.figure
 plt.tight_layout()
 fig.savefig('xgb_featureImportance_noVIF_AllData.png', dpi=my_dpi*10, 
@@ -194,64 +215,70 @@ fig.savefig('xgb_featureImportance_noVIF_AllData.png', dpi=my_dpi*10,
 plt.show();
 
 # Permutation importance
-perm_importance = permutation_importance(model, X, y)
+perm_importance_mean = xgb_all['perm_importance_mean']
 
 plt.rcParams.update({'font.size': 7})
-sorted_idx = perm_importance.importances_mean.argsort()
-plt.barh(X.columns[sorted_idx], perm_importance.importances_mean[sorted_idx])
+sorted_idx = perm_importance_mean.argsort()
+plt.barh(X.columns[sorted_idx], perm_importance_mean[sorted_idx])
 plt.xlabel('Permutation Importance')
 plt.tight_layout()
 plt.savefig('xgb_PermutationfeatureImportance_noVIF_AllData.png', dpi=my_dpi*10, 
-            bbox_inches='tight'))
+            bbox_inches='tight')
 plt.show();
 
 # Visualize feature importance with SHAP
-explainer = shap.TreeExplainer(model)
-shap_values = explainer.shap_values(X)
-
 plt.rcParams.update({'font.size': 7})
 fig = plt.figure()
-shap.summary_plot(shap_values, X, show=False)
+shap.summary_plot(xgb_all['shap_values'], X, show=False)
 fig.savefig('ShapSummary_xgb_noVIF_AllData.png', dpi=my_dpi*10, 
             bbox_inches='tight')
 plt.show();
 
 # Fit model using each importance as a threshold
 # Run for all features and then repeat for features after VIF to compare (X -> X1)
+def xgb_threshold_sweep(X, y, importances, accuracy):
+    """Returns the accuracy for each importance threshold and the optimal threshold."""
+    feat_max = X.shape[1]
+    feat_min = 2
+    acc_max = accuracy
+    thresholds = sort(importances)
+    thresh_goal = thresholds[0]
+    accuracy_list = []
+    n_features = []
+    for thresh in thresholds:
+        # Same selection as SelectFromModel(model, threshold=thresh, prefit=True)
+        select_X = X.loc[:, importances >= thresh]
+        
+        # Define model
+        selection_model = XGBClassifier(**xgb_params)
+        # Train model
+        selection_model.fit(select_X, y)
+        
+        # Evaluate model
+        selection_model_pred = selection_model.predict(select_X)
+        selection_predictions = [round(value) for value in selection_model_pred]
+        accuracy = accuracy_score(y_true=y, y_pred=selection_predictions)
+        accuracy = accuracy * 100
+        print('Thresh= %.6f, n= %d, Accuracy: %.3f%%' % (thresh, select_X.shape[1],
+                                                         accuracy))
+        accuracy_list.append(accuracy)
+        n_features.append(select_X.shape[1])
+        if(select_X.shape[1] < feat_max) and (select_X.shape[1] >= feat_min) and (accuracy >= acc_max):
+            acc_max = accuracy
+            thresh_goal = thresh
+    
+    return {'thresholds': thresholds,
+            'sweep': pd.DataFrame({'n_features': n_features,
+                                   'Accuracy': accuracy_list}),
+            'thresh_goal': thresh_goal}
+
 print('Time for feature selection using XGBoost...')
 search_time_start = time.time()
-feat_max = X.shape[1]
-feat_min = 2
-acc_max = accuracy
-thresholds = sort(model.feature_importances_)
-thresh_goal = thresholds[0]
-accuracy_list = []
-for thresh in thresholds:
-    selection = SelectFromModel(model, threshold=thresh, prefit=True)
-    select_X = selection.transform(X)
-    
-    # Define model
-    selection_model = XGBClassifier(eval_metric='logloss',
-                                    use_label_encoder=False,
-                                    tree_method='gpu_hist',
-                                    gpu_id=0,
-                                    random_state=seed_value)
-    # Train model
-    selection_model.fit(select_X, y)
-    
-    # Evaluate model
-    selection_model_pred = selection_model.predict(select_X)
-    selection_predictions = [round(value) for value in selection_model_pred]
-    accuracy = accuracy_score(y_true=y, y_pred=selection_predictions)
-    accuracy = accuracy * 100
-    print('Thresh= %.6f, n= %d, Accuracy: %.3f%%' % (thresh, select_X.shape[1],
-                                                     accuracy))
-    accuracy_list.append(accuracy)
-    if(select_X.shape[1] < feat_max) and (select_X.shape[1] >= feat_min) and (accuracy >= acc_max):
-      n_min = select_X.shape[1]
-      acc_max = accuracy
-      thresh_goal = thresh
-        
+xgb_sweep = fs_cache.cached('xgb_threshold_sweep', (X, y), xgb_params,
+                            lambda: xgb_threshold_sweep(X, y, 
+                                                        xgb_all['feature_importances'],
+                                                        accuracy))
+thresh_goal = xgb_sweep['thresh_goal']
 print('\n')
 print('Finished feature selection using XGBoost in:',
       time.time() - search_time_start)
@@ -261,37 +288,26 @@ print(thresh_goal)
 print('======================================================================')
 
 # Create df for number features and accuracy 
-key_list = list(range(X.shape[1], 0, -1))
-accuracy_dict = dict(zip(key_list, accuracy_list))
-accuracy_df = pd.DataFrame(accuracy_dict.items(), columns=['n_features',
-                                                           'Accuracy'])
+accuracy_df = xgb_sweep['sweep']
 accuracy_df.to_csv('selectFromModel_xgb_nFeatures_Accuracy.csv',
                    index=False)
 
 # Select features using optimal threshold with least number of features
-selection = SelectFromModel(model, threshold=thresh_goal, prefit=True)
-
-# Fit model for feature importance
-feature_names = X.columns[selection.get_support(indices=True)]
+feature_names = X.columns[xgb_all['feature_importances'] >= thresh_goal]
 print('\n- Feature selection using XGBoost resulted in '
       + str(len(feature_names)) + ' features.')
 print('\n- Features selected using optimal threshold for accuracy:')
-print(X.columns[selection.get_support()]) 
+print(feature_names) 
 
 # Create new feature importance chart
 X = pd.DataFrame(data=X, columns=feature_names)
 
-model = XGBClassifier(eval_metric='logloss', 
-                      use_label_encoder=False, 
-                      tree_method='gpu_hist', 
-                      gpu_id=0,
-                      random_state=seed_value)
-model.fit(X, y)
-model.save_model('xgb_featureSelection.model')
-
-y_pred = model.predict(X)
-predictions = [round(value) for value in y_pred]
-accuracy = accuracy_score(y, predictions)
+xgb_best = fs_cache.cached('xgb_importance', (X, y), xgb_params,
+                           lambda: xgb_importance(X, y,
+                                                  'xgb_featureSelection.model'),
+                           outputs=['xgb_featureSelection.model'])
+
+accuracy = xgb_best['accuracy']
 print('Accuracy: %.3f%%' % (accuracy * 100.0)) 
 print('======================================================================') 
 
@@ -299,7 +315,7 @@ print('======================================================================')
 # XGBoost - plot feature importance
 plt.rcParams['figure.figsize'] = (10, 10)
 plt.rcParams.update({'font.size': 10})
-ax = plot_importance(model)
+ax = plot_importance(xgb_best['importance_weight'])
 fig = ax.figure
 plt.tight_layout()
 fig.savefig('xgb_featureImportance_bestThresh.png', dpi=my_dpi*10, 
@@ -307,26 +323,23 @@ fig.savefig('xgb_featureImportance_bestThresh.png', dpi=my_dpi*10,
 plt.show();
 
 # Permutation Based Feature Importance (with scikit-learn)
-perm_importance = permutation_importance(model, X, y)
+perm_importance_mean = xgb_best['perm_importance_mean']
 
 # Visualize Permutation Based Feature Importance
 plt.rcParams['figure.figsize'] = (10, 10)
 plt.rcParams.update({'font.size': 10})
-sorted_idx = perm_importance.importances_mean.argsort()
-plt.barh(X.columns[sorted_idx], perm_importance.importances_mean[sorted_idx])
+sorted_idx = perm_importance_mean.argsort()
+plt.barh(X.columns[sorted_idx], perm_importance_mean[sorted_idx])
 plt.xlabel('Permutation Importance')
 plt.savefig('xgb_PermutationfeatureImportance_noVIF_bestThresh.png')
 plt.show();
 
 ###############################################################################
 # Feature Importance Computed with SHAP Values
-explainer = shap.TreeExplainer(model)
-shap_values = explainer.shap_values(X)
-
 # Visualize feature importance with SHAP
 fig = plt.figure()
 plt.rcParams.update({'font.size': 7})
-shap.summary_plot(shap_values, X, show=False)
+shap.summary_plot(xgb_best['shap_values'], X, show=False)
 fig.savefig('ShapSummary_xgb_bestThresh.png', dpi=my_dpi*10, 
             bbox_inches='tight')
 plt.show();
@@ -342,31 +355,42 @@ y = df.loan_status
 # Select numeric data
 df_num = X1.select_dtypes(include = ['float64', 'int64'])
 
+# Each VIF regression runs in its own worker with a single BLAS thread, so
+# the workers together use the cores once
+n_vif_workers = os.cpu_count()
+
 # Defining the VIF function for multicollinearity
 def calculate_vif(X, threshold=5.0):
+    """Returns the features remaining after dropping the highest VIF above the threshold and their VIF."""
     features = [X.columns[i] for i in range(X.shape[1])]
+    print('VIF workers: %d x 1 BLAS thread' % n_vif_workers)
     dropped = True
     while dropped:
         dropped = False
         print('\nThe starting number of quantitative features is: '
               + str(len(features)))
-        vif = Parallel(n_jobs=-1,
-                       verbose=5)(delayed(variance_inflation_factor)(X[features].values,
-                                                                     ix) for ix in range(len(features)))
+        with parallel_backend('loky', inner_max_num_threads=1):
+            vif = Parallel(n_jobs=n_vif_workers,
+                           verbose=5)(delayed(variance_inflation_factor)(X[features].values,
+                                                                         ix) for ix in range(len(features)))
         maxloc = vif.index(max(vif))
         if max(vif) > threshold:
             print(time.ctime() + ' dropping \'' + X[features].columns[maxloc]
                   + '\' at index: ' + str(maxloc))
-          features.pop(maxloc)
-          dropped = True
-  print('Features Remaining:')
-  print([features])
-  return X[[i for i in features]]
+            features.pop(maxloc)
+            dropped = True
+    print('Features Remaining:')
+    print([features])
+    return {'features': features,
+            'vif': pd.DataFrame({'feature': features, 'VIF': vif})}
 
 print('Time for calculating VIF on numerical data using threshold = 5...')
 search_time_start = time.time()
 
-X1 = calculate_vif(df_num, 5) 
+vif_result = fs_cache.cached('vif', (df_num,), {'threshold': 5},
+                             lambda: calculate_vif(df_num, 5))
+X1 = df_num[vif_result['features']]
+vif_result['vif'].to_csv('VIF_quantFeatures_thresh5.csv', index=False)
 print('\nNumber of quant features after VIF:', X1.shape[1]) 
 
 print('Finished calculating VIF on numerical data using threshold = 5 in:',
@@ -421,55 +445,72 @@ params = {
     'tol': [1e-1, 1e-2, 1e-3, 1e-4, 1e-5, 1e-6]
     }
 
-# Define grid search conditions
-grid = GridSearchCV(estimator = LogisticGroupLasso( 
-                    groups=groups, group_reg=0.05, l1_reg=0, scale_reg=None, 
-                    supress_warning=True, random_state=seed_value), 
-                    scoring='accuracy', cv=5, param_grid=params)
+def group_lasso_selection(X2, y):
+    """Returns the grid search results and chosen groups from the group lasso."""
+    # Define grid search conditions
+    grid = GridSearchCV(estimator = LogisticGroupLasso( 
+                        groups=groups, group_reg=0.05, l1_reg=0, scale_reg=None, 
+                        supress_warning=True, random_state=seed_value), 
+                        scoring='accuracy', cv=5, param_grid=params)
+    
+    with parallel_backend('threading', n_jobs=-1):
+        grid.fit(X2, y)
+    
+    cv_results = pd.DataFrame(grid.cv_results_)
+    cv_results['params'] = cv_results['params'].astype(str)
+    
+    # Fit the model using results from grid search
+    gl = LogisticGroupLasso(
+        groups=groups,
+        group_reg=0.05,
+        n_iter=3000,
+        tol=0.1, 
+        l1_reg=0,
+        scale_reg=None,
+        supress_warning=True,
+        random_state=seed_value,
+    )
+    
+    with parallel_backend('threading', n_jobs=-1):
+        gl.fit(X2, y)
+    
+    pred_y = gl.predict(X2)
+    
+    return {'best_params': grid.best_params_,
+            'best_score': grid.best_score_,
+            'cv_results': cv_results,
+            'sparsity_mask': np.asarray(gl.sparsity_mask_),
+            'chosen_groups': sorted(int(g) for g in gl.chosen_groups_),
+            'accuracy': (pred_y == y).mean(),
+            'losses': np.asarray(gl.losses_)}
 
 print('Time for feature selection using GroupLasso GridSearchCV...')
 search_time_start = time.time()
-with parallel_backend('threading', n_jobs=-1):
-    grid.fit(X2, y)
+gl_result = fs_cache.cached('group_lasso', (X2, y, groups),
+                            {'grid': params, 'group_reg': 0.05, 'l1_reg': 0,
+                             'cv': 5, 'n_iter': 3000, 'tol': 0.1,
+                             'random_state': seed_value},
+                            lambda: group_lasso_selection(X2, y))
 print('Finished feature selection using GroupLasso GridSearchCV in:',
       time.time() - search_time_start)
 
 print('\nGroup Lasso GridSearchCV Feature selection')
-print('\nBest Estimator:')
-print(grid.best_estimator_)
 print('\nBest Parameters:')
-print(grid.best_params_)
+print(gl_result['best_params'])
 print('\nBest Accuracy:')
-print(grid.best_score_)
+print(gl_result['best_score'])
 print('\nResults from GridSearch CV:')
-print(grid.cv_results_)
+print(gl_result['cv_results'])
 print('======================================================================') 
 
-# Fit the model using results from grid search
-gl = LogisticGroupLasso(
-    groups=groups,
-    group_reg=0.05,
-    n_iter=3000,
-    tol=0.1, 
-    l1_reg=0,
-    scale_reg=None,
-    supress_warning=True,
-    random_state=seed_value,
-)
-
-with parallel_backend('threading', n_jobs=-1):
-    gl.fit(X2, y)
-
-pred_y = gl.predict(X2)
-sparsity_mask = gl.sparsity_mask_ 
-accuracy = (pred_y == y).mean()
+sparsity_mask = gl_result['sparsity_mask']
+accuracy = gl_result['accuracy']
 
 print(f'Number of total variables: {len(sparsity_mask)}')
 print(f'Number of chosen variables: {sparsity_mask.sum()}')
 print(f'Accuracy: {accuracy}')
 
-tdf = pd.Series(list(gl.chosen_groups_)).T
-tdf = tdf.values.tolist()
+tdf = gl_result['chosen_groups']
 
 X2 = df1.drop('loan_status', axis=1)
 X2 = X2.iloc[:,tdf]
@@ -478,7 +519,7 @@ print(f'Selected variables from group lasso: {variables}')
 
 plt.rcParams['figure.figsize'] = (7, 5)
 plt.rcParams.update({'font.size': 15})
-plt.plot(gl.losses_)
+plt.plot(gl_result['losses'])
 plt.tight_layout()
 plt.xlabel('Iteration')
 plt.ylabel('Loss')
@@ -504,16 +545,15 @@ X2 = df.drop('loan_status', axis=1)
 # Create dummy variables for categorical variables    
 X2 = pd.get_dummies(X2, drop_first=True)
 
-# Use results from variable selection using MV-SIS completed in R
-X_mfs = X2[['num_bc_tl', 'num_il_tl', 'num_op_rev_tl', 'pymnt_plan_y',
-            'num_accts_ever_120_pd', 'mo_sin_old_rev_tl_op',
-            'last_pymnt_amnt', 'percent_bc_gt_75', 'revol_util',
-            'tot_hi_cred_lim', 'num_actv_rev_tl', 'disbursement_method_DirectPay',
-            'tot_coll_amt', 'term_ 60 months', 'mort_acc', 'funded_amnt_inv',
-            'int_rate', 'inq_last_6mths', 'delinq_2yrs', 'installment',
-            'collections_12_mths_ex_med', 'open_acc', 'loan_amnt',
-            'funded_amnt', 'annual_inc', 'num_tl_op_past_12m',
-            'home_ownership_OTHER', 'total_bc_limit']]
+# Variable selection using MV-SIS (previously completed in R)
+print('Time for feature screening using MV-SIS...')
+search_time_start = time.time()
+mvsis_rank, mvsis_features = mvsis_screen(X2, y, n_features=28)
+print('Finished feature screening using MV-SIS in:',
+      time.time() - search_time_start)
+mvsis_rank.to_csv('MVSIS_rank.csv', index=False)
+
+X_mfs = X2[mvsis_features]
 X_mfs = X_mfs.drop_duplicates()
 print('\nDimensions of Data using Variables selected from MVSIS:', X_mfs.shape) 
 print('======================================================================')
@@ -556,19 +596,18 @@ print('- Number of different features: ' + str(len(varDiff_mvsisVIF1)))
 print('======================================================================')
 
 # Add variables found in both MVSIS and xgb_VIF and only MVSIS to set for EDA
-df_tmp = df[['num_bc_tl', 'num_il_tl', 'num_op_rev_tl', 'num_accts_ever_120_pd',
-             'mo_sin_old_rev_tl_op', 'percent_bc_gt_75', 'revol_util',
-             'num_actv_rev_tl', 'tot_coll_amt', 'mort_acc', 'delinq_2yrs',
-             'collections_12_mths_ex_med', 'open_acc',
-             'num_tl_op_past_12m', 'home_ownership_OTHER']]
+s_vif = set(X_vif)
+df_tmp = X2[[x for x in X_mfs if x in s_vif or x not in s]]
 
+# Features already in X_xgb are kept once
 df = pd.concat([X_xgb, df_tmp, y], axis=1)
+df = df.loc[:, ~df.columns.duplicated()]
 df = df.drop_duplicates()
 print('- Dimensions of data using for further EDA:', df.shape)
 print('======================================================================')
 
 del X_xgb, X_vif, X_mfs
-del df_tmp, y, s, s1, varDiff_vif, varDiff_xgb, varDiff_mvsisAll
+del df_tmp, y, s, s1, s_vif, varDiff_vif, varDiff_xgb, varDiff_mvsisAll
 del varDiff_mvsisVIF, varDiff_mvsisAll1, varDiff_mvsisVIF1
 
 ###############################################################################
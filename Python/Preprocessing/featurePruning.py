@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+############# Prune Highly Correlated and Imbalanced Features #################
+###############################################################################
+# Features with |Spearman rho| above the threshold are joined into clusters
+# by the connected components of the thresholded correlation matrix and one
+# representative per cluster is kept. Dummy variables whose minority level is
+# rarer than min_freq are dropped. Correlation and frequency statistics are
+# read from the variable selection cache when the data has not changed
+import json
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+
+def _standardized_ranks(X):
+    """Returns the ranks of each column centered and scaled to unit norm."""
+    R = rankdata(X, axis=0).astype(np.float32)
+    R -= R.mean(axis=0)
+    norm = np.sqrt((R * R).sum(axis=0))
+    norm[norm == 0] = 1
+    R /= norm
+    return R
+
+
+def feature_stats(X, y=None):
+    """Returns the correlation matrix, dummy minority frequencies and correlation with the target."""
+    Xv = np.asarray(X, dtype=np.float64)
+    R = _standardized_ranks(Xv)
+    corr = R.T @ R
+
+    # Dummies are the columns taking only the values 0 and 1
+    is_dummy = ((Xv == 0) | (Xv == 1)).all(axis=0)
+    mean = Xv.mean(axis=0)
+    minority_freq = np.where(is_dummy, np.minimum(mean, 1 - mean), np.nan)
+
+    stats = {'corr': pd.DataFrame(corr, index=X.columns, columns=X.columns),
+             'minority_freq': pd.Series(minority_freq, index=X.columns,
+                                        name='minority_freq')}
+    if y is not None:
+        r_y = _standardized_ranks(np.asarray(y, dtype=np.float64).reshape(-1, 1))
+        target_corr = (R.T @ r_y).ravel()
+        stats['target_corr'] = pd.Series(target_corr, index=X.columns,
+                                         name='target_corr')
+    return stats
+
+
+def correlation_clusters(corr, threshold):
+    """Returns the cluster label of each feature from pairs with |rho| >= threshold.
+
+    Clusters are single linkage: a and c share a cluster when a-b and b-c
+    pass the threshold, even if a and c are barely correlated, so long
+    chains of features can end up with one representative.
+    """
+    adjacency = csr_matrix(np.abs(np.asarray(corr)) >= threshold)
+    _, labels = connected_components(adjacency, directed=False)
+    return labels
+
+
+def prune_features(stats, corr_threshold=0.8, min_freq=0.02, keep=()):
+    """Returns the drop list and a manifest of why each feature was dropped.
+
+    The representative kept for each correlated cluster is the member most
+    correlated with the target when available, otherwise the first column.
+    """
+    corr = stats['corr']
+    features = np.asarray(corr.columns)
+    labels = correlation_clusters(corr.values, corr_threshold)
+
+    if 'target_corr' in stats:
+        score = np.abs(stats['target_corr'].reindex(features).values)
+    else:
+        score = -np.arange(len(features), dtype=np.float64)
+    score = np.where(np.isin(features, list(keep)), np.inf, score)
+
+    drop_corr, clusters = [], []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        if len(members) == 1:
+            continue
+        rep = members[np.argmax(score[members])]
+        drop_corr += [features[m] for m in members if m != rep]
+        clusters.append({'kept': str(features[rep]),
+                         'dropped': [str(features[m]) for m in members if m != rep]})
+
+    freq = stats['minority_freq'].reindex(features)
+    rare = (freq < min_freq).values & ~np.isin(features, list(keep))
+    drop_rare = [f for f in features[rare] if f not in drop_corr]
+
+    manifest = {'corr_threshold': corr_threshold,
+                'min_freq': min_freq,
+                'clusters': clusters,
+                'rare_dummies': {str(f): float(freq[f]) for f in drop_rare},
+                'drop': [str(f) for f in drop_corr + drop_rare]}
+    return manifest['drop'], manifest
+
+
+def write_manifest(manifest, filename):
+    """Writes the pruning manifest as json."""
+    with open(filename, 'w') as file:
+        json.dump(manifest, file, indent=2)
+
+###############################################################################
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################### Cache for Variable Selection Results ######################
+###############################################################################
+# Results are keyed by a content hash of the input data plus the method name
+# and parameters, so reruns on unchanged data load instead of recomputing.
+# Each entry is one compressed npz holding arrays and data frames by column
+# with a json manifest of how to rebuild each result
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+
+def fingerprint(*objs):
+    """Returns a content hash of data frames, series, arrays or sparse matrices."""
+    h = hashlib.blake2b(digest_size=16)
+    for obj in objs:
+        if isinstance(obj, (pd.DataFrame, pd.Series)):
+            h.update(pd.util.hash_pandas_object(obj, index=False).values.tobytes())
+            names = obj.columns if isinstance(obj, pd.DataFrame) else [obj.name]
+            h.update(repr([str(c) for c in names]).encode())
+            dtypes = obj.dtypes if isinstance(obj, pd.DataFrame) else [obj.dtype]
+            h.update(repr([str(d) for d in dtypes]).encode())
+        elif scipy.sparse.issparse(obj):
+            obj = obj.tocsr()
+            for part in (obj.data, obj.indices, obj.indptr):
+                h.update(np.ascontiguousarray(part).tobytes())
+            h.update(repr(obj.shape).encode())
+        else:
+            obj = np.ascontiguousarray(obj)
+            h.update(obj.tobytes())
+            h.update(repr((obj.shape, str(obj.dtype))).encode())
+    return h.hexdigest()
+
+
+class FeatureSelectionCache:
+    """On-disk cache of variable selection results."""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, method, data, params=None):
+        """Returns the cache key for a method run on data with params."""
+        params = json.dumps(params or {}, sort_keys=True, default=str)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(method.encode())
+        h.update(fingerprint(*data).encode())
+        h.update(params.encode())
+        return method + '_' + h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def save(self, key, result):
+        """Writes a dict of data frames, series, arrays, lists and scalars."""
+        arrays, manifest = {}, {}
+        for name, value in result.items():
+            if isinstance(value, pd.DataFrame):
+                cols = [str(c) for c in value.columns]
+                for i, c in enumerate(value.columns):
+                    arrays['%s__col%d' % (name, i)] = value[c].values
+                arrays[name + '__index'] = value.index.values
+                manifest[name] = {'type': 'frame', 'columns': cols}
+            elif isinstance(value, pd.Series):
+                arrays[name] = value.values
+                arrays[name + '__index'] = value.index.values
+                manifest[name] = {'type': 'series', 'name': value.name}
+            elif isinstance(value, np.ndarray):
+                arrays[name] = value
+                manifest[name] = {'type': 'array'}
+            else:
+                # Lists, dicts and scalars go in the manifest as json
+                manifest[name] = {'type': 'json', 'value': value}
+
+        arrays['__manifest__'] = np.frombuffer(
+            json.dumps(manifest, default=_to_json).encode(), dtype=np.uint8)
+
+        # Write then rename so an interrupted run never leaves a partial entry
+        tmp_file = self._file(key) + '.tmp'
+        with open(tmp_file, 'wb') as file:
+            np.savez_compressed(file, **arrays)
+        os.replace(tmp_file, self._file(key))
+
+    def load(self, key):
+        """Returns the cached dict for key, or None when it was never computed."""
+        if not os.path.exists(self._file(key)):
+            return None
+
+        with np.load(self._file(key), allow_pickle=True) as npz:
+            manifest = json.loads(npz['__manifest__'].tobytes().decode())
+            result = {}
+            for name, spec in manifest.items():
+                if spec['type'] == 'frame':
+                    result[name] = pd.DataFrame(
+                        {c: npz['%s__col%d' % (name, i)]
+                         for i, c in enumerate(spec['columns'])},
+                        index=npz[name + '__index'])
+                elif spec['type'] == 'series':
+                    result[name] = pd.Series(npz[name],
+                                             index=npz[name + '__index'],
+                                             name=spec['name'])
+                elif spec['type'] == 'array':
+                    result[name] = npz[name]
+                else:
+                    result[name] = spec['value']
+        return result
+
+    def cached(self, method, data, params, compute, outputs=()):
+        """Returns the cached result for method, calling compute() on a miss.
+
+        outputs are files written by compute(), which is called again when
+        one of them is missing even if the result is cached.
+        """
+        key = self.key(method, data, params)
+        result = self.load(key)
+        missing = [f for f in outputs if not os.path.exists(f)]
+        if result is None or missing:
+            if result is None:
+                print('- Computing ' + method + ' (not in cache)')
+            else:
+                print('- Computing ' + method + ' (missing ' + ', '.join(missing) + ')')
+            result = compute()
+            self.save(key, result)
+        else:
+            print('- Loaded ' + method + ' from cache')
+        return result
+
+
+def _to_json(value):
+    """Converts numpy scalars and arrays in json results."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError('Cannot store %s in the feature selection cache' % type(value))
+
+###############################################################################
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################### Boruta for Variable Selection #############################
+###############################################################################
+# Python port of the Boruta section of R/Preprocessing/EDA_VariableSelection.R
+# Each round fits the importance forests concurrently in threads with the
+# cores split between them and tests the hits of every feature against the
+# best shadow with a binomial test. Every concurrent forest has one buffer
+# whose base half is copied in once and only its shadow half is permuted in
+# place before each fit
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import binom
+from sklearn.ensemble import RandomForestClassifier
+from joblib import Parallel, delayed
+
+
+def load_data(filename, target='loan_status'):
+    """Returns features and target from a csv, parquet or npy/npz data set."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.parquet':
+        df = pd.read_parquet(filename)
+    elif ext in ('.npy', '.npz'):
+        # Last column is the target as written by the numpy stages
+        arr = np.load(filename)
+        if ext == '.npz':
+            arr = arr[arr.files[0]]
+        return pd.DataFrame(arr[:, :-1]), pd.Series(arr[:, -1], name=target)
+    else:
+        df = pd.read_csv(filename, low_memory=False)
+    return df.drop(target, axis=1), df[target]
+
+
+def _fit_importance(Z, y, p, rng, forest_params, seed):
+    """Reshuffles the shadow half of Z in place and returns real and max shadow importance."""
+    shadow = Z[:, p:]
+    rng.permuted(shadow, axis=0, out=shadow)
+
+    rf = RandomForestClassifier(random_state=seed, **forest_params)
+    rf.fit(Z, y)
+    imp = rf.feature_importances_
+
+    return imp[:p], imp[p:].max()
+
+
+class Boruta:
+    """All-relevant feature selection with shadow features (Kursa and Rudnicki, 2010)."""
+
+    def __init__(self, max_runs=100, alpha=0.01, n_forests=2, n_estimators=200,
+                 max_depth=7, n_jobs=-1, random_state=42):
+        self.max_runs = max_runs
+        self.alpha = alpha
+        self.n_forests = n_forests
+        self.n_estimators = n_estimators
+        self.max_depth = max_depth
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def fit(self, X, y):
+        """Runs Boruta rounds until every feature is decided or max_runs is reached."""
+        self.features_ = list(X.columns)
+        p = len(self.features_)
+        y = np.asarray(y).ravel()
+
+        # A forest is fit on one matrix, so each concurrent forest has its
+        # own buffer. The base half is copied in once and never written
+        # again, only the shadow half is reshuffled every round
+        buffers = []
+        for k in range(self.n_forests):
+            Z = np.empty((len(X), 2 * p), dtype=np.float32)
+            Z[:, :p] = X.to_numpy() if k == 0 else buffers[0][:, :p]
+            Z[:, p:] = Z[:, :p]
+            buffers.append(Z)
+
+        seeds = np.random.SeedSequence(self.random_state).spawn(self.n_forests)
+        rngs = [np.random.default_rng(s) for s in seeds]
+
+        # Split the cores between the concurrent forests
+        n_cores = os.cpu_count() if self.n_jobs == -1 else self.n_jobs
+        forest_params = {'n_estimators': self.n_estimators,
+                         'max_depth': self.max_depth,
+                         'n_jobs': max(1, n_cores // self.n_forests)}
+
+        hits = np.zeros(p, dtype=np.int64)
+        decision = np.zeros(p, dtype=np.int8)
+        imp_history, shadow_history, round_time = [], [], []
+        n_runs = 0
+
+        while n_runs < self.max_runs and (decision == 0).any():
+            start = time.time()
+            out = Parallel(n_jobs=self.n_forests, prefer='threads')(
+                delayed(_fit_importance)(buffers[k], y, p, rngs[k],
+                                         forest_params,
+                                         self.random_state + n_runs * self.n_forests + k)
+                for k in range(self.n_forests))
+
+            for imp, shadow_max in out:
+                hits += imp > shadow_max
+                imp_history.append(imp)
+                shadow_history.append(shadow_max)
+            n_runs += self.n_forests
+
+            # Two-sided binomial test with Bonferroni correction over undecided features
+            undecided = decision == 0
+            alpha = self.alpha / undecided.sum()
+            p_accept = binom.sf(hits - 1, n_runs, 0.5)
+            p_reject = binom.cdf(hits, n_runs, 0.5)
+            decision[undecided & (p_accept < alpha)] = 1
+            decision[undecided & (p_reject < alpha)] = -1
+
+            round_time.append(time.time() - start)
+            print('Boruta round %d: %d confirmed, %d rejected, %d tentative in %.2fs'
+                  % (n_runs // self.n_forests, (decision == 1).sum(),
+                     (decision == -1).sum(), (decision == 0).sum(),
+                     round_time[-1]))
+
+        self.n_runs_ = n_runs
+        self.hits_ = hits
+        self.decision_ = decision
+        self.imp_history_ = pd.DataFrame(imp_history, columns=self.features_)
+        self.imp_history_['shadowMax'] = shadow_history
+        self.round_time_ = np.array(round_time)
+        return self
+
+    def tentative_rough_fix(self):
+        """Decides tentative features by median importance against the median best shadow."""
+        tentative = self.decision_ == 0
+        med_imp = self.imp_history_[self.features_].median().values
+        med_shadow = self.imp_history_['shadowMax'].median()
+        self.decision_[tentative & (med_imp > med_shadow)] = 1
+        self.decision_[tentative & (med_imp <= med_shadow)] = -1
+        return self
+
+    def att_stats(self):
+        """Returns importance statistics and the decision for every feature."""
+        imp = self.imp_history_[self.features_]
+        labels = np.array(['Rejected', 'Tentative', 'Confirmed'])
+        return pd.DataFrame({'meanImp': imp.mean().values,
+                             'medianImp': imp.median().values,
+                             'minImp': imp.min().values,
+                             'maxImp': imp.max().values,
+                             'normHits': self.hits_ / self.n_runs_,
+                             'decision': labels[self.decision_ + 1]},
+                            index=self.features_)
+
+    def selected_features(self, with_tentative=False):
+        """Returns the confirmed features, optionally with the tentative ones."""
+        keep = self.decision_ >= (0 if with_tentative else 1)
+        return [f for f, k in zip(self.features_, keep) if k]
+
+###############################################################################
+if __name__ == '__main__':
+    print('\nLoan Status: Boruta for Variable Selection')
+    print('======================================================================')
+
+    path = r'D:\LoanStatus\Data'
+    os.chdir(path)
+
+    X, y = load_data('LendingTree_LoanStatus_EDA.csv')
+    X = pd.get_dummies(X, drop_first=True)
+
+    search_time_start = time.time()
+    boruta_df = Boruta().fit(X, y)
+    print('Finished Boruta in:', time.time() - search_time_start)
+
+    path = r'D:\LoanStatus\Python\EDA'
+    os.chdir(path)
+
+    boruta_df.tentative_rough_fix()
+    boruta_stats = boruta_df.att_stats()
+    boruta_stats.to_csv('borutaDF_attStats.csv')
+    boruta_df.imp_history_.to_csv('borutaDF_impHistory.csv', index=False)
+    pd.DataFrame({'round_time': boruta_df.round_time_}).to_csv(
+        'borutaDF_roundTime.csv', index=False)
+
+    print('\nConfirmed features:')
+    print(boruta_df.selected_features())
+    print('======================================================================')
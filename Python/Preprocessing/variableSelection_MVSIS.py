@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+@author: aschu
+"""
+###############################################################################
+################ Model-Free Screening (MV-SIS) for Variable Selection #########
+###############################################################################
+# Python port of R/EDA/MVSIS.R and R/EDA/MVSIS_from_SourceCode.R
+# MV(X_k|Y) = sum_r p_r * E[(F_r(X_k) - F(X_k))^2], where F is the empirical
+# CDF of X_k and F_r the empirical CDF of X_k within class Y=r
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+from joblib import Parallel, delayed
+
+
+def _mv_block(X, y_codes, n_classes):
+    """Returns the MV statistic for every column of a block of features."""
+    n = X.shape[0]
+
+    # Position in the sorted column of the last tie, so F(x) = #(X <= x) / n
+    rank_max = rankdata(X, method='max', axis=0).astype(np.int64) - 1
+    order = np.argsort(X, axis=0, kind='mergesort')
+    F = (rank_max + 1) / n
+
+    mv = np.zeros(X.shape[1])
+    for r in range(n_classes):
+        ind_yr = (y_codes == r)
+        n_r = ind_yr.sum()
+
+        # Running count of class r along each sorted column gives F_r at the
+        # sorted positions; ties take the count at the end of the tie group
+        cum_r = np.cumsum(ind_yr[order], axis=0, dtype=np.int32)
+        F_r = np.take_along_axis(cum_r, rank_max, axis=0) / n_r
+        mv += (n_r / n) * np.mean((F_r - F) ** 2, axis=0)
+
+    return mv
+
+
+def mvsis_statistic(X, y, block_size=8, n_jobs=-1):
+    """Returns the MV-SIS statistic for all features, computed over column blocks in parallel."""
+    X = np.asarray(X, dtype=np.float64)
+    if np.isnan(X).any():
+        raise ValueError('MV-SIS requires complete cases; X contains missing values.')
+
+    _, y_codes = np.unique(np.asarray(y).ravel(), return_inverse=True)
+    n_classes = y_codes.max() + 1
+
+    blocks = [slice(i, min(i + block_size, X.shape[1]))
+              for i in range(0, X.shape[1], block_size)]
+
+    # Threads share X without copying it; sorting and cumsum release the GIL
+    mv = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_mv_block)(X[:, b], y_codes, n_classes) for b in blocks)
+
+    return np.concatenate(mv)
+
+
+def mvsis_screen(X, y, n_features=None, block_size=8, n_jobs=-1):
+    """Returns features ranked by MV-SIS and the names of the top n_features.
+
+    If n_features is None, the cutoff [n/log(n)] from Cui, Li and Zhong (2015)
+    is used.
+    """
+    mv = mvsis_statistic(X, y, block_size=block_size, n_jobs=n_jobs)
+
+    mvsis_rank = pd.DataFrame({'feature': X.columns, 'MV': mv})
+    mvsis_rank = mvsis_rank.sort_values('MV', ascending=False,
+                                        kind='mergesort')
+    mvsis_rank.reset_index(inplace=True, drop=True)
+    mvsis_rank['rank'] = np.arange(1, len(mvsis_rank) + 1)
+
+    if n_features is None:
+        n = X.shape[0]
+        n_features = int(np.floor(n / np.log(n)))
+    n_features = min(n_features, len(mvsis_rank))
+
+    return mvsis_rank, mvsis_rank['feature'][:n_features].tolist()
+
+###############################################################################